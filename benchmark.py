@@ -0,0 +1,155 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+# Number of jobs of the synthetic datasets, length of the scheduling window and number of timed runs per stage
+NUM_JOBS = 10000
+WINDOW_DAYS = 3
+REPEAT = 3
+
+# Fixed window start, so every run expands the same occurrences
+START_TIME = datetime.datetime(2024, 1, 1)
+
+# Number of schedules get_task_datetimes is called for, one at a time
+LOOKUP_SCHEDULES = 1000
+
+# A stage is reported as a regression when it is this much slower (or uses this much more memory) than the baseline
+TOLERANCE = 0.25
+# Differences in wall time below this many seconds are noise and never reported
+MIN_SECONDS = 0.01
+
+
+def measure(function, repeat=REPEAT):
+    """
+    Run a function repeat times and once more under tracemalloc.
+
+    Returns:
+    - tuple: (seconds, peak_bytes, result) where seconds is the fastest wall time, peak_bytes the peak memory
+      allocated during the traced run and result the value returned by the last run.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - start)
+    # Tracing slows the allocations down, so the memory is measured on a separate run
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        result = function()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak_bytes, result
+
+
+def run_benchmarks(num_jobs=NUM_JOBS, days=WINDOW_DAYS, repeat=REPEAT, seed=0):
+    """
+    Time every stage of the pipeline on synthetic datasets of num_jobs jobs.
+
+    Each stage is fed the output of the previous ones, as in cron_task_scheduler.build_schedule.
+
+    Returns:
+    - list: One dict per stage with its 'stage' name, 'seconds' and 'peak_bytes'.
+    """
+    import pandas as pd
+    import cron_occurrences
+    import cron_schedule_lookup
+    import cron_task_scheduler
+    import data_preprocessor
+    import gantt_chart_generator
+    import synthetic_data
+
+    start_time = START_TIME
+    end_time = start_time + datetime.timedelta(days=days)
+    time_zone = pd.Timedelta(hours=3, minutes=30)
+    results = []
+
+    def stage(name, function):
+        # The caches of the occurrence engine would make every run after the first one free
+        def run():
+            cron_occurrences.cache_clear()
+            return function()
+        seconds, peak_bytes, result = measure(run, repeat)
+        results.append({'stage': name, 'seconds': seconds, 'peak_bytes': peak_bytes})
+        print("{:<28} {:9.3f} s {:9.1f} MiB".format(name, seconds, peak_bytes / 2 ** 20))
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = synthetic_data.generate_datasets(num_jobs, directory, seed)
+        cron_data = stage('process_data', lambda: data_preprocessor.process_data(*paths))
+
+    stage('generate_start_date', lambda: cron_task_scheduler.generate_start_date(cron_data.copy()))
+    free_times = stage('find_free_times', lambda: cron_task_scheduler.find_free_times(cron_data, start_time, end_time, consider_category=True))
+    schedules = stage('generate_crontab_schedule', lambda: pd.concat(
+        [cron_task_scheduler.generate_crontab_schedule(free_times, 4, 2, average_runtime, time_zone)
+         for average_runtime in cron_task_scheduler.DEFAULT_RUNTIMES], ignore_index=True))
+    stage('priority_check', lambda: cron_task_scheduler.priority_check(schedules.copy(), cron_data, start_time, end_time))
+    stage('get_task_datetimes', lambda: [cron_schedule_lookup.get_task_datetimes(schedule, start_time, end_time, (22, 3), datetime.timezone.utc)
+                                         for schedule in cron_data['schedule'][:LOOKUP_SCHEDULES]])
+
+    def gantt_data():
+        # The data preparation of create_gantt_chart, without rendering the chart
+        table = cron_occurrences.OccurrenceTable.from_schedules(cron_data['schedule'], start_time, end_time,
+                                                                runtimes=cron_data['avg_runtime'].to_numpy('timedelta64[ns]'))
+        return gantt_chart_generator.gantt_bars(table, cron_data['job_name'].to_numpy(), cron_data['category'].to_numpy(),
+                                                start_time, end_time)
+    stage('create_gantt_chart (data)', gantt_data)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare results with a baseline from a previous run and print the stages that got slower or bigger.
+
+    Returns:
+    - bool: True if no stage regressed by more than tolerance.
+    """
+    previous = {result['stage']: result for result in baseline}
+    ok = True
+    for result in results:
+        before = previous.get(result['stage'])
+        if before is None:
+            continue
+        for key in ('seconds', 'peak_bytes'):
+            if key == 'seconds' and result[key] - before[key] < MIN_SECONDS:
+                continue
+            if before[key] > 0 and result[key] > before[key] * (1 + tolerance):
+                ok = False
+                print("{}: {} went from {:.4g} to {:.4g} (+{:.0%})".format(result['stage'], key, before[key], result[key],
+                                                                         result[key] / before[key] - 1))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the stages of the pipeline on synthetic datasets.")
+    parser.add_argument('--jobs', type=int, default=NUM_JOBS, help="Number of jobs (default {})".format(NUM_JOBS))
+    parser.add_argument('--days', type=int, default=WINDOW_DAYS, help="Length of the window in days (default {})".format(WINDOW_DAYS))
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="Timed runs per stage (default {})".format(REPEAT))
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic datasets (default 0)")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare the results with this JSON file and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="Allowed slowdown (default {})".format(TOLERANCE))
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = run_benchmarks(args.jobs, args.days, args.repeat, args.seed)
+    report = {'jobs': args.jobs, 'days': args.days, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return 0 if compare(results, baseline['results'], args.tolerance) else 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
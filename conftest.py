@@ -0,0 +1,10 @@
+import pandas as pd
+
+
+def make_jobs(rows):
+    """
+    Builds a merged job table from (job name, schedule, runtime in minutes, category, priority) rows.
+    """
+    return pd.DataFrame({'job_name': [row[0] for row in rows], 'schedule': [row[1] for row in rows],
+                         'avg_runtime': pd.to_timedelta([row[2] for row in rows], unit='m'),
+                         'category': [row[3] for row in rows], 'priority': [row[4] for row in rows]})
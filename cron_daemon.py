@@ -0,0 +1,457 @@
+import asyncio
+import heapq
+import itertools
+import shlex
+import numpy as np
+import cron_occurrences
+import instrumentation
+import time_zones
+
+
+MINUTES_PER_DAY = 1440
+
+# Number of jobs of the same category allowed to run at once, unless set otherwise for the category
+DEFAULT_CONCURRENCY = 4
+
+# Number of days of fire times expanded at once for each schedule; the next fire time of a job is then found
+# with a binary search in the expanded array
+FIRE_WINDOW_DAYS = 1
+
+# Longest time the daemon sleeps on the system clock before looking at the time again, so it follows changes of
+# the system time
+MAX_SLEEP_SECONDS = 60
+
+# Seconds between two checks of the datasets for changes by watch()
+RELOAD_SECONDS = 30
+
+# The timer heap is rebuilt without its outdated entries when it holds more than twice as many entries as jobs
+# (plus this many)
+COMPACT_MIN = 1024
+
+# Number of times FakeClock.advance lets the event loop run the tasks that became ready
+SETTLE_STEPS = 20
+
+
+class SystemClock:
+    """
+    The UTC wall clock, for running the daemon for real.
+    """
+
+    def now(self):
+        # Naive UTC, as the crontab schedules are evaluated in UTC
+        return np.datetime64(time_zones.utc_now(), 'us')
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(max(seconds, 0))
+
+    async def sleep_until(self, deadline):
+        while True:
+            seconds = (deadline - self.now()) / np.timedelta64(1, 's')
+            if seconds <= 0:
+                return
+            await asyncio.sleep(min(seconds, MAX_SLEEP_SECONDS))
+
+    async def wait(self, deadline, event):
+        """
+        Waits until the deadline (never if None) or until the event is set, whichever comes first.
+        """
+        await _wait_either(self.sleep_until(deadline) if deadline is not None else None, event)
+
+
+class FakeClock:
+    """
+    A clock that only moves when advance() is called, for driving the daemon deterministically.
+
+    Every coroutine sleeping on the clock (the daemon waiting for its next timer, simulated jobs) is woken in order
+    of deadline while the clock is advanced, and the event loop is given the chance to run the tasks that became
+    ready before the clock moves on.
+    """
+
+    def __init__(self, start):
+        self._now = np.datetime64(start, 'us')
+        self._sleepers = []
+        self._seq = itertools.count()
+
+    def now(self):
+        return self._now
+
+    async def sleep(self, seconds):
+        await self.sleep_until(self._now + _microseconds(seconds))
+
+    async def sleep_until(self, deadline):
+        if deadline <= self._now:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (np.datetime64(deadline, 'us'), next(self._seq), future))
+        await future
+
+    async def wait(self, deadline, event):
+        await _wait_either(self.sleep_until(deadline) if deadline is not None else None, event)
+
+    async def advance(self, seconds):
+        """
+        Moves the clock forward by a number of seconds, waking the sleepers whose deadline is reached on the way.
+        """
+        target = self._now + _microseconds(seconds)
+        await _settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            deadline, _, future = heapq.heappop(self._sleepers)
+            # Sleepers cancelled in the meantime (the daemon woken by a reload, say) are dropped
+            if future.done():
+                continue
+            self._now = max(self._now, deadline)
+            future.set_result(None)
+            await _settle()
+        self._now = target
+        await _settle()
+
+
+class Daemon:
+    """
+    Runs the jobs of a data_preprocessor table at the fire times of their crontab schedules (evaluated in UTC).
+
+    The next fire time of every job is kept in a heap, so each fire costs O(log n) for n jobs: the job is popped,
+    its next fire time is found by a binary search in the expanded fire times of its schedule (shared by the jobs
+    with the same schedule) and it is pushed back. Fired jobs wait in one queue per category, ordered by priority
+    (1 first, 5 last) then fire time, and are started as long as fewer than the concurrency limit of their category
+    are running. A job fired again while still queued is only run once (counted as skipped), and fire times missed
+    while the daemon could not keep up are run once, not once per missed time.
+
+    Parameters:
+    - cron_data (pandas DataFrame): The job table, with 'job_name', 'schedule', 'avg_runtime', 'category' and
+      'priority' columns.
+    - runner (async callable): Called as runner(job, fire_time) to run a job, with job a dict of the columns of its
+      row and fire_time a datetime64[m]. Default is simulate, which only waits for the average runtime on the clock.
+    - concurrency (int or dict): The number of jobs allowed to run at once in every category, or a dict of limits
+      by category (categories not listed get DEFAULT_CONCURRENCY). Default is DEFAULT_CONCURRENCY.
+    - clock (SystemClock or FakeClock): The clock. Default is the system clock.
+    """
+
+    def __init__(self, cron_data, runner=None, concurrency=DEFAULT_CONCURRENCY, clock=None):
+        self.clock = clock if clock is not None else SystemClock()
+        self.runner = runner if runner is not None else self.simulate
+        self.concurrency = concurrency
+        self.jobs = {}
+        self.stats = {'fired': 0, 'started': 0, 'finished': 0, 'failed': 0, 'skipped': 0, 'invalid': 0}
+        self._timers = []
+        self._ready = {}
+        self._running = {}
+        self._tasks = set()
+        self._fire_times = {}
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._stopped = False
+        self.reload(cron_data)
+
+    @instrumentation.stage('daemon_reload')
+    def reload(self, cron_data):
+        """
+        Replaces the job table without rebuilding the timer heap.
+
+        Only the jobs whose schedule changed, and the added ones, get a new timer; jobs whose category, priority or
+        runtime changed are updated in place, and the timers of removed or rescheduled jobs are dropped when they
+        come up. Runs in progress are not interrupted.
+
+        Returns:
+        - dict: The number of 'added', 'removed', 'rescheduled' and 'updated' jobs.
+        """
+        import pandas as pd
+
+        now = self._minute()
+        changes = {'added': 0, 'removed': 0, 'rescheduled': 0, 'updated': 0}
+        runtimes = pd.to_timedelta(cron_data['avg_runtime']).fillna(pd.Timedelta(0)).dt.total_seconds()
+        seen = set()
+        for name, schedule, runtime, category, priority in zip(cron_data['job_name'], cron_data['schedule'], runtimes,
+                                                              cron_data['category'], cron_data['priority']):
+            seen.add(name)
+            fields = {'job_name': name, 'schedule': schedule, 'avg_runtime': float(runtime), 'category': category,
+                      'priority': int(priority)}
+            job = self.jobs.get(name)
+            if job is not None and job['schedule'] == schedule:
+                if any(job[key] != value for key, value in fields.items()):
+                    job.update(fields)
+                    changes['updated'] += 1
+                continue
+            if job is None:
+                job = self.jobs[name] = dict(fields, version=0, pending=False)
+                changes['added'] += 1
+            else:
+                job.update(fields)
+                job['version'] += 1
+                changes['rescheduled'] += 1
+            self._push_timer(job, now)
+
+        for name in set(self.jobs) - seen:
+            # Queued runs of removed jobs are dropped when they reach the front of their queue
+            del self.jobs[name]
+            changes['removed'] += 1
+        # Forget the fire times of schedules no job uses any more
+        schedules = {job['schedule'] for job in self.jobs.values()}
+        for schedule in set(self._fire_times) - schedules:
+            del self._fire_times[schedule]
+        if len(self._timers) > 2 * len(self.jobs) + COMPACT_MIN:
+            self._compact()
+        self._wake.set()
+        return changes
+
+    async def run(self, until=None, drain=True):
+        """
+        Fires and runs the jobs until stop() is called or the clock reaches until.
+
+        Parameters:
+        - until (datetime or numpy.datetime64): Stop at this UTC time. Default is to run until stop() is called.
+        - drain (bool): Wait for the runs in progress before returning. Default is True.
+        """
+        until = np.datetime64(until, 'us') if until is not None else None
+        self._stopped = False
+        while not self._stopped:
+            now = self.clock.now()
+            if until is not None and now >= until:
+                break
+            self._wake.clear()
+            self._fire_due(int(now.astype('datetime64[m]').astype(np.int64)))
+            self._dispatch()
+            deadline = None
+            if self._timers:
+                deadline = np.datetime64(int(self._timers[0][0]), 'm').astype('datetime64[us]')
+            if until is not None:
+                deadline = until if deadline is None else min(deadline, until)
+            await self.clock.wait(deadline, self._wake)
+        if drain and self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stop(self):
+        """
+        Makes run() return; the runs in progress are left to finish.
+        """
+        self._stopped = True
+        self._wake.set()
+
+    async def watch(self, functions_path, dags_path, priority_path, interval=RELOAD_SECONDS, cache_path=None,
+                    table_path=None):
+        """
+        Reloads the job table whenever one of the datasets changes, until stop() is called.
+
+        The datasets (or the job table at table_path, if given) are checked by size and modification time every
+        interval seconds, and read with data_preprocessor.load_data in a worker thread so the timers keep firing
+        meanwhile.
+        """
+        import data_preprocessor
+
+        paths = [table_path] if table_path is not None else [functions_path, dags_path, priority_path]
+        signatures = data_preprocessor.file_signatures(paths)
+        while not self._stopped:
+            await self.clock.sleep(interval)
+            current = data_preprocessor.file_signatures(paths)
+            if current == signatures:
+                continue
+            signatures = current
+            cron_data = await asyncio.get_running_loop().run_in_executor(
+                None, data_preprocessor.load_data, functions_path, dags_path, priority_path, cache_path, table_path)
+            self.reload(cron_data)
+
+    async def simulate(self, job, fire_time):
+        """
+        The default runner: waits for the average runtime of the job on the clock.
+        """
+        await self.clock.sleep(job['avg_runtime'])
+
+    def status(self):
+        """
+        Returns the number of jobs, timers, queued and running jobs by category, and the counters of the daemon.
+        """
+        return {'jobs': len(self.jobs), 'timers': len(self._timers),
+                'queued': {category: len(queue) for category, queue in self._ready.items() if queue},
+                'running': {category: count for category, count in self._running.items() if count},
+                'stats': dict(self.stats)}
+
+    def next_fire_times(self):
+        """
+        Returns the next fire time of every job, as a dict of datetime64[m] keyed by job name.
+        """
+        return {name: np.datetime64(minute, 'm') for minute, _, name, version in self._timers
+                if name in self.jobs and self.jobs[name]['version'] == version}
+
+    def _minute(self):
+        return int(self.clock.now().astype('datetime64[m]').astype(np.int64))
+
+    def _limit(self, category):
+        if isinstance(self.concurrency, dict):
+            return self.concurrency.get(category, DEFAULT_CONCURRENCY)
+        return self.concurrency
+
+    def _push_timer(self, job, minute):
+        # Schedule the first fire of the job strictly after the epoch minute
+        try:
+            next_minute = self._next_fire(job['schedule'], minute)
+        except ValueError:
+            self.stats['invalid'] += 1
+            return
+        if next_minute is not None:
+            heapq.heappush(self._timers, (next_minute, next(self._seq), job['job_name'], job['version']))
+
+    def _next_fire(self, schedule, minute):
+        # The first fire time of a schedule strictly after an epoch minute, or None if it never fires again
+        cached = self._fire_times.get(schedule)
+        if cached is not None and cached[0] <= minute + 1:
+            times = cached[1]
+            i = np.searchsorted(times, minute, side='right')
+            if i < len(times):
+                return int(times[i])
+
+        compiled = cron_occurrences.compile_cron(schedule)
+        first_day = (minute + 1) // MINUTES_PER_DAY
+        times = self._expand(compiled, first_day)
+        times = times[times > minute]
+        if not len(times):
+            # Sparse schedules (weekly, monthly): jump to the day of the next fire time
+            next_time = compiled.next_after(np.datetime64(minute, 'm'))
+            if np.isnat(next_time):
+                return None
+            times = self._expand(compiled, int(next_time.astype('datetime64[D]').astype(np.int64)))
+        # The expanded times cover every fire time from minute + 1 to the end of the window
+        self._fire_times[schedule] = (minute + 1, times)
+        return int(times[0])
+
+    def _expand(self, compiled, first_day):
+        start = np.datetime64(first_day, 'D')
+        return compiled.occurrences(start, start + np.timedelta64(FIRE_WINDOW_DAYS, 'D')).astype(np.int64)
+
+    def _fire_due(self, now):
+        # Pop every timer due by the epoch minute now and queue its job
+        fired = 0
+        while self._timers and self._timers[0][0] <= now:
+            minute, _, name, version = heapq.heappop(self._timers)
+            job = self.jobs.get(name)
+            if job is None or job['version'] != version:
+                continue
+            fired += 1
+            if job['pending']:
+                self.stats['skipped'] += 1
+            else:
+                job['pending'] = True
+                heapq.heappush(self._ready.setdefault(job['category'], []),
+                               (job['priority'], minute, next(self._seq), job))
+            # Fire times missed while the daemon was behind are skipped: the next one is after now
+            self._push_timer(job, max(minute, now))
+        self.stats['fired'] += fired
+        instrumentation.count('daemon_fire', fired=fired)
+
+    def _dispatch(self):
+        # Start the queued jobs of each category, highest priority first, up to its concurrency limit
+        for category, queue in self._ready.items():
+            limit = self._limit(category)
+            while queue and self._running.get(category, 0) < limit:
+                _, minute, _, job = heapq.heappop(queue)
+                if self.jobs.get(job['job_name']) is not job:
+                    continue
+                job['pending'] = False
+                self._running[category] = self._running.get(category, 0) + 1
+                task = asyncio.ensure_future(self._execute(job, category, np.datetime64(minute, 'm')))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job, category, fire_time):
+        self.stats['started'] += 1
+        try:
+            await self.runner({key: job[key] for key in ('job_name', 'schedule', 'avg_runtime', 'category', 'priority')},
+                              fire_time)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            self.stats['failed'] += 1
+            job['last_error'] = repr(error)
+        else:
+            self.stats['finished'] += 1
+        finally:
+            self._running[category] -= 1
+            # Let run() start the next queued job of the category
+            self._wake.set()
+
+    def _compact(self):
+        self._timers = [timer for timer in self._timers
+                        if timer[2] in self.jobs and self.jobs[timer[2]]['version'] == timer[3]]
+        heapq.heapify(self._timers)
+
+
+def command_runner(command):
+    """
+    Returns a runner starting a command for every run, with the fields of the job substituted into its arguments
+    (e.g. 'psql -c "SELECT {job_name}()"'). The command is split into arguments like a shell would, once, and run
+    without a shell, so a field never leaves its argument whatever characters it holds. A non-zero exit status
+    counts as a failed run.
+    """
+    arguments = shlex.split(command)
+
+    async def run(job, fire_time):
+        process = await asyncio.create_subprocess_exec(*[argument.format(**job) for argument in arguments])
+        status = await process.wait()
+        if status != 0:
+            raise RuntimeError("{} exited with status {}".format(job['job_name'], status))
+    return run
+
+
+async def _wait_either(sleeper, event):
+    # Wait for the sleeper coroutine or the event, cancelling the other one
+    tasks = [asyncio.ensure_future(event.wait())]
+    if sleeper is not None:
+        tasks.append(asyncio.ensure_future(sleeper))
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _settle():
+    for _ in range(SETTLE_STEPS):
+        await asyncio.sleep(0)
+
+
+def _microseconds(seconds):
+    return np.timedelta64(int(round(seconds * 1e6)), 'us')
+
+
+def main(argv=None):
+    import argparse
+    import data_preprocessor
+
+    parser = argparse.ArgumentParser(description='Run the jobs at the fire times of their crontab schedules (in UTC).')
+    parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+    parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+    parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+    parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='jobs of the same category allowed to run at once (default {})'.format(DEFAULT_CONCURRENCY))
+    parser.add_argument('--command', help='shell command started for every run, formatted with the fields of the job '
+                                          '(e.g. "echo {job_name}"); by default the runs are only simulated')
+    parser.add_argument('--reload-seconds', type=float, default=RELOAD_SECONDS,
+                        help='seconds between two checks of the datasets for changes (default {})'.format(RELOAD_SECONDS))
+    args = parser.parse_args(argv)
+
+    cron_data = data_preprocessor.load_data(args.functions, args.dags, args.priority, table_path=args.table)
+
+    async def serve():
+        runner = command_runner(args.command) if args.command else None
+        daemon = Daemon(cron_data, runner, args.concurrency)
+        if runner is None:
+            async def log(job, fire_time):
+                print("{} {} ({}, priority {})".format(fire_time, job['job_name'], job['category'], job['priority']))
+                await daemon.simulate(job, fire_time)
+            daemon.runner = log
+        watcher = asyncio.ensure_future(daemon.watch(args.functions, args.dags, args.priority, args.reload_seconds,
+                                                     data_preprocessor.CACHE_PATH, args.table))
+        try:
+            await daemon.run()
+        finally:
+            watcher.cancel()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
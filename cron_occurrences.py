@@ -0,0 +1,541 @@
+import concurrent.futures
+import datetime
+import functools
+import re
+import numpy as np
+import instrumentation
+import time_zones
+
+
+# Size of each cron field once expanded (minute, hour, day of month, month, day of week)
+FIELD_SIZES = (60, 24, 32, 13, 7)
+
+# Smallest and largest value of each cron field
+FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+# Field items parsed without croniter: a number, '*', '*/step' or 'first-last' with an optional step
+SIMPLE_ITEM = re.compile(r'^(?:(\*)|(\d+)(?:-(\d+))?)(?:/(\d+))?$')
+
+MINUTES_PER_DAY = 24 * 60
+
+# Maximum number of compiled schedules and of expanded (schedule, window) arrays kept in memory
+SCHEDULE_CACHE_SIZE = 65536
+OCCURRENCE_CACHE_SIZE = 1024
+
+# Memory used by an OccurrenceTable: an int32 job id plus int64 start and end per occurrence, and one int64 offset per job
+BYTES_PER_OCCURRENCE = 20
+BYTES_PER_JOB = 8
+
+
+class CronSchedule:
+    """
+    A crontab expression compiled into one bitmask per field.
+
+    Bit ``n`` of a field mask is set when the value ``n`` is allowed in that field, so a
+    minute mask of ``0b101`` fires at minutes 0 and 2. Expressions that cannot be
+    represented as plain bitmasks (``L``, ``#`` or seconds fields) keep a reference to
+    croniter and are expanded by iterating it instead.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.minute_mask = 0
+        self.hour_mask = 0
+        self.day_mask = 0
+        self.month_mask = 0
+        self.dow_mask = 0
+        self.day_or = False
+        self.fallback = False
+
+        # Plain numeric fields are parsed directly; croniter parses everything else (aliases, names, L, #,
+        # seconds, wrapping ranges) so those behave exactly as it does
+        expanded, nth_weekday = _expand_simple(expression), None
+        if expanded is None:
+            import croniter
+            expanded, nth_weekday = croniter.croniter.expand(expression)
+        if len(expanded) != 5 or nth_weekday or 'l' in expanded[2]:
+            self.fallback = True
+            return
+
+        masks = []
+        for values, size in zip(expanded, FIELD_SIZES):
+            if values[0] == '*':
+                mask = (1 << size) - 1
+            else:
+                mask = 0
+                for value in values:
+                    mask |= 1 << int(value)
+            masks.append(mask)
+        self.minute_mask, self.hour_mask, self.day_mask, self.month_mask, self.dow_mask = masks
+
+        # croniter (like Vixie cron) fires when either day field matches if both are restricted
+        self.day_or = expanded[2][0] != '*' and expanded[4][0] != '*'
+
+    def __repr__(self):
+        return "CronSchedule({!r})".format(self.expression)
+
+    def minutes_of_day(self):
+        """
+        Returns the sorted minute offsets (from midnight) at which the schedule fires on a matching day.
+        """
+        hours = np.flatnonzero(_bits(self.hour_mask, 24))
+        minutes = np.flatnonzero(_bits(self.minute_mask, 60))
+        return (hours[:, None] * 60 + minutes[None, :]).ravel()
+
+    def matching_days(self, days):
+        """
+        Returns a boolean mask telling which of the given days the schedule fires on.
+
+        Parameters:
+        - days (numpy array): Array of datetime64[D] values.
+
+        Returns:
+        - numpy array: Boolean array with the same shape as days.
+        """
+        return self.days_matching(days, _bits(self.month_mask, 13), _bits(self.day_mask, 32), _bits(self.dow_mask, 7),
+                                  self.day_or)
+
+    @staticmethod
+    def days_matching(days, months, days_of_month, days_of_week, day_or):
+        """
+        Applies cron's rules for the day fields to the given days, from lookup tables indexed by field value.
+
+        The tables are the boolean arrays of one schedule (as in matching_days), or any arrays supporting & and |
+        whose first axis is the field value, such as the packed bitsets of many jobs in schedule_index.
+
+        Parameters:
+        - days (numpy array): Array of datetime64[D] values.
+        - months (numpy array): Table indexed by month (1-12).
+        - days_of_month (numpy array): Table indexed by day of the month (1-31).
+        - days_of_week (numpy array): Table indexed by day of the week (0-6, from Sunday).
+        - day_or: Whether either day field matching is enough (both fields restricted), like the tables.
+
+        Returns:
+        - numpy array: The combined tables of every day, e.g. a boolean array with the same shape as days.
+        """
+        month_start = days.astype('datetime64[M]')
+        month = month_start.astype(np.int64) % 12 + 1
+        day = (days - month_start).astype(np.int64) + 1
+        # 1970-01-01 was a Thursday, which is day 4 in cron's Sunday-based numbering
+        dow = (days.astype(np.int64) + 4) % 7
+
+        day_ok, dow_ok = days_of_month[day], days_of_week[dow]
+        # croniter (like Vixie cron) fires when either day field matches if both are restricted
+        return months[month] & ((day_ok & dow_ok) | (day_or & (day_ok | dow_ok)))
+
+    def occurrences(self, start, end):
+        """
+        Generates every fire time of the schedule within [start, end).
+
+        Parameters:
+        - start (datetime or numpy.datetime64): Start of the window (inclusive).
+        - end (datetime or numpy.datetime64): End of the window (exclusive).
+
+        Returns:
+        - numpy array: Sorted datetime64[m] array of fire times.
+        """
+        start = _to_minute(start, ceil=True)
+        end = _to_minute(end, ceil=True)
+        if end <= start:
+            return np.empty(0, dtype='datetime64[m]')
+        if self.fallback:
+            return self._croniter_occurrences(start, end)
+
+        days = np.arange(start.astype('datetime64[D]'), end.astype('datetime64[D]') + 1, dtype='datetime64[D]')
+        days = days[self.matching_days(days)]
+        offsets = self.minutes_of_day().astype('timedelta64[m]')
+        times = (days.astype('datetime64[m]')[:, None] + offsets[None, :]).ravel()
+        return times[(times >= start) & (times < end)]
+
+    def next_after(self, moment):
+        """
+        Returns the first fire time strictly after the given moment, like croniter's get_next().
+
+        Parameters:
+        - moment (datetime or numpy.datetime64): The reference time.
+
+        Returns:
+        - numpy.datetime64: The next fire time, or NaT if the schedule never fires within 5 years.
+        """
+        start = _to_minute(moment, ceil=False) + np.timedelta64(1, 'm')
+        # Widen the search window until a fire time shows up; most schedules hit in the first day
+        for days in (1, 32, 367, 5 * 366):
+            times = self.occurrences(start, start + np.timedelta64(days, 'D'))
+            if len(times):
+                return times[0]
+        return np.datetime64('NaT', 'm')
+
+    def _croniter_occurrences(self, start, end):
+        import croniter
+        cron = croniter.croniter(self.expression, start.astype(datetime.datetime) - datetime.timedelta(seconds=1))
+        end = end.astype(datetime.datetime)
+        times = []
+        next_time = cron.get_next(datetime.datetime)
+        while next_time < end:
+            times.append(next_time)
+            next_time = cron.get_next(datetime.datetime)
+        return np.array(times, dtype='datetime64[m]')
+
+
+def compile_cron(expression):
+    """
+    Compiles a crontab expression into a CronSchedule.
+
+    Compiled schedules are kept in a process-wide LRU cache keyed by the expression, so
+    jobs sharing the same schedule are only parsed once (see cache_info()).
+
+    Parameters:
+    - expression (str): The crontab expression, e.g. '*/5 * * * *'.
+
+    Returns:
+    - CronSchedule: The compiled schedule.
+    """
+    return _compile_cached(' '.join(expression.split()))
+
+
+def occurrences(expression, start, end):
+    """
+    Generates every fire time of a crontab expression within [start, end).
+
+    The expanded arrays are kept in a process-wide LRU cache keyed by the expression and the
+    window rounded to the minute, so repeated lookups of the same window reuse them. The
+    returned array is shared and therefore read-only; copy it before modifying it.
+
+    Parameters:
+    - expression (str): The crontab expression.
+    - start (datetime or numpy.datetime64): Start of the window (inclusive).
+    - end (datetime or numpy.datetime64): End of the window (exclusive).
+
+    Returns:
+    - numpy array: Sorted, read-only datetime64[m] array of fire times.
+    """
+    return _occurrences_cached(' '.join(expression.split()), _to_minute(start, ceil=True), _to_minute(end, ceil=True))
+
+
+@instrumentation.stage('expand_jobs', occurrences=lambda result: len(result[1]))
+def expand_jobs(schedules, start, end, workers=None):
+    """
+    Generates the fire times of many jobs within [start, end), expanding every distinct expression once.
+
+    The distinct expressions are expanded together with array operations rather than one occurrences()
+    call each, so the occurrence cache is only used for the expressions croniter has to expand.
+
+    Parameters:
+    - schedules (iterable of str): One crontab expression per job, duplicates allowed.
+    - start (datetime or numpy.datetime64): Start of the window (inclusive).
+    - end (datetime or numpy.datetime64): End of the window (exclusive).
+    - workers (int): Number of processes to expand the distinct expressions with. Default is None,
+      which expands them in the current process. The result is identical either way.
+
+    Returns:
+    - tuple: (job_index, times) where job_index is an int64 array holding the position of the job
+      in schedules and times is the datetime64[m] array of its fire times, sorted by job then time.
+    """
+    schedules = list(schedules)
+    distinct = list(dict.fromkeys(schedules))
+    if workers is not None and workers > 1 and len(distinct) > 1:
+        by_schedule = dict(zip(distinct, _expand_parallel(distinct, start, end, workers)))
+        per_job = [by_schedule[schedule] for schedule in schedules]
+        counts = np.array([len(times) for times in per_job], dtype=np.int64)
+        job_index = np.repeat(np.arange(len(schedules), dtype=np.int64), counts)
+        times = np.concatenate(per_job) if per_job else np.empty(0, dtype='datetime64[m]')
+        return job_index, times
+
+    # Expand the distinct expressions together, then gather the fire times of each job from its expression's
+    codes = dict(zip(distinct, range(len(distinct))))
+    code = np.array([codes[schedule] for schedule in schedules], dtype=np.int64)
+    minutes, first, counts = _expand_batch([compile_cron(schedule) for schedule in distinct], start, end)
+    job_index, position = _gather(first[code], counts[code])
+    return job_index, minutes[position].view('datetime64[m]')
+
+
+class OccurrenceTable:
+    """
+    The occurrences of many jobs stored as flat arrays, grouped by job like a CSR matrix.
+
+    The occurrences of job ``j`` are ``starts[offsets[j]:offsets[j + 1]]`` (and the matching ``ends``),
+    and ``job_index`` holds the job of every occurrence. Starts and ends are int64 nanoseconds since
+    the epoch on the wall clock the schedules were expanded in, so they can be viewed as datetime64[ns]
+    without copying. The table takes BYTES_PER_OCCURRENCE bytes per occurrence and BYTES_PER_JOB bytes
+    per job, i.e. about 20 MB per million occurrences; format it to strings only when writing output.
+    """
+
+    def __init__(self, offsets, job_index, starts, ends):
+        self.offsets = offsets
+        self.job_index = job_index
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_schedules(cls, schedules, start, end, runtimes=None, workers=None):
+        """
+        Expands the schedules of many jobs within [start, end) into a table.
+
+        Parameters:
+        - schedules (iterable of str): One crontab expression per job, duplicates allowed.
+        - start (datetime or numpy.datetime64): Start of the window (inclusive).
+        - end (datetime or numpy.datetime64): End of the window (exclusive).
+        - runtimes (array-like of timedelta): The runtime of each job, added to its starts to get its ends.
+          Default is None, which makes every occurrence end when it starts.
+        - workers (int): Number of processes to expand the schedules with (see expand_jobs).
+
+        Returns:
+        - OccurrenceTable: The occurrences of every job, sorted by job then time.
+        """
+        schedules = list(schedules)
+        job_index, times = expand_jobs(schedules, start, end, workers=workers)
+        starts = times.astype('datetime64[ns]').view(np.int64)
+        if runtimes is None:
+            ends = starts
+        else:
+            ends = starts + np.asarray(runtimes, dtype='timedelta64[ns]').view(np.int64)[job_index]
+        offsets = np.zeros(len(schedules) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(job_index, minlength=len(schedules)), out=offsets[1:])
+        return cls(offsets, job_index.astype(np.int32), starts, ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return "OccurrenceTable({} jobs, {} occurrences, {:.1f} MB)".format(self.num_jobs, len(self), self.nbytes / 1e6)
+
+    @property
+    def num_jobs(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        # Starts and ends may share the same array when the jobs have no runtime
+        ends = 0 if self.ends is self.starts else self.ends.nbytes
+        return self.offsets.nbytes + self.job_index.nbytes + self.starts.nbytes + ends
+
+    def counts(self):
+        """
+        Returns the number of occurrences of each job.
+        """
+        return np.diff(self.offsets)
+
+    def job(self, job):
+        """
+        Returns the starts and ends (as datetime64[ns] arrays) of one job.
+        """
+        rows = slice(self.offsets[job], self.offsets[job + 1])
+        return self.starts[rows].view('datetime64[ns]'), self.ends[rows].view('datetime64[ns]')
+
+    def start_times(self):
+        return self.starts.view('datetime64[ns]')
+
+    def end_times(self):
+        return self.ends.view('datetime64[ns]')
+
+    def hours(self):
+        """
+        Returns the hour of the day (0-23) each occurrence starts at.
+        """
+        return (self.starts // (3600 * 10**9)) % 24
+
+    def select(self, mask):
+        """
+        Returns a new table with only the occurrences where mask is True; the jobs are kept.
+        """
+        job_index = self.job_index[mask]
+        offsets = np.zeros_like(self.offsets)
+        np.cumsum(np.bincount(job_index, minlength=self.num_jobs), out=offsets[1:])
+        ends = self.ends[mask] if self.ends is not self.starts else None
+        starts = self.starts[mask]
+        return OccurrenceTable(offsets, job_index, starts, starts if ends is None else ends)
+
+    def to_zone(self, zone):
+        """
+        Returns a new table with the (UTC) occurrences projected onto the wall clock of a time zone.
+
+        The projection only shifts every occurrence by the offset of the zone at that moment
+        (see time_zones.to_local), so one expansion serves any number of time zones.
+        """
+        starts = time_zones.to_local(self.start_times(), zone).view(np.int64)
+        ends = starts if self.ends is self.starts else time_zones.to_local(self.end_times(), zone).view(np.int64)
+        return OccurrenceTable(self.offsets, self.job_index, starts, ends)
+
+
+def cache_info():
+    """
+    Returns the hit/miss statistics of the schedule and occurrence caches.
+
+    Returns:
+    - dict: {'schedules': CacheInfo, 'occurrences': CacheInfo}, each with hits, misses, maxsize and currsize.
+    """
+    return {'schedules': _compile_cached.cache_info(), 'occurrences': _occurrences_cached.cache_info()}
+
+
+def cache_clear():
+    """
+    Empties the schedule and occurrence caches and resets their statistics.
+    """
+    _compile_cached.cache_clear()
+    _occurrences_cached.cache_clear()
+
+
+@functools.lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def _compile_cached(expression):
+    return CronSchedule(expression)
+
+
+@functools.lru_cache(maxsize=OCCURRENCE_CACHE_SIZE)
+def _occurrences_cached(expression, start, end):
+    times = _compile_cached(expression).occurrences(start, end)
+    times.flags.writeable = False
+    return times
+
+
+# Report the hits and misses of both caches per stage when the instrumentation is enabled
+instrumentation.watch_cache('schedules', _compile_cached.cache_info)
+instrumentation.watch_cache('occurrences', _occurrences_cached.cache_info)
+
+
+def next_runs(schedules, moment):
+    """
+    Finds the next fire time after a moment for each schedule, compiling every distinct expression once.
+
+    Parameters:
+    - schedules (iterable of str): Crontab expressions, duplicates allowed.
+    - moment (datetime or numpy.datetime64): The reference time.
+
+    Returns:
+    - numpy array: datetime64[m] array with one next fire time per input schedule.
+    """
+    schedules = list(schedules)
+    next_by_schedule = {schedule: compile_cron(schedule).next_after(moment) for schedule in set(schedules)}
+    return np.array([next_by_schedule[schedule] for schedule in schedules], dtype='datetime64[m]')
+
+
+def _expand_parallel(schedules, start, end, workers):
+    # Shard the expressions over a process pool; executor.map keeps the shards in order
+    start = _to_minute(start, ceil=True)
+    end = _to_minute(end, ceil=True)
+    shards = [list(shard) for shard in np.array_split(np.array(schedules, dtype=object), min(len(schedules), workers * 4))]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_expand_shard, shards, [start] * len(shards), [end] * len(shards)))
+    # Split each shard's packed epoch minutes back into one array per expression
+    expanded = []
+    for minutes, counts in results:
+        expanded.extend(np.split(minutes.view('datetime64[m]'), np.cumsum(counts)[:-1]))
+    return expanded
+
+
+def _expand_shard(schedules, start, end):
+    # Runs in a worker process; results travel back as one int64 array of epoch minutes plus counts
+    per_schedule = [occurrences(schedule, start, end) for schedule in schedules]
+    counts = np.array([len(times) for times in per_schedule], dtype=np.int64)
+    minutes = np.concatenate(per_schedule).astype(np.int64) if per_schedule else np.empty(0, dtype=np.int64)
+    return minutes, counts
+
+
+def _expand_simple(expression):
+    # Expand the fields of an expression like croniter.expand does, or return None when any field is not plain
+    fields = expression.split()
+    if len(fields) != 5:
+        return None
+    expanded = []
+    for index, (field, (low, high)) in enumerate(zip(fields, FIELD_RANGES)):
+        values = set()
+        for item in field.split(','):
+            match = SIMPLE_ITEM.match(item)
+            if match is None:
+                return None
+            star, first, last, step = match.groups()
+            if star:
+                first, last = low, high
+            elif last is None:
+                # croniter reads 'n/step' as a range up to the end of the field; leave it to croniter
+                if step is not None:
+                    return None
+                last = first
+            elif int(first) >= int(last):
+                # So are wrapping ranges and 'n-n', which croniter reads its own way
+                return None
+            first, last, step = int(first), int(last), int(step or 1)
+            # Out of range values (including Sunday written 7) and empty steps are left to croniter to reject or read
+            if first < low or last > high or step == 0:
+                return None
+            values.update(range(first, last + 1, step))
+        # Like croniter, a field with a bare '*' is written '*', and so is a field listing every value unless it is
+        # a day field and the other day field has no '*' (it then keeps its values, so either day field can match)
+        every = '*' in field.split(',') or (len(values) == high - low + 1
+                                            and (index not in (2, 4) or '*' in fields[6 - index]))
+        expanded.append(['*'] if every else sorted(values))
+    return expanded
+
+
+def _expand_batch(schedules, start, end):
+    # Expand many compiled schedules within [start, end) at once, as epoch minutes grouped by schedule:
+    # the fire times of schedule i are minutes[first[i]:first[i] + counts[i]], sorted
+    window = (_to_minute(start, ceil=True), _to_minute(end, ceil=True))
+    start, end = (moment.astype(np.int64) for moment in window)
+    if end <= start or not schedules:
+        empty = np.zeros(len(schedules), dtype=np.int64)
+        return np.empty(0, dtype=np.int64), empty, empty
+
+    days = np.arange(start // MINUTES_PER_DAY, (end - 1) // MINUTES_PER_DAY + 1).astype('datetime64[D]')
+
+    # Fallback schedules have empty masks, so they get no fire times here and are expanded by croniter below
+    def bits(name, size):
+        # One row per field value and one column per schedule, the layout CronSchedule.days_matching expects
+        masks = np.array([getattr(schedule, name) for schedule in schedules], dtype=np.uint64)
+        return ((masks[None, :] >> np.arange(size, dtype=np.uint64)[:, None]) & 1).astype(bool)
+
+    day_or = np.array([schedule.day_or for schedule in schedules], dtype=bool)
+    matching = CronSchedule.days_matching(days, bits('month_mask', 13), bits('day_mask', 32), bits('dow_mask', 7), day_or).T
+
+    # Minutes of the day of each schedule (every hour crossed with every minute), then every matching day
+    # crossed with them; both crossings keep each schedule's values sorted
+    hour_schedule, hour = np.nonzero(bits('hour_mask', 24).T)
+    minute_bits = bits('minute_mask', 60).T
+    minute_schedule, minute = np.nonzero(minute_bits)
+    minute_first = np.concatenate([[0], np.cumsum(minute_bits.sum(axis=1))[:-1]])
+    entry, position = _gather(minute_first[hour_schedule], minute_bits.sum(axis=1)[hour_schedule])
+    of_day = hour[entry] * 60 + minute[position]
+    of_day_counts = np.bincount(hour_schedule[entry], minlength=len(schedules))
+    of_day_first = np.concatenate([[0], np.cumsum(of_day_counts)[:-1]])
+
+    day_schedule, day_index = np.nonzero(matching)
+    entry, position = _gather(of_day_first[day_schedule], of_day_counts[day_schedule])
+    minutes = days.astype(np.int64)[day_index][entry] * MINUTES_PER_DAY + of_day[position]
+    owner = day_schedule[entry]
+    # Only the first and last days can hold fire times outside the window
+    inside = (minutes >= start) & (minutes < end)
+    minutes, owner = minutes[inside], owner[inside]
+    counts = np.bincount(owner, minlength=len(schedules))
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    fallback = [index for index, schedule in enumerate(schedules) if schedule.fallback]
+    if fallback:
+        extra = [_occurrences_cached(schedules[index].expression, *window).astype(np.int64) for index in fallback]
+        first[fallback] = len(minutes) + np.concatenate([[0], np.cumsum([len(times) for times in extra])[:-1]])
+        counts[fallback] = [len(times) for times in extra]
+        minutes = np.concatenate([minutes] + extra)
+    return minutes, first, counts
+
+
+def _gather(first, counts):
+    # For runs of counts[i] consecutive positions starting at first[i], return the run of every position and
+    # the position itself, run after run
+    total = counts.sum()
+    run = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    offsets = np.cumsum(counts) - counts
+    return run, first[run] + np.arange(total, dtype=np.int64) - offsets[run]
+
+
+def _bits(mask, size):
+    # Unpack an integer bitmask into a boolean lookup array indexed by field value
+    return np.array([(mask >> value) & 1 for value in range(size)], dtype=bool)
+
+
+def _to_minute(moment, ceil):
+    # Normalise datetimes (naive or aware, wall clock kept) and datetime64 values to minute resolution
+    if isinstance(moment, datetime.datetime) and moment.tzinfo is not None:
+        moment = moment.replace(tzinfo=None)
+    moment = np.datetime64(moment, 'us')
+    minute = moment.astype('datetime64[m]')
+    if ceil and minute < moment:
+        minute += np.timedelta64(1, 'm')
+    return minute
@@ -0,0 +1,243 @@
+import datetime
+import numpy as np
+import cron_occurrences
+import data_preprocessor
+import instrumentation
+import load_profile
+import time_zones
+
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# Number of weeks expanded to build a load histogram; each minute of the week keeps its peak over these weeks
+HISTOGRAM_WEEKS = 4
+
+# Number of candidate schedules returned for each runtime
+TOP_K = 10
+
+# Masks of the fields of a schedule that fires every day of every month
+ALL_DAYS = (1 << cron_occurrences.FIELD_SIZES[2]) - 1
+ALL_MONTHS = (1 << cron_occurrences.FIELD_SIZES[3]) - 1
+
+# Columns of the placement results
+PLACEMENT_COLUMNS = ["average_runtime", "crontab_schedule", "crontab_schedule_localTime", "num_runs", "num_unassigned",
+                     "peak_load", "mean_load", "overlap"]
+
+
+def load_histogram(tasks, start_time=None, weeks=HISTOGRAM_WEEKS, percentile=None):
+    """
+    Counts how many of the tasks are running during each minute of the week.
+
+    Parameters:
+    - tasks (pandas DataFrame): The tasks, with 'schedule' and 'avg_runtime' columns.
+    - start_time (datetime): Any moment of the first week expanded. Default is now.
+    - weeks (int): Number of weeks expanded. Default is HISTOGRAM_WEEKS.
+    - percentile (float): Make every run last this percentile of the task's runtimes instead of its average runtime
+      (see data_preprocessor.get_runtimes). Default is None, the average.
+
+    Returns:
+    - numpy array: int64 array of MINUTES_PER_WEEK values; minute 0 is Monday 00:00.
+    """
+    return load_histograms(tasks, [None], start_time, weeks, percentile)[0]
+
+
+@instrumentation.stage('load_histograms', rows=len)
+def load_histograms(tasks, subsets, start_time=None, weeks=HISTOGRAM_WEEKS, percentile=None):
+    """
+    Counts how many tasks of each subset are running during each minute of the week, compiling every schedule once.
+
+    The schedules firing every day of every month repeat every week, so their runs are laid on a single week from the
+    masks of their minutes, hours and days of the week, wrapping around its end. The other schedules are expanded over
+    the given number of weeks. Every run is added to a difference array (+1 on its first minute, -1 after its last
+    one) whose cumulative sum is the number of running tasks per minute; the weeks are then folded into one, keeping
+    the peak of each minute of the week.
+
+    Parameters:
+    - tasks (pandas DataFrame): The tasks, with 'schedule' and 'avg_runtime' columns.
+    - subsets (list): Boolean arrays selecting the tasks of each histogram, or None for all the tasks.
+    - start_time (datetime): Any moment of the first week expanded. Default is now.
+    - weeks (int): Number of weeks expanded. Default is HISTOGRAM_WEEKS.
+    - percentile (float): Runtime percentile of the runs (see load_histogram). Default is None, the average.
+
+    Returns:
+    - numpy array: int64 array of shape (len(subsets), MINUTES_PER_WEEK); minute 0 is Monday 00:00.
+    """
+    import pandas as pd
+
+    if start_time is None:
+        start_time = time_zones.utc_now()
+    # Start on the Monday of the week, so minute n of the histogram is minute n of every week
+    day = np.datetime64(start_time, 'D')
+    window_start = (day - (day.astype(np.int64) - 4) % 7).astype('datetime64[m]')
+    window_end = window_start + weeks * MINUTES_PER_WEEK
+
+    members = np.array([np.ones(len(tasks), dtype=bool) if subset is None else np.asarray(subset, dtype=bool)
+                        for subset in subsets]).reshape(len(subsets), len(tasks))
+    runtimes = data_preprocessor.get_runtimes(tasks, percentile).to_numpy('timedelta64[s]').astype(np.int64)
+    lengths = np.minimum(np.maximum(-(-runtimes // 60), 1), MINUTES_PER_WEEK)
+    codes, schedules = pd.factorize(tasks['schedule'])
+    compiled = [cron_occurrences.compile_cron(schedule) for schedule in schedules]
+    weekly = np.array([is_weekly(schedule) for schedule in compiled], dtype=bool)[codes] if len(tasks) else np.zeros(0, dtype=bool)
+
+    # Weekly tasks: the runs of each distinct (schedule, length) pair are laid once, weighted by its number of tasks
+    pairs, pair_of_task = np.unique(np.stack([codes[weekly], lengths[weekly]], axis=1), axis=0, return_inverse=True)
+    pair_of_task = pair_of_task.ravel()
+    weights = np.array([np.bincount(pair_of_task, weights=member[weekly], minlength=len(pairs)) for member in members])
+    fires_of_code = {code: week_fires(mask_values(compiled[code].minute_mask, 60), mask_values(compiled[code].hour_mask, 24),
+                                      mask_values(compiled[code].dow_mask, 7)) for code in np.unique(pairs[:, 0])}
+    fires = [fires_of_code[code] for code in pairs[:, 0]]
+    counts = np.array([len(times) for times in fires], dtype=np.int64)
+    pair_of_run = np.repeat(np.arange(len(pairs)), counts)
+    starts = np.concatenate(fires) if fires else np.empty(0, dtype=np.int64)
+    ends = starts + pairs[pair_of_run, 1] if len(pairs) else starts
+    size = 2 * MINUTES_PER_WEEK + 1
+    week = np.zeros((len(subsets), MINUTES_PER_WEEK), dtype=np.int64)
+    for row, pair_weights in enumerate(weights):
+        diff = (np.bincount(starts, weights=pair_weights[pair_of_run], minlength=size)
+                - np.bincount(ends, weights=pair_weights[pair_of_run], minlength=size))
+        running = np.cumsum(diff).round().astype(np.int64)
+        # Runs going past the end of the week continue at its start
+        week[row] = running[:MINUTES_PER_WEEK] + running[MINUTES_PER_WEEK:2 * MINUTES_PER_WEEK]
+
+    # Other tasks: expanded once over all the weeks, each run counted in every subset of its task
+    others = np.flatnonzero(~weekly)
+    origin, total, job_index, starts, minutes = load_profile.expand_runs(
+        tasks.iloc[others], window_start.astype(datetime.datetime), window_end.astype(datetime.datetime), percentile=percentile)
+    in_subset = members[:, others][:, job_index]
+    rows, runs = np.nonzero(in_subset)
+    running = load_profile.running_counts(starts[runs], minutes[runs], rows, len(subsets), total)
+    return (running.reshape(len(subsets), weeks, MINUTES_PER_WEEK) + week[:, None, :]).max(axis=1)
+
+
+def is_weekly(schedule):
+    """
+    Tells whether a compiled schedule fires every day of every month, so it repeats every week.
+    """
+    return not schedule.fallback and schedule.day_mask == ALL_DAYS and schedule.month_mask == ALL_MONTHS
+
+
+def mask_values(mask, size):
+    """
+    Returns the values allowed by a field mask of a compiled schedule, as a sorted int64 array.
+    """
+    return np.flatnonzero(cron_occurrences._bits(mask, size))
+
+
+def week_fires(minutes, hours, days):
+    """
+    Returns the minutes of the week a weekly schedule fires at, from the values of its minute, hour and day of the
+    week fields; cron counts the days of the week from Sunday, the histograms from Monday.
+    """
+    weekdays = (days - 1) % 7
+    return (weekdays[:, None, None] * MINUTES_PER_DAY + hours[None, :, None] * 60 + minutes[None, None, :]).ravel()
+
+
+def candidate_hours(max_runs_per_day, min_hours_gap):
+    """
+    Lists the sets of hours a daily schedule can run at: 1 to max_runs_per_day hours evenly spaced by at least
+    min_hours_gap, including the gap across midnight.
+
+    Returns:
+    - tuple: (hours, num_runs, min_gaps) where hours is an int64 array of shape (patterns, max_runs_per_day) holding
+      the sorted hours of each pattern (padded by repeating its first hour), num_runs the number of hours of each
+      pattern and min_gaps its smallest gap in hours.
+    """
+    patterns = {}
+    for num_runs in range(1, max_runs_per_day + 1):
+        steps = [24] if num_runs == 1 else range(max(min_hours_gap, 1), 24)
+        for step in steps:
+            # The last run of the day must also leave min_hours_gap before the first run of the next day
+            if num_runs > 1 and 24 - (num_runs - 1) * step < max(min_hours_gap, 1):
+                continue
+            for first in range(24):
+                hours = tuple(sorted((first + i * step) % 24 for i in range(num_runs)))
+                gaps = np.diff(hours + (hours[0] + 24,))
+                patterns.setdefault(hours, int(gaps.min()))
+    hours = np.array([pattern + (pattern[0],) * (max_runs_per_day - len(pattern)) for pattern in patterns], dtype=np.int64)
+    num_runs = np.array([len(pattern) for pattern in patterns], dtype=np.int64)
+    min_gaps = np.array(list(patterns.values()), dtype=np.int64)
+    return hours.reshape(len(patterns), max_runs_per_day), num_runs, min_gaps
+
+
+@instrumentation.stage('place_job', rows=len)
+def place_job(load, priority_load, runtimes, max_runs_per_day, min_hours_gap, time_zone, top_k=TOP_K):
+    """
+    Finds the best daily crontab schedules for a new job of each given runtime.
+
+    Every minute of the hour combined with every set of hours from candidate_hours is a candidate schedule. Each
+    candidate is scored against the load histograms by the peak number of tasks running during its runs, the
+    number of priority runs in progress when its runs start (added up over a week) and the mean load during its
+    runs. The scores of all candidates and all runtimes are computed with array operations
+    on per-minute-of-day tables, so each runtime costs a few passes over the candidates.
+
+    Parameters:
+    - load (numpy array): Load histogram of all the tasks, from load_histogram.
+    - priority_load (numpy array): Load histogram of the priority tasks, from load_histogram.
+    - runtimes (iterable of int): The average runtimes of the job, in minutes.
+    - max_runs_per_day (int): The maximum number of times the job can run per day.
+    - min_hours_gap (int): The minimum number of hours gap between each run.
+    - time_zone: The local time zone (see time_zones.get_zone); its current offset gives the local schedules.
+    - top_k (int): Number of schedules returned for each runtime. Default is TOP_K.
+
+    Returns:
+    - A pandas DataFrame with the top_k schedules of each runtime, best first, ranked by number of unassigned runs,
+      then peak load, then overlap, then mean load.
+    """
+    import pandas as pd
+
+    hours, num_runs, min_gaps = candidate_hours(max_runs_per_day, min_hours_gap)
+    # Candidates are (pattern, minute) pairs, and each run starts at a minute of the day
+    starts = (hours[:, None, :] * 60 + np.arange(60)[None, :, None]).reshape(-1, max_runs_per_day)
+    num_runs = np.repeat(num_runs, 60)
+    min_gaps = np.repeat(min_gaps, 60)
+    real_run = np.arange(max_runs_per_day)[None, :] < num_runs[:, None]
+
+    load = np.asarray(load, dtype=np.int64)
+    # Priority runs in progress at each minute of the day, added up over the week
+    overlap = np.where(real_run, np.asarray(priority_load, dtype=np.int64).reshape(7, MINUTES_PER_DAY).sum(axis=0)[starts], 0).sum(axis=1)
+    # Running maximum and sum of the load over the minutes a run lasts, grown one minute at a time; the week wraps around
+    window_max = load.copy()
+    window_sum = load.copy()
+    grown = 1
+
+    results = []
+    for runtime in sorted(set(int(runtime) for runtime in runtimes)):
+        length = max(runtime, 1)
+        while grown < length:
+            shifted = np.roll(load, -grown)
+            window_max = np.maximum(window_max, shifted)
+            window_sum = window_sum + shifted
+            grown += 1
+        # Fold the week into a day: a daily run is as loaded as its worst day
+        peak_of_day = window_max.reshape(7, MINUTES_PER_DAY).max(axis=0)
+        sum_of_day = window_sum.reshape(7, MINUTES_PER_DAY).sum(axis=0)
+        peak = peak_of_day[starts].max(axis=1)
+        mean = np.where(real_run, sum_of_day[starts], 0).sum(axis=1) / (7 * length * num_runs)
+
+        # Runs of the job must not overlap each other, and the ranking keys go from least to most significant
+        valid = np.flatnonzero(min_gaps * 60 >= length)
+        order = np.lexsort((mean[valid], overlap[valid], peak[valid], -num_runs[valid]))
+        best = valid[order[:top_k]]
+        for candidate in best:
+            results.append({
+                "average_runtime": runtime,
+                "crontab_schedule": _daily_crontab(starts[candidate, :num_runs[candidate]]),
+                "crontab_schedule_localTime": _daily_crontab(starts[candidate, :num_runs[candidate]], time_zone),
+                "num_runs": int(num_runs[candidate]),
+                "num_unassigned": int(max_runs_per_day - num_runs[candidate]),
+                "peak_load": int(peak[candidate]),
+                "mean_load": float(mean[candidate]),
+                "overlap": int(overlap[candidate]),
+            })
+
+    return pd.DataFrame(results, columns=PLACEMENT_COLUMNS)
+
+
+def _daily_crontab(starts, time_zone=None):
+    # Crontab running every day at the given minutes of the day, shifted to the current local time if a time zone is given
+    if time_zone is not None:
+        offset = time_zones.utc_offset(time_zone, time_zones.utc_now())
+        starts = (starts + int(offset.total_seconds() // 60)) % MINUTES_PER_DAY
+    hours = sorted(int(start) // 60 for start in starts)
+    return "{} {} * * *".format(int(starts[0]) % 60, ",".join(str(hour) for hour in hours))
@@ -0,0 +1,230 @@
+import functools
+import numpy as np
+import cron_occurrences
+import cron_placement
+import instrumentation
+import time_zones
+
+
+MINUTES_PER_DAY = cron_placement.MINUTES_PER_DAY
+MINUTES_PER_WEEK = cron_placement.MINUTES_PER_WEEK
+
+# Priority of the jobs the rescheduler may move; jobs with any other priority keep their schedule
+MOVABLE_PRIORITY = 5
+
+# Maximum number of passes over the movable jobs; the search stops earlier once a pass lowers the peak of no category
+PASSES = 2
+
+# Maximum number of distinct minute and hour fields whose rotations are kept in memory
+ROTATION_CACHE_SIZE = 4096
+
+# Columns of the diff of the moved jobs
+DIFF_COLUMNS = ['job_name', 'category', 'old_schedule', 'new_schedule', 'old_peak', 'new_peak']
+
+@instrumentation.stage('reschedule', rows=lambda result: len(result[0]))
+def reschedule(cron_data, passes=PASSES, start_time=None):
+    """
+    Moves the jobs of priority 5 to flatten the peaks of concurrent jobs of each category.
+
+    Every job keeps its period: only the minutes and hours it runs at are rotated (e.g. '10 6-23/2 * * *' can
+    become '25 0,8,10,12,14,16,18,20,22 * * *' and keeps running 9 times a day, 2 hours apart), and its days are kept. The
+    load of each category is a minute-of-week histogram of the running jobs (minute 0 is Monday 00:00, in UTC).
+    The movable jobs are visited largest first (fires per week times runtime): each is taken out of the histogram
+    of its category, every rotation of its schedule is scored against the rest of the load at once (the highest
+    and the total number of jobs running during its runs) and it is put back at the best one. Passes are repeated
+    while they lower the peak of some category.
+
+    Only schedules firing every day of every month (any days of the week) can be moved; the others, and the jobs
+    of priority other than 5, are fixed. Fixed jobs that do not repeat every week are counted with the peak of
+    each minute of the week over cron_placement.HISTOGRAM_WEEKS weeks from start_time.
+
+    Parameters:
+    - cron_data (pandas DataFrame): The job table, with 'job_name', 'schedule', 'avg_runtime', 'category' and
+      'priority' columns.
+    - passes (int): Maximum number of passes over the movable jobs. Default is PASSES.
+    - start_time (datetime): Start of the weeks the fixed jobs that do not repeat every week are expanded over.
+      Default is now.
+
+    Returns:
+    - tuple: (diff, peaks) where diff is a pandas DataFrame with the old and new schedule of every moved job and
+      the highest number of jobs of its category running with it before and after, and peaks a pandas DataFrame
+      with the peak number of concurrent jobs of each category before and after.
+    """
+    import pandas as pd
+
+    runtimes = pd.to_timedelta(cron_data['avg_runtime']).fillna(pd.Timedelta(0)).to_numpy('timedelta64[s]').astype(np.int64)
+    lengths = np.minimum(np.maximum(-(-runtimes // 60), 1), MINUTES_PER_WEEK)
+    codes, categories = pd.factorize(cron_data['category'], sort=True)
+    schedules = cron_data['schedule'].to_numpy()
+    priorities = cron_data['priority'].to_numpy()
+    names = cron_data['job_name'].to_numpy()
+
+    # Split the jobs into weekly ones, which are counted from their masks, and the others
+    compiled = [cron_occurrences.compile_cron(schedule) for schedule in schedules]
+    weekly = np.array([cron_placement.is_weekly(schedule) for schedule in compiled], dtype=bool)
+    load = np.zeros((len(categories), MINUTES_PER_WEEK), dtype=np.int64)
+    others = np.flatnonzero(~weekly)
+    if len(others):
+        load += cron_placement.load_histograms(cron_data.iloc[others], [codes[others] == code for code in range(len(categories))],
+                                               start_time)
+
+    placements = {}
+    for job in np.flatnonzero(weekly):
+        schedule = compiled[job]
+        placement = (cron_placement.mask_values(schedule.minute_mask, 60), cron_placement.mask_values(schedule.hour_mask, 24),
+                     cron_placement.mask_values(schedule.dow_mask, 7))
+        placements[job] = placement
+        load[codes[job]] += _coverage(cron_placement.week_fires(*placement), lengths[job])
+    before = load.max(axis=1)
+
+    movable = np.flatnonzero(weekly & (priorities == MOVABLE_PRIORITY))
+    impact = np.array([len(cron_placement.week_fires(*placements[job])) * lengths[job] for job in movable], dtype=np.int64)
+    order = movable[np.argsort(-impact, kind='stable')]
+    old_peaks = {}
+    peaks_before = before
+    for _ in range(passes):
+        moved = 0
+        for job in order:
+            minutes, hours, days = placements[job]
+            coverage = _coverage(cron_placement.week_fires(minutes, hours, days), lengths[job])
+            (new_minutes, new_hours), peak, old_peak = _best_rotation(load[codes[job]] - coverage, minutes, hours,
+                                                                      days, lengths[job])
+            old_peaks.setdefault(job, old_peak)
+            if np.array_equal(new_minutes, minutes) and np.array_equal(new_hours, hours):
+                continue
+            # Only the histogram of the job's category changes, by the difference of its two placements
+            moved += 1
+            placements[job] = (new_minutes, new_hours, days)
+            load[codes[job]] += _coverage(cron_placement.week_fires(new_minutes, new_hours, days), lengths[job]) - coverage
+        peaks_after = load.max(axis=1)
+        if not moved or not (peaks_after < peaks_before).any():
+            break
+        peaks_before = peaks_after
+
+    rows = []
+    for job in movable:
+        minutes, hours, days = placements[job]
+        new_schedule = _crontab(minutes, hours, days)
+        original = compiled[job]
+        if (np.array_equal(minutes, cron_placement.mask_values(original.minute_mask, 60))
+                and np.array_equal(hours, cron_placement.mask_values(original.hour_mask, 24))):
+            continue
+        rest = load[codes[job]] - _coverage(cron_placement.week_fires(minutes, hours, days), lengths[job])
+        new_peak = int(_window_max(rest, lengths[job])[cron_placement.week_fires(minutes, hours, days)].max()) + 1
+        rows.append([names[job], categories[codes[job]], schedules[job], new_schedule, old_peaks[job], new_peak])
+    diff = pd.DataFrame(rows, columns=DIFF_COLUMNS)
+    peaks = pd.DataFrame({'category': list(categories), 'peak_before': before,
+                          'peak_after': load.max(axis=1)})
+    return diff, peaks
+
+
+def apply_diff(cron_data, diff):
+    """
+    Returns a copy of the job table with the schedules of the moved jobs replaced by their new ones.
+    """
+    new_schedules = dict(zip(diff['job_name'], diff['new_schedule']))
+    cron_data = cron_data.copy()
+    cron_data['schedule'] = [new_schedules.get(name, schedule) for name, schedule in zip(cron_data['job_name'], cron_data['schedule'])]
+    return cron_data
+
+
+def _coverage(fires, length):
+    # Number of runs in progress during each minute of the week, for runs of length minutes wrapping around the week
+    if len(fires) * length < MINUTES_PER_WEEK:
+        # Few short runs: count their minutes directly rather than summing a difference array
+        return np.bincount(((fires[:, None] + np.arange(length)) % MINUTES_PER_WEEK).ravel(), minlength=MINUTES_PER_WEEK)
+    diff = (np.bincount(fires, minlength=MINUTES_PER_WEEK + length + 1)
+            - np.bincount(fires + length, minlength=MINUTES_PER_WEEK + length + 1))
+    running = np.cumsum(diff)
+    covered = running[:MINUTES_PER_WEEK].copy()
+    covered[:length] += running[MINUTES_PER_WEEK:MINUTES_PER_WEEK + length]
+    return covered
+
+
+def _window_max(load, length):
+    # Highest load during the length minutes starting at each minute of the week, with doubling windows
+    extended = np.concatenate([load, load[:length - 1]])
+    window, size = extended, 1
+    while size * 2 <= length:
+        window = np.maximum(window[:-size], window[size:])
+        size *= 2
+    return np.maximum(window[:MINUTES_PER_WEEK], window[length - size:length - size + MINUTES_PER_WEEK])
+
+
+def _window_sum(load, length):
+    sums = np.cumsum(np.concatenate([[0], load, load[:length - 1]]))
+    return sums[length:length + MINUTES_PER_WEEK] - sums[:MINUTES_PER_WEEK]
+
+
+def _rotations(values, size):
+    # Every distinct rotation of a set of field values, the unrotated one first
+    return _rotations_cached(tuple(int(value) for value in values), size)
+
+
+@functools.lru_cache(maxsize=ROTATION_CACHE_SIZE)
+def _rotations_cached(values, size):
+    rotated = np.sort((np.array(values)[None, :] + np.arange(size)[:, None]) % size, axis=1)
+    _, first = np.unique(rotated, axis=0, return_index=True)
+    rotated = rotated[np.sort(first)]
+    rotated.flags.writeable = False
+    return rotated
+
+
+def _best_rotation(rest, minutes, hours, days, length):
+    # Score every rotation of the minutes and hours against the rest of the load; keep the current one unless
+    # another one has a lower peak, or the same peak and a lower total
+    minute_sets = _rotations(minutes, 60)
+    hour_sets = _rotations(hours, 24)
+    weekdays = (days - 1) % 7
+    # The runs of a rotation are every (day, hour, minute) of its sets, so the days, then the hours, then the
+    # minutes can be reduced one after the other instead of looking up every run of every rotation
+    window_max = _window_max(rest, length).reshape(7, 24, 60)[weekdays].max(axis=0)
+    window_sum = _window_sum(rest, length).reshape(7, 24, 60)[weekdays].sum(axis=0)
+    peaks = window_max[hour_sets].max(axis=1)[:, minute_sets].max(axis=2).T
+    totals = window_sum[hour_sets].sum(axis=1)[:, minute_sets].sum(axis=2).T
+    peaks, totals = peaks.ravel(), totals.ravel()
+    # lexsort sorts by the last key first; the stable order keeps the current rotation (index 0) on ties
+    best = np.lexsort((totals, peaks))[0]
+    if (peaks[best], totals[best]) >= (peaks[0], totals[0]):
+        best = 0
+    return ((minute_sets[best // len(hour_sets)], hour_sets[best % len(hour_sets)]),
+            int(peaks[best]) + 1, int(peaks[0]) + 1)
+
+
+def _crontab(minutes, hours, days):
+    return "{} {} * * {}".format(_field(minutes, 60), _field(hours, 24), _field(days, 7))
+
+
+def _field(values, size):
+    # Write a field as '*', a stepped range ('*/15', '5-59/15') or a list of values
+    if len(values) == size:
+        return '*'
+    if len(values) > 1:
+        step = int(values[1] - values[0])
+        if np.all(np.diff(values) == step) and values[0] < step and values[-1] + step >= size:
+            return "*/{}".format(step) if values[0] == 0 else "{}-{}/{}".format(values[0], size - 1, step)
+    return ",".join(str(value) for value in values)
+
+
+def main(argv=None):
+    import argparse
+    import data_preprocessor
+
+    parser = argparse.ArgumentParser(description='Move the jobs of priority 5 to flatten the peaks of concurrent jobs.')
+    parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+    parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+    parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+    parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+    parser.add_argument('--passes', type=int, default=PASSES, help='maximum number of passes (default {})'.format(PASSES))
+    parser.add_argument('--output', default='reschedule_diff.csv', help='csv file the old and new schedules are written to')
+    args = parser.parse_args(argv)
+
+    cron_data = data_preprocessor.load_data(args.functions, args.dags, args.priority, table_path=args.table)
+    diff, peaks = reschedule(cron_data, args.passes, time_zones.utc_now())
+    diff.to_csv(args.output, index=False)
+    print(peaks.to_string(index=False))
+    print("{} jobs moved, written to {}".format(len(diff), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
-import pandas as pd
-import croniter
+import numpy as np
 import datetime
-import pytz
-import re
-import data_preprocessor
+import cron_occurrences
+import instrumentation
+import schedule_index
+import schedule_intervals
+import time_zones
 
 def get_task_datetimes(cron_schedule, start_date, end_date, time_interval, time_zone):
     """
@@ -17,152 +18,338 @@ def get_task_datetimes(cron_schedule, start_date, end_date, time_interval, time_
         format 'YYYY-MM-DD'.
     - time_interval (tuple): Time interval for the datetimes, in the format (start_hour, end_hour).
         Both start_hour and end_hour should be integers between 0 and 23.
-    - time_zone (str): Time zone of the datetimes.
+    - time_zone: Time zone of the dates, time interval and datetimes: an IANA name (e.g. 'Europe/Berlin'),
+        an offset or a tzinfo object (see time_zones.get_zone). The cron schedule itself runs in UTC.
     
     Returns:
     - list: List of datetime objects for the task.
     """
+    # Expand every run after the start date up to and including the end date in one batched call, in UTC,
+    # and move the runs to the wall clock of the time zone
+    window_start, window_end = _window(start_date, end_date, time_zone)
+    times = time_zones.to_local(cron_occurrences.occurrences(cron_schedule, window_start, window_end), time_zone)
+
+    # Keep the datetimes within the specified time interval and format them
+    datetimes = _format_datetimes(times[_in_time_interval(_hours(times), time_interval)])
+
+    # Return the list of datetimes, or None if the list is empty
+    return datetimes if datetimes else None
+
+
+@instrumentation.stage('get_task_occurrences', occurrences=len)
+def get_task_occurrences(df, start_date, end_date, time_interval, time_zone, workers=None):
+    """
+    Generate the runs of every task in a dataframe within a specified time interval and date range.
+
+    Parameters:
+    - df (pandas DataFrame): The tasks, with a 'schedule' column.
+    - start_date, end_date, time_interval, time_zone: Same as for get_task_datetimes.
+    - workers (int): Number of processes to expand the schedules with. Default is None, which
+        expands them in the current process. The result is the same either way.
+
+    Returns:
+    - cron_occurrences.OccurrenceTable: The runs of every task (in the order of df), as int64 arrays
+        on the wall clock of the time zone.
+    """
+    # Expand the runs of all the tasks at once in UTC; each distinct schedule is only expanded once
+    window_start, window_end = _window(start_date, end_date, time_zone)
+    table = cron_occurrences.OccurrenceTable.from_schedules(df['schedule'], window_start, window_end, workers=workers).to_zone(time_zone)
+
+    # Keep the runs within the specified time interval
+    return table.select(_in_time_interval(table.hours(), time_interval))
+
+
+def get_all_task_datetimes(df, start_date, end_date, time_interval, time_zone, workers=None):
+    """
+    Generate the formatted datetimes of every task in a dataframe within a specified time interval and date range.
+
+    Parameters:
+    - df (pandas DataFrame): The tasks, with 'job_name' and 'schedule' columns.
+    - start_date, end_date, time_interval, time_zone, workers: Same as for get_task_occurrences.
+
+    Returns:
+    - pandas DataFrame: The 'job_name' and list of 'datetimes' of every task that runs at least once.
+    """
+    table = get_task_occurrences(df, start_date, end_date, time_interval, time_zone, workers=workers)
+    return format_task_datetimes(df['job_name'], table)
+
+
+def get_running_jobs(df, start_date, end_date, time_interval, time_zone, index_path=schedule_index.INDEX_PATH):
+    """
+    Find the names of the tasks that run at least once within a specified time interval and date range, without
+    expanding their schedules.
+
+    The answer comes from the inverted index of schedule_index, which is read from index_path when it was built
+    from the same job names and schedules, and rebuilt (and written back) otherwise.
+
+    Parameters:
+    - df (pandas DataFrame): The tasks, with 'job_name' and 'schedule' columns.
+    - start_date, end_date, time_interval, time_zone: Same as for get_task_datetimes.
+    - index_path (str): File the index is persisted to, or None to build it in memory. Default is schedule_index.INDEX_PATH.
+
+    Returns:
+    - numpy array: The names of the tasks, in the order of df.
+    """
+    index = schedule_index.load_index(df, index_path)
+    return index.job_names_of(index.query(start_date, end_date, time_interval, time_zone))
+
+
+def lookup_batch(df, queries, workers=None):
+    """
+    Answer many time interval queries at once, expanding the schedules only once for overlapping date ranges.
+
+    The schedules are expanded in UTC over each group of overlapping date ranges, and projected once onto the
+    wall clock of every time zone queried, so queries in many time zones cost one expansion plus array shifts.
+
+    Parameters:
+    - df (pandas DataFrame): The tasks, with a 'schedule' column.
+    - queries (list of dict): Each query has the keys 'time_interval', 'time_zone', 'start_date' and
+        'end_date', with the same meaning as the arguments of get_task_datetimes.
+    - workers (int): Number of processes to expand the schedules with. Default is None.
+
+    Returns:
+    - list of cron_occurrences.OccurrenceTable: The runs of every task for each query, on the wall clock of its time zone.
+    """
+    if not queries:
+        return []
+    # The UTC date range of every query, merged into groups of overlapping ranges that are expanded once each
+    windows = np.array([[np.datetime64(moment, 'us') for moment in _window(query['start_date'], query['end_date'], query['time_zone'])]
+                        for query in queries])
+    group_starts, group_ends = schedule_intervals.merge_intervals(windows[:, 0], windows[:, 1])
+    groups = np.searchsorted(group_starts, windows[:, 0], side='right') - 1
+
+    results = [None] * len(queries)
+    for group, (group_start, group_end) in enumerate(zip(group_starts, group_ends)):
+        table = cron_occurrences.OccurrenceTable.from_schedules(df['schedule'], group_start, group_end, workers=workers)
+        # Project the runs onto each time zone once, however many queries use it
+        zones = {}
+        for number in np.flatnonzero(groups == group):
+            query = queries[number]
+            name = time_zones.zone_name(query['time_zone'])
+            if name not in zones:
+                local = table.to_zone(query['time_zone'])
+                zones[name] = (local, local.hours())
+            local, hours = zones[name]
+            window_start, window_end = windows[number].astype('datetime64[ns]').view(np.int64)
+            in_range = (table.starts >= window_start) & (table.starts < window_end)
+            results[number] = local.select(in_range & _in_time_interval(hours, query['time_interval']))
+    return results
+
+
+def format_task_datetimes(job_names, table):
+    """
+    Format the runs of a table as lists of 'YYYY-MM-DD HH:MM' strings, one row per task that runs at least once.
+
+    Returns:
+    - pandas DataFrame: The 'job_name' and list of 'datetimes' of every task that runs at least once.
+    """
+    import pandas as pd
+
+    jobs = np.flatnonzero(table.counts())
+    datetimes = np.split(np.array(_format_datetimes(table.start_times()), dtype=object), table.offsets[jobs[1:]]) if len(jobs) else []
+    return pd.DataFrame({'job_name': np.asarray(job_names, dtype=object)[jobs], 'datetimes': [list(dts) for dts in datetimes]})
+
+
+def format_batch(job_names, queries, tables):
+    """
+    Format the results of lookup_batch as one combined dataframe.
+
+    Returns:
+    - pandas DataFrame: One row per query and task that runs at least once, with the 'query' number,
+        its 'start_hour', 'end_hour', 'time_zone', 'start_date' and 'end_date', the 'job_name' and the
+        list of 'datetimes'.
+    """
+    import pandas as pd
+
+    results = []
+    for number, (query, table) in enumerate(zip(queries, tables)):
+        result = format_task_datetimes(job_names, table)
+        result.insert(0, 'query', number)
+        result.insert(1, 'start_hour', query['time_interval'][0])
+        result.insert(2, 'end_hour', query['time_interval'][1])
+        result.insert(3, 'time_zone', time_zones.zone_name(query['time_zone']))
+        result.insert(4, 'start_date', str(query['start_date']))
+        result.insert(5, 'end_date', str(query['end_date']))
+        results.append(result)
+    if not results:
+        return pd.DataFrame(columns=['query', 'start_hour', 'end_hour', 'time_zone', 'start_date', 'end_date', 'job_name', 'datetimes'])
+    return pd.concat(results, ignore_index=True)
+
+
+def parse_offset(offset):
+    """
+    Convert a time zone given as an offset from UTC in the format '±H:M', an IANA name such as 'Europe/Berlin'
+    (or an empty string for UTC) to a time zone object.
+    """
+    return time_zones.get_zone(offset)
+
+
+def parse_start_date(start_date_input, time_zone=None):
+    """
+    Convert a start date in the format YYYY-MM-DD (or "now", on the wall clock of time_zone, UTC by default) to a datetime.
+    """
+    import pandas as pd
+
+    if start_date_input == 'now':
+        # Use the current date and time if the user inputs "now"; the dates are on the wall clock of the time zone
+        now = time_zones.utc_now()
+        return now + time_zones.utc_offset(time_zone, now)
+    # Parse the input date and time
+    return pd.to_datetime(start_date_input).to_pydatetime()
+
+
+def parse_end_date(end_date_input, start_date):
+    """
+    Convert an end date in the format YYYY-MM-DD (or a time delta in the format +Xd after start_date) to a datetime.
+    """
+    import pandas as pd
+
+    if end_date_input.startswith('+'):
+        # Parse the time delta if the input is in the form "+Xd"
+        days = int(end_date_input[1:-1])
+        return start_date + datetime.timedelta(days=days)
+    # Parse the input date and time
+    return pd.to_datetime(end_date_input).to_pydatetime()
+
+
+def read_queries(args):
+    """
+    Build the list of queries of a batch invocation, from a JSON file and/or from the command line options.
+
+    The JSON file holds a list of objects with the keys "time_interval" ([start_hour, end_hour]),
+    "time_zone" (IANA name or "±H:M", optional), "start" (YYYY-MM-DD or "now") and "end" (YYYY-MM-DD or "+Xd").
+    On the command line, every --interval is combined with every --time-zone for the --start/--end date range.
+    """
+    import json
+
+    specs = []
+    if args.queries:
+        with open(args.queries) as f:
+            specs.extend(json.load(f))
+    for start_hour, end_hour in args.interval or []:
+        for offset in args.time_zone or ['']:
+            specs.append({'time_interval': [start_hour, end_hour], 'time_zone': offset, 'start': args.start, 'end': args.end})
+
+    queries = []
+    for spec in specs:
+        time_zone = parse_offset(spec.get('time_zone', ''))
+        start_date = parse_start_date(spec.get('start', 'now'), time_zone)
+        queries.append({
+            'time_interval': tuple(spec['time_interval']),
+            'time_zone': time_zone,
+            'start_date': start_date,
+            'end_date': parse_end_date(spec.get('end', '+1d'), start_date),
+        })
+    return queries
+
+
+def _window(start_date, end_date, time_zone):
     # Convert start_date and end_date to datetime objects
     if isinstance(start_date, str):
-        start_date = datetime.fromisoformat(start_date)
+        start_date = datetime.datetime.fromisoformat(start_date)
     if isinstance(end_date, str):
-        end_date = datetime.fromisoformat(end_date)
+        end_date = datetime.datetime.fromisoformat(end_date)
 
-    # Set the timezone for the datetime objects
-    start_date = start_date.replace(tzinfo=time_zone)
-    end_date = end_date.replace(tzinfo=time_zone)
+    # The dates are on the wall clock of the time zone and the schedules run in UTC
+    start_date = time_zones.to_utc(start_date, time_zone)
+    end_date = time_zones.to_utc(end_date, time_zone)
 
-    # Create a croniter object for the given schedule and start date
-    cron = croniter.croniter(cron_schedule, start_date)
-    
+    # The runs are taken strictly after the start date and up to and including the end date
+    return start_date + datetime.timedelta(microseconds=1), end_date + datetime.timedelta(microseconds=1)
+
+
+def _in_time_interval(hours, time_interval):
     # Unpack the time interval into start and end hours
     start_hour, end_hour = time_interval
-    
-    # Initialize an empty list to store the datetimes
-    datetimes = []
-    
-    # Iterate over the schedule until we reach the end date
-    while True:
-        # Get the next datetime in the schedule
-        dt = cron.get_next()
-        
-        # Break if we've reached the end date
-        if dt > datetime.datetime.timestamp(end_date):
-            break
-        
-        # Check if the datetime is within the specified time interval
-        dt = datetime.datetime.fromtimestamp(dt)
-
-        if start_hour > end_hour: # Means that part of the interval is in the next day
-            if dt.hour >= start_hour and dt.hour != 0:
-                # Add the datetime to the list if it is before midnight
-                datetimes.append(datetime.datetime.strftime(dt,'%Y-%m-%d %H:%M'))
-            elif dt.hour >= 0 and dt.hour < end_hour:
-                # Add the datetime to the list if it is past midnight
-                datetimes.append(datetime.datetime.strftime(dt,'%Y-%m-%d %H:%M'))
-
-        if dt.hour >= start_hour and dt.hour < end_hour:
-            # Add the datetime to the list if it is
-            datetimes.append(datetime.datetime.strftime(dt,'%Y-%m-%d %H:%M'))
-    
-    # Return the list of datetimes, or None if the list is empty
-    return datetimes if datetimes else None
+    if start_hour > end_hour: # Means that part of the interval is in the next day
+        return (hours >= start_hour) | (hours < end_hour)
+    return (hours >= start_hour) & (hours < end_hour)
 
 
-# Load the dataframe containing the tasks and their crontab schedules
-functions_path = './functions.csv'
-dags_path = './dags.csv'
-priority_path = './priority.csv'
-df = data_preprocessor.main()
-
-# Prompt the user for the time interval
-print('Enter the time interval in the format: start_hour end_hour')
-print('For example, to get tasks that run between 3am and 5am, enter: 3 5')
-time_interval = input('Enter the time interval: ')
-start_hour, end_hour = map(int, time_interval.split())
-time_interval = (start_hour, end_hour)
-
-
-# Set the default time zone
-default_time_zone = pytz.UTC
-# Prompt the user to enter an offset from UTC in the format "±H:M" (e.g. "-8:00" for UTC-8, "8:00" for UTC+8, "0:00" for UTC)
-print("Enter an offset from UTC in the format '±H:M'\n(e.g. '-8:00' for UTC-8, '8:00' for UTC+8, '+0:00' for UTC)\nor leave blank to use the default time zone: ")
-offset = input()
-# Use the default time zone if the user didn't specify an offset
-if not offset:
-    time_zone = default_time_zone
-else:
-    # Validate the user's input
-    while not re.match(r"^[+-]\d+:\d\d$", offset):  # Check that the input consists of a sign character and two numbers separated by a colon
-        print("Invalid input. Please enter the offset in the format '±H:M'.")
-        print("Enter an offset from UTC in the format '±H:M'\n(e.g. '-8:00' for UTC-8, '8:00' for UTC+8, '+0:00' for UTC)\nor leave blank to use the default time zone: ")
-        offset = input()
-    # Split the input on the ":" character
-    offset_parts = offset.split(":")
-    # Get the sign character and convert it to a multiplier
-    sign = offset_parts[0][0]
-    if sign == "+":
-        sign = 1
-    elif sign == "-":
-        sign = -1
-    else:
-        raise ValueError("Invalid sign character: '{}'. Please enter '+' for positive offsets or '-' for negative offsets.".format(sign))
-    # Convert the hours and minutes parts to integers
-    offset_hours = int(offset_parts[0][1])
-    offset_minutes = int(offset_parts[1])
-    # Create a time zone object with the specified offset from UTC
-    tz_offset = sign * (offset_hours * 60 + offset_minutes)  # Calculate the offset in minutes
-    time_zone = pytz.FixedOffset(tz_offset)
-    # Use the default time zone if the offset is 0
-    if offset_hours == 0 and offset_minutes == 0:
-        time_zone = default_time_zone
-
-
-# Prompt the user for the start date
-print('Enter the start date in the format: YYYY-MM-DD')
-print('Alternatively, enter "now" to use the current date and time as the start date')
-start_date_input = input('Enter the start date: ')
-
-if start_date_input == 'now':
-    # Use the current date and time if the user inputs "now"
-    start_date = datetime.datetime.now()
-else:
-    # Parse the input date and time
-    start_date = pd.to_datetime(start_date_input)
+def _hours(times):
+    # The hour of the day of each datetime64 value
+    return (times - times.astype('datetime64[D]')).astype('timedelta64[h]').astype(np.int64)
 
 
-# Prompt the user for the end date
-print('Enter the end date in the format: YYYY-MM-DD')
-print('Alternatively, enter a time delta in the format +Xd to specify the end date as a number of days after the start date')
-print('For example, to get tasks that run for a week starting from the start date, enter: +7d')
-end_date_input = input('Enter the end date: ')
+def _format_datetimes(times):
+    return [dt.replace('T', ' ') for dt in np.datetime_as_string(times, unit='m')]
 
-if end_date_input.startswith('+'):
-    # Parse the time delta if the input is in the form "+Xd"
-    days = int(end_date_input[1:-1])
-    end_date = start_date + datetime.timedelta(days=days)
-else:
-    # Parse the input date and time
-    end_date = pd.to_datetime(end_date_input)
 
+def main(argv=None):
+    """
+    Save the datetimes of all the tasks within one or more time intervals and date ranges to a csv file.
+
+    Without query options the time interval, time zone and date range are prompted for. With --queries,
+    --interval or --every-hour all the queries are answered in one batch and written to one combined csv file.
+    """
+    import argparse
+    import data_preprocessor
 
-# Initialize an empty list to store the task data
-task_data = []
+    parser = argparse.ArgumentParser(description='Find the tasks that run within time intervals and date ranges.')
+    parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+    parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+    parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+    parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+    parser.add_argument('--queries', help='JSON file with a list of queries')
+    parser.add_argument('--interval', nargs=2, type=int, action='append', metavar=('START_HOUR', 'END_HOUR'),
+                        help='time interval to query, can be repeated')
+    parser.add_argument('--every-hour', action='store_true', help='query every hour of the day')
+    parser.add_argument('--time-zone', action='append',
+                        help="time zone name (e.g. Europe/Berlin) or offset from UTC in the format '±H:M' (e.g. --time-zone=-8:00), can be repeated")
+    parser.add_argument('--start', default='now', help='start date in the format YYYY-MM-DD, or "now"')
+    parser.add_argument('--end', default='+1d', help='end date in the format YYYY-MM-DD, or +Xd days after the start date')
+    parser.add_argument('--workers', type=int, help='number of processes to expand the schedules with')
+    parser.add_argument('--output', default='functions_lookup.csv', help='csv file the batch results are written to')
+    args = parser.parse_args(argv)
 
-# Iterate over the tasks in the dataframe
-for _, row in df.iterrows():
-    # Get the task name and crontab schedule
-    task_name = row['job_name']
-    cron_schedule = row['schedule']
-    # Get the list of datetimes for the task
-    datetimes = get_task_datetimes(cron_schedule, start_date, end_date, time_interval, time_zone)
-    
-    # Add the task name and datetimes to the task data list if the list is not empty
-    if datetimes:
-        task_data.append({'job_name': task_name, 'datetimes': datetimes})
+    # Load the dataframe containing the tasks and their crontab schedules
+    df = data_preprocessor.main(args.functions, args.dags, args.priority, table_path=args.table)
+
+    if args.queries or args.interval or args.every_hour:
+        if args.every_hour:
+            args.interval = (args.interval or []) + [[hour, (hour + 1) % 24] for hour in range(24)]
+        queries = read_queries(args)
+        tables = lookup_batch(df, queries, workers=args.workers)
+        format_batch(df['job_name'], queries, tables).to_csv(args.output)
+        return
+
+    # Prompt the user for the time interval
+    print('Enter the time interval in the format: start_hour end_hour')
+    print('For example, to get tasks that run between 3am and 5am, enter: 3 5')
+    time_interval = input('Enter the time interval: ')
+    start_hour, end_hour = map(int, time_interval.split())
+    time_interval = (start_hour, end_hour)
+
+    # Prompt the user to enter a time zone name (e.g. "Europe/Berlin") or an offset from UTC in the format "±H:M" (e.g. "-8:00" for UTC-8)
+    prompt = ("Enter a time zone name (e.g. 'Europe/Berlin') or an offset from UTC in the format '±H:M'\n"
+              "(e.g. '-8:00' for UTC-8, '+8:00' for UTC+8, '+0:00' for UTC)\nor leave blank to use the default time zone (UTC): ")
+    print(prompt)
+    # Validate the user's input; the default time zone (UTC) is used if the user didn't specify one
+    time_zone = None
+    while time_zone is None:
+        try:
+            time_zone = parse_offset(input())
+        except ValueError as error:
+            print("Invalid input: {}".format(error))
+            print(prompt)
+
+    # Prompt the user for the start date
+    print('Enter the start date in the format: YYYY-MM-DD')
+    print('Alternatively, enter "now" to use the current date and time as the start date')
+    start_date = parse_start_date(input('Enter the start date: '), time_zone)
+
+    # Prompt the user for the end date
+    print('Enter the end date in the format: YYYY-MM-DD')
+    print('Alternatively, enter a time delta in the format +Xd to specify the end date as a number of days after the start date')
+    print('For example, to get tasks that run for a week starting from the start date, enter: +7d')
+    end_date = parse_end_date(input('Enter the end date: '), start_date)
+
+    # Get the datetimes of all the tasks
+    df_output = get_all_task_datetimes(df, start_date, end_date, time_interval, time_zone, workers=args.workers)
+
+    # Save the output
+    df_output.to_csv("functions_btw_{}and{}.csv".format(start_hour,end_hour))
 
-# Create a new dataframe from the task data
-df_output = pd.DataFrame(task_data)
 
-# Save the output
-df_output.to_csv("functions_btw_{}and{}.csv".format(start_hour,end_hour))
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,25 @@
-import pandas as pd
+import numpy as np
 import datetime
-import croniter
-import re
+import os
 import data_preprocessor
+import cron_occurrences
+import cron_placement
+import instrumentation
+import schedule_intervals
+import time_zones
+
+# Columns of the generated crontab schedules
+SCHEDULE_COLUMNS = ["average_runtime", "crontab_schedule", "crontab_schedule_localTime", "num_runs", "num_unassigned",
+                    "category", "free_start_time", "free_end_time"]
+
+# Average runtimes (in minutes) the crontab schedules are generated for
+DEFAULT_RUNTIMES = range(1, 16)
+
+# Snapshot of the tasks the last output was computed from, used to update it incrementally
+SNAPSHOT_PATH = './scheduler_snapshot.npz'
+
+# Output of the placement engine, kept apart from output.csv so the incremental mode never patches it
+PLACEMENT_PATH = './placement.csv'
 
 def generate_start_date(tasks):
   """
@@ -14,25 +31,13 @@ def generate_start_date(tasks):
   Returns:
   - A pandas DataFrame with the tasks sorted by start date.
   """
-  # Create an empty list to store the start dates
-  start_dates = []
+  import pandas as pd
 
-  # Iterate over the tasks
-  for i, task in tasks.iterrows():
-    # Get the crontab schedule
-    crontab = task["schedule"]
-
-    # Use croniter to find the next occurrence of the crontab schedule
-    cron = croniter.croniter(crontab, datetime.datetime.now())
-
-    # The start date is the next occurrence of the crontab schedule
-    start_date = cron.get_next(datetime.datetime)
-
-    # Add the start date to the list
-    start_dates.append(start_date)
+  # The start date is the next occurrence of each crontab schedule, compiling every distinct schedule once
+  start_dates = cron_occurrences.next_runs(tasks["schedule"], time_zones.utc_now())
 
   # Add the start dates to the tasks DataFrame as a new column
-  tasks["start_date"] = start_dates
+  tasks["start_date"] = pd.to_datetime(start_dates)
 
   # Sort the tasks by start date
   tasks = tasks.sort_values("start_date")
@@ -40,93 +45,65 @@ def generate_start_date(tasks):
   return tasks
 
 
-# Define the tasks
-functions_path = './functions.csv'
-dags_path = './dags.csv'
-priority_path = './priority.csv'
-cron_data = data_preprocessor.main(functions_path, dags_path, priority_path)
-
-# Define the free time intervals
-tasks = generate_start_date(cron_data)
-
-
-def find_free_times(tasks, start_time, end_time, consider_category=False):
+@instrumentation.stage('find_free_times', rows=len)
+def find_free_times(tasks, start_time, end_time, consider_category=False, percentile=None):
   """
   Finds all the free times between tasks within the specified start and end time.
 
+  Every occurrence of every task within the interval is expanded and lasts the task's average runtime.
+  The occurrences are merged into busy intervals with a sorted sweep line and the free times are the gaps between them.
+
   Parameters:
   - tasks (pandas DataFrame): A pandas DataFrame containing the tasks, their crontab schedules, their average runtime, and their category.
   - start_time (datetime): The start of the time interval to find the free times.
   - end_time (datetime): The end of the time interval to find the free times.
-  - consider_category (bool): A flag indicating whether to consider the category when finding the free times. Default is False.
+  - consider_category (bool): A flag indicating whether to find the free times separately for each category. Default is False.
+  - percentile (float): Make every occurrence last this percentile of the task's runtimes (e.g. 99) instead of its average runtime (see data_preprocessor.get_runtimes). Default is None, the average.
 
   Returns:
-  - A pandas DataFrame with the start and end time of all free times in each row.
+  - A pandas DataFrame with the start and end time of all free times in each row (and their category if consider_category is True).
   """
-
-  # Create an empty list to store the free times
-  free_times = []
-
-  # Iterate over the tasks
-  for i, task in tasks.iterrows():
-    # Initialize the start time and end time of the free time
-    free_start_time = None
-    free_end_time = None
-
-    # Get the crontab schedule and category
-    crontab = task["schedule"]
-    category = task["category"]
-    runtime = task['avg_runtime']
-
-    # Use croniter to find the next occurrence of the crontab schedule
-    cron = croniter.croniter(crontab, datetime.datetime.now())
-
-    if i == 0:
-      # If this is the first task, the free time starts at the specified start time
-      free_start_time = start_time
-    else:
-      # If this is not the first task, the free time starts at the end of the previous task
-      prev_cron = croniter.croniter(tasks.iloc[i-1]["schedule"], datetime.datetime.now())
-      prev_end_time = prev_cron.get_next(datetime.datetime)
-      free_start_time = prev_end_time + runtime
-
-    # The free time ends at the start of the current task
-    task_start_time = cron.get_next(datetime.datetime)
-    free_end_time = task_start_time
-
-    # If the free time is not zero and is within the specified time interval, add it to the list
-    if (free_end_time - free_start_time).total_seconds() > 0 and start_time <= free_start_time <= end_time:
-      if consider_category:
-        # If the category needs to be considered, only add the free time if it is in the same category as the current task
-        if tasks.iloc[i-1]["category"] == category:
-          free_times.append({
-              "start_time": free_start_time,
-              "end_time": free_end_time
-              })
-      else:
-      # If the category does not need to be considered, add the free time regardless of the category
-        free_times.append({
-            "start_time": free_start_time,
-            "end_time": free_end_time
-            })
-
-      # Convert the list of free times to a pandas DataFrame
-      free_times_df = pd.DataFrame(free_times)
-
-  return free_times_df
-
-
-# Specify the start and end time of the time interval
-start_time = datetime.datetime.now()
-end_time = datetime.datetime.now() + datetime.timedelta(days=3)
-
-# Find all the free times between tasks within the time interval, regardless of the category
-free_times_df = find_free_times(tasks, start_time, end_time)
-
-# Find all the free times between tasks within the time interval, only considering the same category
-free_times_df = find_free_times(tasks, start_time, end_time, consider_category=True)
-
-
+  import pandas as pd
+
+  window_start = np.datetime64(start_time, 'ns').astype(np.int64)
+  window_end = np.datetime64(end_time, 'ns').astype(np.int64)
+
+  # Every group is handled as integers (category codes, nanoseconds) and the result frame is built once at the end
+  runtimes = data_preprocessor.get_runtimes(tasks, percentile).to_numpy('timedelta64[ns]').astype(np.int64)
+  schedule_codes, schedules = pd.factorize(tasks['schedule'])
+  if consider_category:
+    group_codes, names = pd.factorize(tasks['category'])
+    # Like a groupby, the tasks without a category are left out
+    known = group_codes >= 0
+    group_codes, schedule_codes, runtimes = group_codes[known], schedule_codes[known], runtimes[known]
+  else:
+    group_codes, names = np.zeros(len(tasks), dtype=np.int64), [None]
+
+  # Identical schedules produce identical start times, so only the longest runtime of each schedule matters for the busy time
+  order = np.lexsort((-runtimes, schedule_codes, group_codes))
+  distinct = np.ones(len(order), dtype=bool)
+  distinct[1:] = (np.diff(group_codes[order]) != 0) | (np.diff(schedule_codes[order]) != 0)
+  first = order[distinct]
+  job_groups, job_schedules, job_runtimes = group_codes[first], schedule_codes[first], runtimes[first]
+  longest = int(job_runtimes.max()) if len(first) else 0
+
+  # Expand all the occurrences, including the ones that started earlier and are still running at the start time
+  job_index, times = cron_occurrences.expand_jobs(schedules[job_schedules], start_time - pd.Timedelta(longest), end_time)
+  starts = times.astype('datetime64[ns]').astype(np.int64)
+  ends = starts + job_runtimes[job_index]
+
+  # Merge the occurrences of each group into busy intervals and take their complement within the interval
+  busy_groups, busy_starts, busy_ends, _ = schedule_intervals.merge_intervals_by_group(job_groups[job_index], starts, ends)
+  free_groups, free_starts, free_ends = schedule_intervals.free_gaps_by_group(busy_groups, busy_starts, busy_ends, window_start,
+                                                                              window_end, len(names))
+
+  free_times = pd.DataFrame({"start_time": free_starts.view('datetime64[ns]'), "end_time": free_ends.view('datetime64[ns]')})
+  if consider_category:
+    free_times["category"] = np.asarray(names, dtype=object)[free_groups]
+  return free_times
+
+
+@instrumentation.stage('generate_crontab_schedule', rows=len)
 def generate_crontab_schedule(free_times, max_runs_per_day, min_hours_gap, average_runtime, time_zone):
   """
   Generates a crontab schedule that fits within the free time intervals and takes into consideration the possibility of the task running multiple times per day with a certain number of hours gap between each run.
@@ -136,10 +113,13 @@ def generate_crontab_schedule(free_times, max_runs_per_day, min_hours_gap, avera
   - max_runs_per_day (int): The maximum number of times the task can run per day.
   - min_hours_gap (int): The minimum number of hours gap between each run.
   - average_runtime (int): The average runtime of the task in minutes.
+  - time_zone: The local time zone: an IANA name such as 'Asia/Tehran' (following daylight saving time), an offset or a timedelta (see time_zones.get_zone).
 
   Returns:
-  - A pandas DataFrame with each row representing the task's average runtime, the possible crontab schedule, how many times it is running in the specified interval, and the number free datetimes that couldn't be assigned to this crontab.
+  - A pandas DataFrame with each row representing the task's average runtime, the possible crontab schedule, how many times it is running in the specified interval, and the number free datetimes that couldn't be assigned to this crontab, along with the free time interval (and its category) the schedule was generated from.
   """
+  import pandas as pd
+
   # Create an empty list to store the results
   results = []
 
@@ -149,8 +129,8 @@ def generate_crontab_schedule(free_times, max_runs_per_day, min_hours_gap, avera
     end_datetime = row['end_time']
     
     # Shift the datetime objects to match the local time
-    start_datetime_tz = start_datetime + pd.Timedelta(time_zone)
-    end_datetime_tz = end_datetime + pd.Timedelta(time_zone)
+    start_datetime_tz = start_datetime + time_zones.utc_offset(time_zone, start_datetime)
+    end_datetime_tz = end_datetime + time_zones.utc_offset(time_zone, end_datetime)
 
     # Calculate the number of minutes between the start and end datetimes
     duration = (end_datetime - start_datetime).total_seconds() / 60.0
@@ -178,15 +158,9 @@ def generate_crontab_schedule(free_times, max_runs_per_day, min_hours_gap, avera
       else:
         crontab_tz = f"{start_datetime_tz.minute} {start_datetime_tz.hour} * * *"
 
-      cron = croniter.croniter(crontab, start_datetime)
-
-
       # Calculate the number of free datetimes that couldn't be assigned to this crontab
-      num_unassigned = 0
-      for i in range(max_runs_per_day):
-        next_run = cron.get_next(datetime.datetime)
-        if next_run > end_datetime:
-          num_unassigned += 1
+      runs = cron_occurrences.occurrences(crontab, start_datetime + datetime.timedelta(microseconds=1), end_datetime + datetime.timedelta(microseconds=1))
+      num_unassigned = max(max_runs_per_day - len(runs), 0)
 
       # Store the results in a pandas DataFrame
       results.append({
@@ -194,75 +168,359 @@ def generate_crontab_schedule(free_times, max_runs_per_day, min_hours_gap, avera
         "crontab_schedule": crontab,
         "crontab_schedule_localTime": crontab_tz,
         "num_runs": num_runs,
-        "num_unassigned": num_unassigned
+        "num_unassigned": num_unassigned,
+        "category": row.get("category"),
+        "free_start_time": start_datetime,
+        "free_end_time": end_datetime
       })
 
-  return pd.DataFrame(results)
+  return pd.DataFrame(results, columns=SCHEDULE_COLUMNS)
+
 
+def place_crontab_schedules(cron_data, max_runs_per_day, min_hours_gap, time_zone, runtimes=DEFAULT_RUNTIMES,
+                            top_k=cron_placement.TOP_K, consider_category=True, start_time=None, percentile=None):
+  """
+  Finds the best crontab schedules for a new job of each runtime with the placement engine of cron_placement.
+
+  Instead of deriving one schedule from each free time, every daily schedule allowed by max_runs_per_day and min_hours_gap is scored against a minute-of-week load histogram of the existing jobs (peak load, overlap with the priority jobs, mean load) and the top_k of each runtime are kept.
+
+  Parameters:
+  - cron_data (pandas DataFrame): The tasks, their crontab schedules, their average runtime, their category and their priority.
+  - max_runs_per_day (int): The maximum number of times the task can run per day.
+  - min_hours_gap (int): The minimum number of hours gap between each run.
+  - time_zone (str or timedelta): The local time zone, anything time_zones.get_zone accepts: a name (e.g. 'Asia/Tehran'), an offset string (e.g. '+3:30') or a Timedelta.
+  - runtimes (iterable of int): The average runtimes (in minutes) to place a job for. Default is DEFAULT_RUNTIMES.
+  - top_k (int): Number of schedules kept for each runtime (and category). Default is cron_placement.TOP_K.
+  - consider_category (bool): A flag indicating whether to measure the load separately for each category. Default is True.
+  - start_time (datetime): Any moment of the first week the load histograms are built from. Default is now.
+  - percentile (float): Make every run of the tasks last this percentile of their runtimes instead of their average runtime. Default is None, the average.
 
-def priority_check(df, cron_data):
+  Returns:
+  - A pandas DataFrame with the schedules of each runtime (and category), best first.
+  """
+  import pandas as pd
+
+  # The priority jobs of every category count as overlaps; all the histograms come from a single expansion
+  if consider_category:
+    categories = cron_data['category'].astype(str).to_numpy()
+    names = sorted(set(categories))
+    subsets = [categories == name for name in names]
+  else:
+    names, subsets = [None], [None]
+  loads = cron_placement.load_histograms(cron_data, [(cron_data['priority']!=5).to_numpy()] + subsets, start_time,
+                                         percentile=percentile)
+
+  results = []
+  for name, load in zip(names, loads[1:]):
+    placed = cron_placement.place_job(load, loads[0], runtimes, max_runs_per_day, min_hours_gap, time_zone, top_k)
+    if consider_category:
+      placed.insert(5, "category", name)
+    results.append(placed)
+
+  return pd.concat(results, ignore_index=True)
+
+
+@instrumentation.stage('priority_check', rows=len)
+def priority_check(df, cron_data, start_time=None, end_time=None, percentile=None):
   """
   This function checks for overlaps between the crontab schedules in the 
   generated crontab schedules dataframe and the schedules in the main dataframe
   with priority != 5. It creates a new column 'overlap' and populates it with 
   the number of overlaps for each schedule.
+
+  Every run of each generated schedule within the time interval is checked against every run of
+  every priority job; a run overlaps when it starts while a priority job is running.
+
+  Parameters:
+  - df (pandas DataFrame): The generated crontab schedules, with a 'crontab_schedule' column.
+  - cron_data (pandas DataFrame): The tasks, their crontab schedules, their average runtime, and their priority.
+  - start_time (datetime): The start of the time interval to check. Default is now.
+  - end_time (datetime): The end of the time interval to check. Default is one day after start_time.
+  - percentile (float): Make every priority job run last this percentile of its runtimes instead of its average runtime. Default is None, the average.
+
+  Returns:
+  - The df DataFrame with an integer 'overlap' column.
   """
-  df['overlap'] = None
-  priority = cron_data[cron_data['priority']!=5]
-  overlap_dict = {}
-
-  for i, row in priority.iterrows():
-      function_name = row['job_name']
-      priority_schedule = row['schedule']
-      priority_runtime = row['avg_runtime']
-      priority_cron = croniter.croniter(priority_schedule)
-      priority_next_run_time = priority_cron.get_next(datetime.datetime)
-      count = 0
-      for j, df_row in df.iterrows():
-          schedule = df_row['crontab_schedule']
-          df_cron = croniter.croniter(schedule)
-          df_next_run_time = df_cron.get_next(datetime.datetime)
-          if (priority_next_run_time < df_next_run_time) and (df_next_run_time <= priority_next_run_time + priority_runtime):
-              count += 1
-      if count>0:
-          overlap_dict[function_name] = count
-
-      rows = df[df['crontab_schedule']== schedule]
-      df.loc[rows.index, 'overlap'] = [overlap_dict for _ in range(len(rows))]
+  if start_time is None:
+    start_time = time_zones.utc_now()
+  if end_time is None:
+    end_time = start_time + datetime.timedelta(days=1)
+
+  df['overlap'] = count_overlaps(df['crontab_schedule'], cron_data[cron_data['priority']!=5], start_time, end_time, percentile)
 
   return df
 
-# Set the offset from UTC in the format '±H:M'
-offset = "+3:30"
-# Split the input on the ":" character
-offset_parts = offset.split(":")
-# Get the sign character and convert it to a multiplier
-sign = offset_parts[0][0]
-if sign == "+":
-    sign = 1
-elif sign == "-":
-    sign = -1
-else:
-    raise ValueError("Invalid sign character: '{}'. Please enter '+' for positive offsets or '-' for negative offsets.".format(sign))
-# Convert the hours and minutes parts to integers
-offset_hours = int(offset_parts[0][1])
-offset_minutes = int(offset_parts[1])
-# Create a time zone object with the specified offset from UTC
-tz_offset = sign * (offset_hours * 60 + offset_minutes)  # Calculate the offset in minutes
-time_zone = pd.to_timedelta(tz_offset, unit='m')
-
-# Set the maximum number of times the task can run
-max_runs_per_day = 4
-
-# Set the minimum number of hours gap between each run
-min_hours_gap = 2
-
-# Generate the crontab schedules for average runtimes between 1 and 15 minutes
-df = pd.DataFrame()
-for average_runtime in range(1, 16):
-  df = df.append(generate_crontab_schedule(free_times_df, max_runs_per_day, min_hours_gap, average_runtime, time_zone)).reset_index(drop=True)
-
-# Check for priority violations
-df = priority_check(df, cron_data)
-
-df.to_csv("output.csv")
\ No newline at end of file
+def count_overlaps(schedules, jobs, start_time, end_time, percentile=None):
+  """
+  Counts, for each crontab schedule, how many of its runs within the time interval start while one of the jobs is running.
+
+  Parameters:
+  - schedules (iterable of str): The crontab schedules to check.
+  - jobs (pandas DataFrame): The jobs to check against, with 'schedule' and 'avg_runtime' columns.
+  - start_time (datetime): The start of the time interval to check.
+  - end_time (datetime): The end of the time interval to check.
+  - percentile (float): Make every job run last this percentile of its runtimes instead of its average runtime. Default is None, the average.
+
+  Returns:
+  - A numpy int64 array with the number of overlaps of each schedule.
+  """
+  import pandas as pd
+
+  schedules = list(schedules)
+  runtimes = data_preprocessor.get_runtimes(jobs, percentile)
+  longest = runtimes.max() if len(jobs) else pd.Timedelta(0)
+
+  # Expand the runs of the jobs, including the ones that started earlier and are still running at the start time
+  job_index, times = cron_occurrences.expand_jobs(jobs['schedule'], start_time - longest, end_time)
+  job_starts = times.astype('datetime64[ns]')
+  job_ends = job_starts + runtimes.to_numpy('timedelta64[ns]')[job_index]
+
+  # Count the job runs in progress at each run of the schedules and add them up per schedule
+  schedule_index, schedule_times = cron_occurrences.expand_jobs(schedules, start_time, end_time)
+  counts = schedule_intervals.count_containing(job_starts, job_ends, schedule_times.astype('datetime64[ns]'))
+  return np.bincount(schedule_index, weights=counts, minlength=len(schedules)).astype(np.int64)
+
+
+def diff_jobs(old_data, new_data):
+  """
+  Compares two versions of the tasks by job name.
+
+  Parameters:
+  - old_data (pandas DataFrame): The previous version of the tasks.
+  - new_data (pandas DataFrame): The current version of the tasks.
+
+  Returns:
+  - A tuple (removed, added) of pandas DataFrames. Removed holds the old rows of the jobs that were deleted or changed and added holds the new rows of the jobs that were created or changed.
+  """
+  import pandas as pd
+
+  # The runtime percentiles of either version are compared too, as missing in a version without them
+  percentiles = [column for column in data_preprocessor.percentile_columns() if column in old_data.columns or column in new_data.columns]
+  columns = ['job_name', 'schedule', 'avg_runtime', 'category', 'priority'] + percentiles
+  old_rows = old_data.reindex(columns=columns).astype({'category': str, 'priority': 'int64'})
+  new_rows = new_data.reindex(columns=columns).astype({'category': str, 'priority': 'int64'})
+  for column in ['avg_runtime'] + percentiles:
+    old_rows[column] = pd.to_timedelta(old_rows[column])
+    new_rows[column] = pd.to_timedelta(new_rows[column])
+
+  # A job is unchanged when a row with exactly the same values exists in both versions
+  merged = old_rows.merge(new_rows, how='outer', on=columns, indicator=True)
+  removed = merged[merged['_merge'] == 'left_only'].drop(columns='_merge').reset_index(drop=True)
+  added = merged[merged['_merge'] == 'right_only'].drop(columns='_merge').reset_index(drop=True)
+  return removed, added
+
+
+def build_schedule(cron_data, start_time, end_time, max_runs_per_day, min_hours_gap, time_zone, runtimes=DEFAULT_RUNTIMES,
+                   percentile=None):
+  """
+  Runs the whole pipeline: finds the free times of each category, generates the crontab schedules for each runtime and checks them for priority overlaps.
+
+  With a percentile (e.g. 99), every run of the tasks lasts that percentile of their runtimes instead of their average runtime, both for the free times and for the overlaps (see find_free_times).
+
+  Returns:
+  - A pandas DataFrame with the generated crontab schedules, sorted by runtime, category and free time.
+  """
+  import pandas as pd
+
+  free_times = find_free_times(cron_data, start_time, end_time, consider_category=True, percentile=percentile)
+  df = pd.concat([generate_crontab_schedule(free_times, max_runs_per_day, min_hours_gap, average_runtime, time_zone)
+                  for average_runtime in runtimes], ignore_index=True)
+  df = priority_check(df, cron_data, start_time, end_time, percentile)
+  return _sort_schedule(df)
+
+
+def update_schedule(df, old_data, new_data, start_time, end_time, max_runs_per_day, min_hours_gap, time_zone, runtimes=DEFAULT_RUNTIMES,
+                    percentile=None):
+  """
+  Patches the output of build_schedule after some jobs changed, recomputing only what the changed jobs affect.
+
+  Only the free times of the categories of the changed jobs are recomputed. The generated schedules of free times that still exist are kept, and their overlaps are corrected with the changed priority jobs only; new free times get new schedules.
+
+  Parameters:
+  - df (pandas DataFrame): The previous output of build_schedule (or update_schedule) for the same time interval and settings.
+  - old_data (pandas DataFrame): The tasks df was computed from.
+  - new_data (pandas DataFrame): The current tasks.
+  - The other parameters are the same as for build_schedule.
+
+  Returns:
+  - A pandas DataFrame equal to build_schedule(new_data, ...).
+  """
+  import pandas as pd
+
+  removed, added = diff_jobs(old_data, new_data)
+  if len(removed) == 0 and len(added) == 0:
+    return df
+
+  # Recompute the free times of the categories the changed jobs belong to (before and after the change)
+  categories = set(removed['category']) | set(added['category'])
+  affected = new_data[new_data['category'].astype(str).isin(categories)]
+  # A category whose jobs were all removed has no free times left, so all of its schedules are dropped below
+  free_times = find_free_times(affected, start_time, end_time, consider_category=True, percentile=percentile)
+  free_times['category'] = free_times['category'].astype(str)
+
+  # Keep the schedules of the unaffected categories and of the free times that did not change
+  gap_columns = ['category', 'free_start_time', 'free_end_time']
+  new_gaps = pd.MultiIndex.from_frame(free_times.rename(columns={'start_time': 'free_start_time', 'end_time': 'free_end_time'})[gap_columns])
+  old_gaps = pd.MultiIndex.from_frame(df[gap_columns].astype({'category': str}))
+  keep = ~df['category'].astype(str).isin(categories) | old_gaps.isin(new_gaps)
+  kept = df[keep].copy()
+
+  # Correct the overlaps of the kept schedules with the priority jobs that were removed or added
+  removed_priority = removed[removed['priority']!=5]
+  added_priority = added[added['priority']!=5]
+  if len(kept) and (len(removed_priority) or len(added_priority)):
+    kept['overlap'] = (kept['overlap'].to_numpy(dtype=np.int64)
+                       + count_overlaps(kept['crontab_schedule'], added_priority, start_time, end_time, percentile)
+                       - count_overlaps(kept['crontab_schedule'], removed_priority, start_time, end_time, percentile))
+
+  # Generate and check schedules for the free times that are new
+  fresh_times = free_times[~new_gaps.isin(old_gaps)]
+  fresh = pd.concat([generate_crontab_schedule(fresh_times, max_runs_per_day, min_hours_gap, average_runtime, time_zone)
+                     for average_runtime in runtimes], ignore_index=True)
+  fresh = priority_check(fresh, new_data, start_time, end_time, percentile)
+
+  # An empty frame of new schedules would turn the typed columns of the kept ones into objects
+  return _sort_schedule(pd.concat([kept, fresh] if len(fresh) else [kept], ignore_index=True))
+
+
+def save_snapshot(cron_data, snapshot_path, start_time, end_time, max_runs_per_day, min_hours_gap, time_zone, runtimes=DEFAULT_RUNTIMES,
+                  percentile=None):
+  """
+  Stores the tasks an output was computed from, along with its time interval and settings, for the next incremental run.
+  """
+  data_preprocessor.write_table(cron_data, snapshot_path,
+                                window=np.array([start_time, end_time], dtype='datetime64[us]'),
+                                settings=np.array([max_runs_per_day, min_hours_gap], dtype=np.int64),
+                                time_zone=np.array(time_zones.zone_name(time_zone)),
+                                runtimes=np.array(list(runtimes), dtype=np.int64),
+                                percentile=np.array(np.nan if percentile is None else percentile, dtype=np.float64))
+
+
+def load_snapshot(snapshot_path):
+  """
+  Reads a snapshot stored by save_snapshot.
+
+  Returns:
+  - A tuple (cron_data, start_time, end_time, settings) where settings is a tuple (max_runs_per_day, min_hours_gap, time_zone name, runtimes, percentile), or None if there is no snapshot (or it was stored by an older version).
+  """
+  if not os.path.exists(snapshot_path):
+    return None
+  cron_data, arrays = data_preprocessor.read_table(snapshot_path)
+  if 'time_zone' not in arrays:
+    return None
+  start_time, end_time = arrays['window'].astype(datetime.datetime)
+  max_runs_per_day, min_hours_gap = arrays['settings'].tolist()
+  # Snapshots stored before the percentile was recorded were computed with the average runtimes
+  percentile = float(arrays['percentile']) if 'percentile' in arrays else np.nan
+  settings = (max_runs_per_day, min_hours_gap, str(arrays['time_zone']), tuple(arrays['runtimes'].tolist()),
+              None if np.isnan(percentile) else percentile)
+  return cron_data, start_time, end_time, settings
+
+
+def run_schedule(cron_data, max_runs_per_day, min_hours_gap, time_zone, start_time=None, end_time=None, runtimes=DEFAULT_RUNTIMES,
+                 output_path='output.csv', snapshot_path=SNAPSHOT_PATH, percentile=None):
+  """
+  Computes the output for the tasks and writes it to output_path, incrementally when possible.
+
+  The percentile is passed on to build_schedule and update_schedule; a previous output is only patched if it was computed with the same percentile.
+
+  When a snapshot of a previous run with the same time interval and settings exists, the previous output is patched with update_schedule; otherwise it is rebuilt with build_schedule.
+  If no time interval is given, the interval of the previous run is reused while it has not ended, otherwise the next 3 days are used.
+
+  Returns:
+  - A pandas DataFrame with the generated crontab schedules.
+  """
+  import pandas as pd
+
+  snapshot = load_snapshot(snapshot_path) if snapshot_path is not None else None
+  if start_time is None and end_time is None:
+    if snapshot is not None and snapshot[2] > time_zones.utc_now():
+      start_time, end_time = snapshot[1], snapshot[2]
+    else:
+      start_time = time_zones.utc_now()
+      end_time = start_time + datetime.timedelta(days=3)
+
+  settings = (max_runs_per_day, min_hours_gap, time_zones.zone_name(time_zone), tuple(runtimes),
+              None if percentile is None else float(percentile))
+  if (snapshot is not None and (snapshot[1], snapshot[2], snapshot[3]) == (start_time, end_time, settings)
+      and os.path.exists(output_path)):
+    previous = pd.read_csv(output_path, index_col=0, parse_dates=['free_start_time', 'free_end_time'])
+    df = update_schedule(previous, snapshot[0], cron_data, start_time, end_time, max_runs_per_day, min_hours_gap, time_zone, runtimes,
+                         percentile)
+  else:
+    df = build_schedule(cron_data, start_time, end_time, max_runs_per_day, min_hours_gap, time_zone, runtimes, percentile)
+
+  df.to_csv(output_path)
+  if snapshot_path is not None:
+    save_snapshot(cron_data, snapshot_path, start_time, end_time, max_runs_per_day, min_hours_gap, time_zone, runtimes, percentile)
+  return df
+
+
+def _sort_schedule(df):
+  df['category'] = df['category'].astype(str)
+  return df.sort_values(['average_runtime', 'category', 'free_start_time'], kind='stable').reset_index(drop=True)
+
+def main(functions_path='./functions.csv', dags_path='./dags.csv', priority_path='./priority.csv', offset="+3:30",
+         max_runs_per_day=4, min_hours_gap=2, table_path=None, percentile=None, placement=False):
+  """
+  Loads the tasks, generates the crontab schedules for average runtimes between 1 and 15 minutes, checks them for priority violations and writes them to output.csv.
+
+  With placement, the schedules are searched with the placement engine instead (see place_crontab_schedules) and written to PLACEMENT_PATH.
+
+  Parameters:
+  - functions_path, dags_path, priority_path (str): Paths of the datasets.
+  - offset (str): The local time zone, as an offset from UTC in the format '±H:M' (e.g. '+3:30', '-10:00') or an IANA name (e.g. 'Asia/Tehran').
+  - max_runs_per_day (int): The maximum number of times the task can run per day.
+  - min_hours_gap (int): The minimum number of hours gap between each run.
+  - table_path (str): Read the tasks from a job table stored by data_preprocessor.write_table (e.g. by metadata_loader) instead of the datasets. Default is None.
+  - percentile (float): Make every run of the tasks last this percentile of their runtimes (e.g. 99) instead of their average runtime. Default is None, the average.
+  - placement (bool): Use the placement engine. Default is False.
+
+  Returns:
+  - A pandas DataFrame with the generated crontab schedules.
+  """
+  # Define the tasks
+  cron_data = data_preprocessor.main(functions_path, dags_path, priority_path, table_path=table_path)
+
+  # Parse the offset (every digit of the hours, e.g. '+10:00') or the time zone name
+  time_zone = time_zones.get_zone(offset)
+
+  if placement:
+    df = place_crontab_schedules(cron_data, max_runs_per_day, min_hours_gap, time_zone, percentile=percentile)
+    df.to_csv(PLACEMENT_PATH)
+    return df
+
+  # Generate the crontab schedules for average runtimes between 1 and 15 minutes and check them for priority violations,
+  # patching the previous output when only a few jobs changed since the last run
+  return run_schedule(cron_data, max_runs_per_day, min_hours_gap, time_zone, percentile=percentile)
+
+
+def parse_args(argv=None):
+  """
+  Reads the arguments of main from the command line.
+
+  Returns:
+  - dict: The keyword arguments of main.
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Generate crontab schedules fitting the free times between the tasks.')
+  parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+  parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+  parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+  parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+  parser.add_argument('--offset', default='+3:30', help="local time zone, as an offset from UTC (e.g. '+3:30') or a name (default +3:30)")
+  parser.add_argument('--max-runs-per-day', type=int, default=4, help='maximum number of runs per day (default 4)')
+  parser.add_argument('--min-hours-gap', type=int, default=2, help='minimum number of hours between two runs (default 2)')
+  parser.add_argument('--percentile', type=float,
+                      help='make every run last this percentile of its runtimes (e.g. 99) instead of the average runtime')
+  parser.add_argument('--placement', action='store_true',
+                      help='score every daily schedule against the load of the jobs (written to {})'.format(PLACEMENT_PATH))
+  args = parser.parse_args(argv)
+  return {'functions_path': args.functions, 'dags_path': args.dags, 'priority_path': args.priority, 'offset': args.offset,
+          'max_runs_per_day': args.max_runs_per_day, 'min_hours_gap': args.min_hours_gap, 'table_path': args.table,
+          'percentile': args.percentile, 'placement': args.placement}
+
+
+if __name__ == '__main__':
+  main(**parse_args())
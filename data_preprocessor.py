@@ -1,49 +1,69 @@
-import pandas as pd
-import datetime
+import numpy as np
+import hashlib
+import os
+import instrumentation
 
 
+# Keywords searched in the job names, in order of precedence, and the resulting categories ('other' when none matches)
+CATEGORIES = ['bus', 'train', 'flight', 'hotel', 'payment']
+
+# Columns read from each dataset and their types
+FUNCTIONS_DTYPES = {'func_name': 'str', 'schedule': 'str', 'avg_runtime': 'str'}
+DAGS_DTYPES = {'dag_id': 'str', 'schedule': 'str', 'avg_runtime': 'str'}
+PRIORITY_DTYPES = {'function_name': 'str', 'priority': 'Int64'}
+
+# Number of rows read from the functions and dags datasets at a time
+CHUNK_SIZE = 100000
+
+# Percentiles of the runtime sketch of each job, stored as 'runtime_p50', 'runtime_p90' and 'runtime_p99' columns
+RUNTIME_PERCENTILES = (50, 90, 99)
+
+# Binary cache of the merged job table, rebuilt whenever one of the datasets changes
+CACHE_PATH = './cron_data_cache.npz'
+# Version of the table layout stored in the cache; bump it whenever process_data builds a different table (as when
+# the runtime percentile columns were added) so caches written by an older version are rebuilt
+CACHE_VERSION = 2
+
+# A Postgres interval such as "0 years 0 mons 0 days 0 hours 13 mins 57.700518 secs"
+INTERVAL_PATTERN = (r'^\s*(?:(?P<years>-?\d+) years?\s*)?(?:(?P<mons>-?\d+) mons?\s*)?(?:(?P<days>-?\d+) days?\s*)?'
+                    r'(?:(?P<hours>-?\d+) hours?\s*)?(?:(?P<mins>-?\d+) mins?\s*)?(?:(?P<secs>-?\d+(?:\.\d+)?) secs?\s*)?$')
+# Seconds in each interval unit, using the same 30-day month and 365.25-day year as Postgres' EXTRACT(epoch)
+INTERVAL_SECONDS = {'years': 365.25 * 86400, 'mons': 30 * 86400, 'days': 86400, 'hours': 3600, 'mins': 60, 'secs': 1}
+
+
+def category_dtype():
+    # The categorical type of the 'category' column
+    import pandas as pd
+    return pd.CategoricalDtype(CATEGORIES + ['other'])
+
 def convert_to_timedelta(runtime_string):
-    # split the string by space
-    time_parts = runtime_string.split()
-    # create a dictionary to store the time parts
-    time_dict = {}
-    for i in range(0, len(time_parts), 2):
-        if time_parts[i+1] == 'years':
-            time_dict['years'] = int(time_parts[i])
-        elif time_parts[i+1] == 'mons':
-            time_dict['months'] = int(time_parts[i])
-        elif time_parts[i+1] == 'days':
-            time_dict['days'] = int(time_parts[i])
-        elif time_parts[i+1] == 'hours':
-            time_dict['hours'] = int(time_parts[i])
-        elif time_parts[i+1] == 'mins':
-            time_dict['mins'] = int(time_parts[i])
-        elif time_parts[i+1] == 'secs':
-            time_dict['secs'] = float(time_parts[i])
-    # convert to timedelta
-    time_delta = datetime.timedelta(days=time_dict.get('days',0), hours=time_dict.get('hours',0), minutes=time_dict.get('mins',0),seconds=time_dict.get('secs',0))
-    return time_delta
+    # Convert a single Postgres interval string to a timedelta
+    import pandas as pd
+    return parse_runtimes(pd.Series([runtime_string])).iloc[0].to_pytimedelta()
+
+def parse_runtimes(runtimes):
+    """
+    Convert a column of Postgres interval strings to timedeltas with one vectorized regex extract (missing runtimes are 0)
+    """
+    import pandas as pd
+    parts = runtimes.str.extract(INTERVAL_PATTERN).astype(float)
+    # A runtime that is given but is not an interval would otherwise silently become 0
+    malformed = runtimes.notna() & ~runtimes.str.fullmatch(INTERVAL_PATTERN).fillna(False).astype(bool)
+    if malformed.any():
+        raise ValueError('Malformed runtime {!r} ({} malformed runtimes)'.format(runtimes[malformed].iloc[0], int(malformed.sum())))
+    parts = parts.fillna(0)
+    seconds = sum(parts[unit].to_numpy() * factor for unit, factor in INTERVAL_SECONDS.items())
+    return pd.Series(pd.to_timedelta(seconds, unit='s'), index=runtimes.index, name=runtimes.name)
 
 def assign_category(df, column_name):
     """
     Assign a category based on keywords in the column_name
     """
-    # Create a new column called 'category' and set all values to 'other' by default
-    df['category'] = 'other'
-
-    for index, row in df.iterrows():
-        name = row[column_name]
-        # Check the name and assign a category based on the keywords in the name
-        if 'bus' in name:
-            df.at[index, 'category'] = 'bus'
-        elif 'train' in name:
-            df.at[index, 'category'] = 'train'
-        elif 'flight' in name:
-            df.at[index, 'category'] = 'flight'
-        elif 'hotel' in name:
-            df.at[index, 'category'] = 'hotel'
-        elif 'payment' in name:
-            df.at[index, 'category'] = 'payment'
+    import pandas as pd
+    # The first keyword found in the name gives the category, 'other' if none is found
+    name = df[column_name].astype(str)
+    conditions = [name.str.contains(keyword, regex=False).to_numpy() for keyword in CATEGORIES]
+    df['category'] = pd.Categorical(np.select(conditions, CATEGORIES, default='other'), dtype=category_dtype())
     return df
 
 def rename_columns(df):
@@ -55,39 +75,221 @@ def rename_columns(df):
 
 def select_columns(df):
     selected_columns = ['job_name', 'schedule', 'avg_runtime', 'category']
+    # The runtime percentiles are only known when the jobs come with their run history
+    selected_columns += [column for column in percentile_columns() if column in df.columns]
     return df[selected_columns]
 
-def process_data(functions_path, dags_path, priority_path):
-    functions = pd.read_csv(functions_path)
-    dags = pd.read_csv(dags_path)
-    priority = pd.read_csv(priority_path)
-    
-    # Convert avg_runtime to timedelta
-    functions['avg_runtime'] = functions['avg_runtime'].apply(convert_to_timedelta)
-    
-    # Assign category to functions and dags
-    functions = assign_category(functions, 'func_name')
-    dags = assign_category(dags, 'dag_id')
-
-    # Rename columns
-    functions = rename_columns(functions)
-    dags = rename_columns(dags)
-
-    # Select the columns of interest
-    functions = select_columns(functions)
-    dags = select_columns(dags)
-
-    # Join the tables on 'job_name', 'schedule', and 'category'
-    merged_data = pd.concat([functions, dags], ignore_index=True)
+def percentile_columns():
+    return ['runtime_p{}'.format(percentile) for percentile in RUNTIME_PERCENTILES]
+
+def get_runtimes(tasks, percentile=None, mean_column='avg_runtime'):
+    """
+    Return the runtime of each task at a percentile of its run durations, as a timedelta Series (missing runtimes are 0)
+
+    Percentiles between those of RUNTIME_PERCENTILES are interpolated linearly, and the ones outside are clipped to
+    the nearest one. The mean runtime is used when percentile is None, and for the tasks without percentile columns
+    (or with missing values in them), such as the ones read from the CSV exports.
+    """
+    import pandas as pd
+    mean = pd.to_timedelta(tasks[mean_column]).fillna(pd.Timedelta(0))
+    columns = [column for column in percentile_columns() if column in tasks.columns]
+    if percentile is None or len(columns) < len(RUNTIME_PERCENTILES):
+        return mean
+    if not 0 <= percentile <= 100:
+        raise ValueError("percentile must be between 0 and 100, got {}".format(percentile))
+    # The two stored percentiles around the requested one, and the weight of the upper one
+    points = np.array(RUNTIME_PERCENTILES, dtype=float)
+    upper = int(np.clip(np.searchsorted(points, percentile), 1, len(points) - 1))
+    weight = float(np.clip((percentile - points[upper - 1]) / (points[upper] - points[upper - 1]), 0, 1))
+    low = pd.to_timedelta(tasks[columns[upper - 1]]).to_numpy('timedelta64[ns]').astype(np.float64)
+    high = pd.to_timedelta(tasks[columns[upper]]).to_numpy('timedelta64[ns]').astype(np.float64)
+    known = ~(pd.isna(tasks[columns[upper - 1]]).to_numpy() | pd.isna(tasks[columns[upper]]).to_numpy())
+    runtimes = np.where(known, np.round(low + (high - low) * weight), mean.to_numpy('timedelta64[ns]').astype(np.float64))
+    return pd.Series(pd.to_timedelta(runtimes.astype(np.int64), unit='ns'), index=tasks.index, name=mean_column)
+
+def read_priority(priority_path):
+    # The priority dataset is a small lookup table, so it is always read at once
+    import pandas as pd
+    priority = pd.read_csv(priority_path, usecols=list(PRIORITY_DTYPES), dtype=PRIORITY_DTYPES)
+    return priority.drop_duplicates('function_name').set_index('function_name')['priority']
+
+def process_chunk(chunk, name_column, priority):
+    """
+    Convert one chunk of the functions or dags dataset to the merged job table format
+    """
+    import pandas as pd
+    # Functions report Postgres intervals, dags report pandas timedeltas
+    if name_column == 'func_name':
+        chunk['avg_runtime'] = parse_runtimes(chunk['avg_runtime'])
+    else:
+        chunk['avg_runtime'] = pd.to_timedelta(chunk['avg_runtime'])
+    return merge_jobs(chunk, name_column, priority)
+
+def merge_jobs(chunk, name_column, priority):
+    """
+    Convert jobs with parsed runtimes to the merged job table format: category, column names and priority
+    """
+    chunk = assign_category(chunk, name_column)
+    chunk = rename_columns(chunk)
+    chunk = select_columns(chunk)
 
     # Merge with priority data
-    merged_data = merged_data.join(priority.set_index('function_name').loc[:, ['priority']], on='job_name', how='left')
-    merged_data.fillna({'priority':5}, inplace=True)
+    chunk = chunk.assign(priority=chunk['job_name'].map(priority).fillna(5).astype('int64'))
+    return chunk.reset_index(drop=True)
+
+def iter_data(functions_path, dags_path, priority_path, chunksize=CHUNK_SIZE):
+    """
+    Read the datasets in chunks and yield the merged job table chunk by chunk
+    """
+    import pandas as pd
+    priority = read_priority(priority_path)
+    for path, dtypes in ((functions_path, FUNCTIONS_DTYPES), (dags_path, DAGS_DTYPES)):
+        name_column = next(iter(dtypes))
+        for chunk in pd.read_csv(path, usecols=list(dtypes), dtype=dtypes, chunksize=chunksize):
+            yield process_chunk(chunk, name_column, priority)
+
+@instrumentation.stage('process_data', rows=len)
+def process_data(functions_path, dags_path, priority_path, chunksize=CHUNK_SIZE):
+    # Join the functions and dags chunks into a single table
+    import pandas as pd
+    chunks = list(iter_data(functions_path, dags_path, priority_path, chunksize))
+    if not chunks:
+        return pd.DataFrame({'job_name': pd.Series(dtype='str'), 'schedule': pd.Series(dtype='str'),
+                             'avg_runtime': pd.Series(dtype='timedelta64[ns]'), 'category': pd.Series(dtype=category_dtype()),
+                             'priority': pd.Series(dtype='int64')})
+    merged_data = pd.concat(chunks, ignore_index=True)
 
     return merged_data
 
 
-def main(functions_path=None, dags_path=None, priority_path=None):
+def file_signature(path, digest=None):
+    """
+    Return the size, modification time and (optionally reused) content hash of a file
+    """
+    stat = os.stat(path)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+    return stat.st_size, stat.st_mtime_ns, digest
+
+def file_signatures(paths):
+    """
+    Return the size and modification time of each file, a cheap check for changes that does not read them
+    """
+    signatures = []
+    for path in paths:
+        stat = os.stat(path)
+        signatures.append((stat.st_size, stat.st_mtime_ns))
+    return signatures
+
+def write_table(cron_data, path, **extra):
+    """
+    Store the merged job table, plus any extra NumPy arrays, in a .npz file
+    """
+    import pandas as pd
+    category = pd.Categorical(cron_data['category'])
+    arrays = {
+        'job_name': cron_data['job_name'].to_numpy(dtype=str),
+        'schedule': cron_data['schedule'].to_numpy(dtype=str),
+        'avg_runtime': pd.to_timedelta(cron_data['avg_runtime']).to_numpy('timedelta64[ns]').astype(np.int64),
+        'category': category.codes,
+        'categories': np.array(category.categories, dtype=str),
+        'priority': cron_data['priority'].to_numpy(dtype=np.int64),
+    }
+    for column in percentile_columns():
+        if column in cron_data.columns:
+            arrays[column] = pd.to_timedelta(cron_data[column]).to_numpy('timedelta64[ns]').astype(np.int64)
+    arrays.update(extra)
+    # Write to a temporary file first so a crash never leaves a half-written file behind
+    temp_path = path + '.tmp.npz'
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, path)
+
+def read_table(path):
+    """
+    Read a job table stored by write_table and return it with the dict of its extra arrays
+    """
+    import pandas as pd
+    with np.load(path, allow_pickle=False) as stored:
+        arrays = {name: stored[name] for name in stored.files}
+    categories = pd.CategoricalDtype(arrays.pop('categories').tolist())
+    cron_data = pd.DataFrame({
+        'job_name': pd.Series(arrays.pop('job_name'), dtype='str'),
+        'schedule': pd.Series(arrays.pop('schedule'), dtype='str'),
+        'avg_runtime': pd.to_timedelta(arrays.pop('avg_runtime'), unit='ns'),
+        'category': pd.Categorical.from_codes(arrays.pop('category'), dtype=categories),
+        'priority': arrays.pop('priority'),
+    })
+    # The runtime percentiles go before the priority, as in the tables built by merge_jobs
+    for column in percentile_columns():
+        if column in arrays:
+            cron_data.insert(len(cron_data.columns) - 1, column, pd.to_timedelta(arrays.pop(column), unit='ns'))
+    return cron_data, arrays
+
+def save_cache(cron_data, cache_path, signatures):
+    """
+    Store the merged job table, the signatures of its datasets and the cache version in the binary cache
+    """
+    write_table(cron_data, cache_path, version=np.int64(CACHE_VERSION),
+                sizes=np.array([size for size, _, _ in signatures], dtype=np.int64),
+                mtimes=np.array([mtime for _, mtime, _ in signatures], dtype=np.int64),
+                hashes=np.array([digest for _, _, digest in signatures], dtype=str))
+
+def load_cache(cache_path, paths):
+    """
+    Return the cached job table if it has the current version and none of the datasets changed since it was stored, otherwise None
+    """
+    if not os.path.exists(cache_path):
+        return None
+    cron_data, arrays = read_table(cache_path)
+    if 'version' not in arrays or int(arrays['version']) != CACHE_VERSION:
+        return None
+    if len(arrays['sizes']) != len(paths):
+        return None
+
+    # Size and modification time are enough when they match; otherwise compare the content hashes
+    signatures = []
+    for path, size, mtime, digest in zip(paths, arrays['sizes'], arrays['mtimes'], arrays['hashes']):
+        stat = os.stat(path)
+        if stat.st_size != size:
+            return None
+        if stat.st_mtime_ns == mtime:
+            signatures.append(file_signature(path, str(digest)))
+            continue
+        signature = file_signature(path)
+        if signature[2] != digest:
+            return None
+        signatures.append(signature)
+
+    # Remember the new modification times of datasets that were only touched
+    if [mtime for _, mtime, _ in signatures] != arrays['mtimes'].tolist():
+        save_cache(cron_data, cache_path, signatures)
+    return cron_data
+
+def load_data(functions_path, dags_path, priority_path, cache_path=CACHE_PATH, table_path=None):
+    """
+    Return the merged job table, from the binary cache when the datasets are unchanged, or the table stored
+    by write_table at table_path (e.g. by metadata_loader) instead of the datasets
+    """
+    if table_path is not None:
+        return read_table(table_path)[0]
+    if cache_path is None:
+        return process_data(functions_path, dags_path, priority_path)
+    paths = [functions_path, dags_path, priority_path]
+    cron_data = load_cache(cache_path, paths)
+    if cron_data is None:
+        signatures = [file_signature(path) for path in paths]
+        cron_data = process_data(functions_path, dags_path, priority_path)
+        save_cache(cron_data, cache_path, signatures)
+    return cron_data
+
+
+def main(functions_path=None, dags_path=None, priority_path=None, cache_path=CACHE_PATH, table_path=None):
+    if table_path is not None:
+        return load_data(functions_path, dags_path, priority_path, cache_path, table_path)
     if __name__ == '__main__':
         if functions_path is None:
             print("Enter path to \"functions\" dataset:")
@@ -106,5 +308,9 @@ def main(functions_path=None, dags_path=None, priority_path=None):
         if priority_path is None:
             priority_path = './priority.csv'
 
-    cron_data = process_data(functions_path, dags_path, priority_path)
-    return cron_data
\ No newline at end of file
+    cron_data = load_data(functions_path, dags_path, priority_path, cache_path)
+    return cron_data
+
+
+if __name__ == '__main__':
+    print(main())
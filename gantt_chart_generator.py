@@ -1,68 +1,301 @@
-import pandas as pd
-import plotly.express as px
-import plotly.offline as offline
-import croniter
+import numpy as np
+import cron_occurrences
 import data_preprocessor
+import instrumentation
+import schedule_intervals
+import time_zones
 
 
-def create_gantt_chart(df, interval, tasks):
-    # Convert the crontab schedules to a list of dictionaries in the form {'Start': start_time, 'Finish': end_time, 'Task': task}
-    job_schedules = []
-    current_time = pd.Timestamp.now()
-    end_time = current_time + pd.DateOffset(**interval)  # Calculate the end time based on the user-specified interval
-    for _, row in df.iterrows():
-        job_name = row['job_name']
-        if tasks != ['all'] and job_name not in tasks:  # Skip tasks that are not in the specified list
+# Width, in pixels, of the time axis; runs of the same row closer together than one pixel are drawn as a single band
+CHART_WIDTH = 1600
+
+# Largest number of bars drawn in one chart; the bands are merged further until the chart fits
+MAX_BARS = 20000
+
+# Number of time buckets of the density heatmap
+HEATMAP_BUCKETS = 200
+
+# Height, in pixels, of a row of the WebGL chart and bounds of the height of the chart
+GL_ROW_HEIGHT = 14
+GL_MIN_HEIGHT = 450
+GL_MAX_HEIGHT = 4000
+
+# File extensions written as static images instead of HTML
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.svg', '.pdf')
+
+
+@instrumentation.stage('gantt_bars', rows=len)
+def gantt_bars(table, task_names, categories, start_time, end_time, group_by='job', width=CHART_WIDTH, max_bars=MAX_BARS):
+    """
+    Turn the runs of an occurrence table into the bars of the chart, merging runs that would overlap on screen.
+
+    Parameters:
+    - table (OccurrenceTable): The runs of every job, with their end times.
+    - task_names (numpy array): Name of each job of the table.
+    - categories (numpy array): Category of each job of the table.
+    - start_time (pandas Timestamp): Start of the chart window.
+    - end_time (pandas Timestamp): End of the chart window.
+    - group_by (str): 'job' for one row per job, 'category' for one row per category. Default is 'job'.
+    - width (int): Width of the time axis in pixels, or None to draw every run. Default is CHART_WIDTH.
+    - max_bars (int): Largest number of bars to return, or None for no limit; only exceeded when there are more
+      categories than bars. Default is MAX_BARS.
+
+    Returns:
+    - pandas DataFrame: One bar per row with columns 'Start', 'Finish', 'Task', 'Category' and 'Runs'
+      (the number of runs merged into the bar).
+    """
+    import pandas as pd
+    task_codes, task_labels = pd.factorize(np.asarray(task_names))
+    category_codes, category_labels = pd.factorize(np.asarray(categories, dtype=str))
+    # Every job has a single category, so the category of a job's bar is the one of the job
+    job_category = np.zeros(len(task_labels), dtype=np.int64)
+    job_category[task_codes] = category_codes
+    if max_bars is not None and len(task_labels) > max_bars:
+        # Not even one bar per job fits, so draw one row per category
+        group_by = 'category'
+    rows = (task_codes if group_by == 'job' else category_codes)[table.job_index]
+    starts, ends, runs = table.starts, table.ends, np.ones(len(table), dtype=np.int64)
+
+    # Runs closer together than one pixel cannot be told apart, so they are merged into bands; the merge distance
+    # doubles until the chart fits in max_bars, merging the bands again rather than the runs, and rows fall back
+    # to categories if one band per job still does not fit
+    span = max(int(pd.Timestamp(end_time).value - pd.Timestamp(start_time).value), 1)
+    gap = None if width is None else span // width
+    while True:
+        if gap is not None:
+            rows, starts, ends, runs = schedule_intervals.merge_intervals_by_group(rows, starts, ends, gap, weights=runs)
+        if max_bars is None or len(starts) <= max_bars:
+            break
+        if gap is not None and gap >= span:
+            if group_by == 'category':
+                break
+            group_by, rows = 'category', job_category[rows]
+            continue
+        gap = span // max_bars if gap is None else max(gap * 2, span // max_bars)
+
+    if group_by == 'job':
+        tasks = pd.Categorical.from_codes(rows, categories=task_labels)
+        category = pd.Categorical.from_codes(job_category[rows], categories=category_labels)
+    else:
+        tasks = category = pd.Categorical.from_codes(rows, categories=category_labels)
+    return pd.DataFrame({'Start': starts.view('datetime64[ns]'), 'Finish': ends.view('datetime64[ns]'),
+                         'Task': tasks, 'Category': category, 'Runs': runs})
+
+
+@instrumentation.stage('gantt_density')
+def gantt_density(table, labels, start_time, end_time, buckets=HEATMAP_BUCKETS):
+    """
+    Count the runs starting in each time bucket of the chart window, for each row of the chart.
+
+    Parameters:
+    - table (OccurrenceTable): The runs of every job.
+    - labels (numpy array): Row label (job name or category) of each job of the table.
+    - start_time (pandas Timestamp): Start of the chart window.
+    - end_time (pandas Timestamp): End of the chart window.
+    - buckets (int): Number of time buckets. Default is HEATMAP_BUCKETS.
+
+    Returns:
+    - tuple: (bucket_starts, row_labels, counts) where counts is an int64 array of shape (rows, buckets).
+    """
+    import pandas as pd
+    codes, row_labels = pd.factorize(np.asarray(labels))
+    window_start = pd.Timestamp(start_time).value
+    span = max(int(pd.Timestamp(end_time).value - window_start), 1)
+    bucket = np.clip((table.starts - window_start) * buckets // span, 0, buckets - 1)
+    # One bincount over the (row, bucket) pairs fills the whole matrix
+    counts = np.bincount(codes[table.job_index].astype(np.int64) * buckets + bucket,
+                         minlength=len(row_labels) * buckets).reshape(len(row_labels), buckets)
+    bucket_starts = (window_start + np.arange(buckets, dtype=np.int64) * span // buckets).view('datetime64[ns]')
+    return bucket_starts, np.asarray(row_labels), counts
+
+
+@instrumentation.stage('gantt_gl_figure')
+def gantt_gl_figure(bars, title='Job Schedules'):
+    """
+    Draw the bars of gantt_bars as WebGL line segments, with one Scattergl trace per category.
+
+    Each bar is a horizontal segment from its start to its finish on the row of its task; the segments of a category
+    are separated by gaps in a single pair of x/y arrays, so the figure holds a few numeric arrays (sent to the browser
+    as binary) instead of one shape per bar, and the browser draws them on the GPU.
+
+    Parameters:
+    - bars (pandas DataFrame): The bars, with the 'Start', 'Finish', 'Task', 'Category' and 'Runs' columns of gantt_bars.
+    - title (str): Title of the chart. Default is 'Job Schedules'.
+
+    Returns:
+    - plotly.graph_objects.Figure: The chart.
+    """
+    import pandas as pd
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    tasks = pd.Categorical(bars['Task'])
+    categories = pd.Categorical(bars['Category'])
+    rows = tasks.codes.astype(np.float64)
+    # Date axes take milliseconds since the epoch
+    starts = bars['Start'].to_numpy('datetime64[ns]').view(np.int64) / 1e6
+    finishes = bars['Finish'].to_numpy('datetime64[ns]').view(np.int64) / 1e6
+    runs = bars['Runs'].to_numpy(dtype=np.float64)
+    colors = px.colors.sequential.Viridis
+    line_width = float(np.clip(GL_ROW_HEIGHT * 0.7, 1, 10))
+
+    fig = go.Figure()
+    for code, category in enumerate(categories.categories):
+        selected = categories.codes == code
+        if not selected.any():
             continue
-        schedule = row['schedule']
-        duration = row['duration'].total_seconds() / 60  # Convert duration to minutes
-        category = row['category']
-        # Use croniter to parse the crontab schedule and generate a list of start times
-        cron = croniter.croniter(schedule, current_time)
-        start_times = []
-        # Convert the float value returned by croniter.get_next() to a Timestamp object
-        next_time = pd.Timestamp.fromtimestamp(cron.get_next())
-        while next_time < end_time:
-            start_times.append(next_time)
-            next_time = pd.Timestamp.fromtimestamp(cron.get_next())
-        # Create end times by adding the duration to each start time
-        end_times = [t + pd.DateOffset(minutes=duration) for t in start_times]
-        # Create a list of dictionaries from the start and end times and task name
-        task_schedules = [{'Start': start, 'Finish': end, 'Task': job_name, 'Category': category} for start, end in zip(start_times, end_times)]
-        job_schedules.extend(task_schedules)
-    
-    # Create the gantt chart using plotly.express
-    fig = px.timeline(job_schedules, x_start='Start', x_end='Finish', y='Task', title='Job Schedules', 
-                      color='Category', color_discrete_sequence=px.colors.sequential.Viridis
-                      )
-    # Save the chart to an HTML file
-    offline.plot(fig, filename='gantt_chart.html')
-    
-    # Show the chart
-    fig.show()
-
-
-
-# Example usage
-functions_path = './functions.csv'
-dags_path = './dags.csv'
-priority_path = '.priority.csv'
-df = data_preprocessor.main(functions_path,dags_path,priority_path)
-df = pd.DataFrame({'job_name': functions['job_name'], 'schedule': functions['schedule'], 'duration': functions['avg_runtime'], 'category': functions['category']})
-
-# Ask the user for the interval
-interval = {}
-tasks = []
-print("Enter the interval for the gantt chart (e.g. days=7, weeks=2, months=1):")
-interval_input = input()
-for item in interval_input.split(','):
-    key, value = item.split('=')
-    interval[key.strip()] = int(value.strip())
-print("Enter the names of the tasks to include in the chart, separated by commas (or enter 'all' to include all tasks):")
-tasks_input = input()
-if tasks_input == 'all':
-    tasks = ['all']
-else:
-    tasks = [task.strip() for task in tasks_input.split(',')]
-
-create_gantt_chart(df, interval, tasks)
\ No newline at end of file
+        # start, finish, gap for every bar of the category
+        x = np.full((selected.sum(), 3), np.nan)
+        y = np.full((selected.sum(), 3), np.nan)
+        x[:, 0], x[:, 1] = starts[selected], finishes[selected]
+        y[:, 0] = y[:, 1] = rows[selected]
+        fig.add_trace(go.Scattergl(x=x.ravel(), y=y.ravel(), customdata=np.repeat(runs[selected], 3), mode='lines',
+                                   name=str(category), connectgaps=False,
+                                   line={'width': line_width, 'color': colors[code % len(colors)]},
+                                   hovertemplate='%{x}<br>Runs: %{customdata}<extra>' + str(category) + '</extra>'))
+    height = int(np.clip(len(tasks.categories) * GL_ROW_HEIGHT + 150, GL_MIN_HEIGHT, GL_MAX_HEIGHT))
+    fig.update_layout(title=title, height=height, legend_title_text='Category',
+                      xaxis={'type': 'date'},
+                      yaxis={'tickmode': 'array', 'tickvals': np.arange(len(tasks.categories)),
+                             'ticktext': [str(task) for task in tasks.categories], 'autorange': 'reversed'})
+    return fig
+
+
+@instrumentation.stage('create_gantt_chart')
+def create_gantt_chart(df, interval, tasks, workers=None, mode='bars', group_by='job', width=CHART_WIDTH,
+                       max_bars=MAX_BARS, buckets=HEATMAP_BUCKETS, percentile=None, filename='gantt_chart.html', show=True):
+    """
+    Draw the runs of the tasks from now until the end of the interval and render the chart.
+
+    Parameters:
+    - df (pandas DataFrame): The tasks, with 'job_name', 'schedule', 'category' and 'duration' columns.
+    - interval (dict): Length of the chart window, as pandas.DateOffset arguments (e.g. {'days': 7}).
+    - tasks (list): Names of the tasks to draw, or ['all'].
+    - workers (int): Number of processes the schedules are expanded with. Default is a single process.
+    - mode (str): 'bars' for a plotly.express timeline, 'gl' for WebGL bars (gantt_gl_figure), which stay fast with
+      many bars, or 'heatmap' for the number of runs starting in each time bucket. Default is 'bars'.
+    - group_by, width, max_bars: See gantt_bars. buckets: See gantt_density.
+    - percentile (float): Draw the runs with this percentile of the tasks' runtimes instead of 'duration' (see
+      data_preprocessor.get_runtimes). Default is None.
+    - filename, show: See render_chart.
+
+    Returns:
+    - plotly.graph_objects.Figure: The chart.
+    """
+    import pandas as pd
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    # Keep only the tasks in the specified list
+    if tasks != ['all']:
+        df = df[df['job_name'].isin(tasks)]
+    current_time = pd.Timestamp(time_zones.utc_now())
+    end_time = current_time + pd.DateOffset(**interval)  # Calculate the end time based on the user-specified interval
+    # Generate all the runs of all the schedules within the chart window in one batched call, optionally
+    # spread over several processes, as compact int64 start/end arrays with each task's duration added (at the given
+    # percentile of its runtimes when the tasks have runtime percentile columns)
+    durations = data_preprocessor.get_runtimes(df, percentile, mean_column='duration')
+    table = cron_occurrences.OccurrenceTable.from_schedules(df['schedule'], current_time + pd.Timedelta(microseconds=1), end_time,
+                                                            runtimes=durations.to_numpy('timedelta64[ns]'), workers=workers)
+
+    if mode == 'heatmap':
+        # Draw how many runs start in each time bucket instead of the runs themselves
+        labels = df['job_name'] if group_by == 'job' else df['category'].astype(str)
+        bucket_starts, row_labels, counts = gantt_density(table, labels.to_numpy(), current_time, end_time, buckets)
+        fig = go.Figure(go.Heatmap(x=bucket_starts, y=row_labels, z=counts, colorscale='Viridis', colorbar={'title': 'Runs'}))
+        fig.update_layout(title='Job Schedules')
+    else:
+        # Collect the bars as columns of the chart data, with runs too close to be told apart merged into bands
+        job_schedules = gantt_bars(table, df['job_name'].to_numpy(), df['category'].to_numpy(), current_time, end_time,
+                                   group_by, width, max_bars)
+
+        if mode == 'gl':
+            fig = gantt_gl_figure(job_schedules)
+        else:
+            # Create the gantt chart using plotly.express
+            fig = px.timeline(job_schedules, x_start='Start', x_end='Finish', y='Task', title='Job Schedules',
+                              color='Category', color_discrete_sequence=px.colors.sequential.Viridis, hover_data=['Runs']
+                              )
+    render_chart(fig, filename, show)
+    return fig
+
+
+@instrumentation.stage('render_chart')
+def render_chart(fig, filename='gantt_chart.html', show=True):
+    """
+    Render the chart once: write it to a file and open that file, or only show it when filename is None.
+
+    Parameters:
+    - fig (plotly Figure): The chart.
+    - filename (str): File the chart is written to; '.png', '.svg', '.pdf' and the other IMAGE_EXTENSIONS write a
+      static image (which needs the kaleido package), anything else an HTML file. None writes no file.
+      Default is 'gantt_chart.html'.
+    - show (bool): Whether to open the chart, in the browser for HTML files. Default is True.
+    """
+    import plotly.offline as offline
+
+    if filename is None:
+        if show:
+            fig.show()
+    elif filename.lower().endswith(IMAGE_EXTENSIONS):
+        # Static images are drawn without the browser, and not opened
+        fig.write_image(filename)
+    else:
+        # Save the chart to an HTML file, opening it rather than rendering the figure a second time
+        offline.plot(fig, filename=filename, auto_open=show)
+
+
+def main(functions_path='./functions.csv', dags_path='./dags.csv', priority_path='./priority.csv', table_path=None, percentile=None,
+         mode='bars', filename='gantt_chart.html', show=True):
+    import pandas as pd
+
+    # Load the tasks (or the job table written by metadata_loader) and keep the columns the chart needs
+    cron_data = data_preprocessor.main(functions_path, dags_path, priority_path, table_path=table_path)
+    df = pd.DataFrame({'job_name': cron_data['job_name'], 'schedule': cron_data['schedule'], 'duration': cron_data['avg_runtime'], 'category': cron_data['category']})
+    for column in data_preprocessor.percentile_columns():
+        if column in cron_data.columns:
+            df[column] = cron_data[column]
+
+    # Ask the user for the interval
+    interval = {}
+    tasks = []
+    print("Enter the interval for the gantt chart (e.g. days=7, weeks=2, months=1):")
+    interval_input = input()
+    for item in interval_input.split(','):
+        key, value = item.split('=')
+        interval[key.strip()] = int(value.strip())
+    print("Enter the names of the tasks to include in the chart, separated by commas (or enter 'all' to include all tasks):")
+    tasks_input = input()
+    if tasks_input == 'all':
+        tasks = ['all']
+    else:
+        tasks = [task.strip() for task in tasks_input.split(',')]
+
+    create_gantt_chart(df, interval, tasks, mode=mode, percentile=percentile, filename=filename, show=show)
+
+
+def parse_args(argv=None):
+    """
+    Reads the paths of the datasets, or of a job table, the runtime percentile and how the chart is drawn and rendered from the command line and returns them as keyword arguments of main.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Draw a Gantt chart of the runs of the tasks.')
+    parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+    parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+    parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+    parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+    parser.add_argument('--percentile', type=float,
+                        help='draw every run with this percentile of its runtimes (e.g. 99) instead of the average runtime')
+    parser.add_argument('--mode', choices=['bars', 'gl', 'heatmap'], default='bars',
+                        help='plotly.express bars, WebGL bars that stay fast with many bars, or a heatmap of the runs per time bucket')
+    parser.add_argument('--output', default='gantt_chart.html',
+                        help='file the chart is written to; .png, .svg and .pdf write a static image')
+    parser.add_argument('--no-show', dest='show', action='store_false', help='write the chart without opening it')
+    args = parser.parse_args(argv)
+    return {'functions_path': args.functions, 'dags_path': args.dags, 'priority_path': args.priority, 'table_path': args.table,
+            'percentile': args.percentile, 'mode': args.mode, 'filename': args.output, 'show': args.show}
+
+
+if __name__ == '__main__':
+    main(**parse_args())
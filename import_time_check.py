@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+
+
+# Maximum time, in milliseconds, importing each module may take in a fresh interpreter (numpy is the only heavy import allowed)
+IMPORT_TIME_BUDGETS = {
+    'cron_occurrences': 200,
+    'schedule_intervals': 200,
+    'time_zones': 200,
+    'schedule_index': 200,
+    'cron_placement': 200,
+    'load_profile': 200,
+    'synthetic_data': 200,
+    'benchmark': 200,
+    'instrumentation': 200,
+    'data_preprocessor': 200,
+    'metadata_loader': 200,
+    'cron_schedule_lookup': 200,
+    'cron_task_scheduler': 200,
+    'cron_daemon': 200,
+    'cron_rescheduler': 200,
+    'query_server': 200,
+    'gantt_chart_generator': 200,
+}
+
+# Heavy libraries that must only be imported when a function needs them
+LAZY_MODULES = ['pandas', 'plotly', 'pytz', 'croniter', 'psycopg2']
+
+# Number of fresh interpreters each module is imported in; the fastest run is kept
+RUNS = 5
+
+MEASURE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+print(elapsed, ','.join(name for name in {lazy!r} if name in sys.modules))
+"""
+
+
+def measure_import(module):
+    """
+    Import a module in a fresh interpreter and return the time it took (in milliseconds) and the lazy modules it pulled in.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, '-c', MEASURE.format(module=module, lazy=LAZY_MODULES)],
+                            cwd=here, capture_output=True, text=True, check=True).stdout.split()
+    return float(output[0]), output[1].split(',') if len(output) > 1 else []
+
+
+def check_import_times(budgets=IMPORT_TIME_BUDGETS, runs=RUNS):
+    """
+    Check every module against its import-time budget and print a report.
+
+    Returns:
+    - bool: True if every module is within its budget and imports none of the lazy modules.
+    """
+    ok = True
+    for module, budget in budgets.items():
+        results = [measure_import(module) for _ in range(runs)]
+        elapsed = min(elapsed for elapsed, _ in results)
+        eager = results[0][1]
+        passed = elapsed <= budget and not eager
+        ok = ok and passed
+        print("{:<24} {:7.1f} ms (budget {} ms){}{}".format(module, elapsed, budget,
+                                                         '' if not eager else ', imports ' + ', '.join(eager),
+                                                         '' if passed else '  FAILED'))
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_import_times() else 1)
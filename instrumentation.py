@@ -0,0 +1,186 @@
+import atexit
+import functools
+import json
+import os
+import time
+
+
+# Environment variables enabling the instrumentation without changing any code: the path the JSON report is
+# written to when the process exits, and a comma-separated list of stages to profile with cProfile
+REPORT_ENV = 'CRON_INSTRUMENTATION'
+PROFILE_ENV = 'CRON_PROFILE'
+
+_enabled = False
+_stats = {}
+_caches = {}
+_profile_stages = set()
+_profile_dir = '.'
+_profilers = {}
+_profiling = False
+
+
+def stage(name, **counters):
+    """
+    Decorates a function as a stage of the pipeline.
+
+    While the instrumentation is disabled the wrapper only checks a flag and calls the function. Once enabled,
+    every call adds to the stage's number of calls and time, to each counter (computed from the result by the
+    given functions, e.g. rows=len) and to the hits and misses of every watched cache during the call.
+
+    Parameters:
+    - name (str): Name of the stage in the report.
+    - counters: Functions computing a number from the result of the function, keyed by the counter name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            return _run(name, counters, function, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, **values):
+    """
+    Adds values to the counters of a stage, for numbers only known inside a function. Does nothing while disabled.
+    """
+    if not _enabled:
+        return
+    counters = _stage_stats(name)['counters']
+    for key, value in values.items():
+        counters[key] = counters.get(key, 0) + value
+
+
+def watch_cache(name, cache_info):
+    """
+    Registers a cache whose hits and misses are reported per stage.
+
+    Parameters:
+    - name (str): Name of the cache in the report.
+    - cache_info (callable): Returns an object with hits and misses attributes, such as functools.lru_cache's cache_info.
+    """
+    _caches[name] = cache_info
+
+
+def enable(profile=(), profile_dir='.'):
+    """
+    Starts collecting the statistics of the stages.
+
+    Parameters:
+    - profile (iterable of str): Stages to run under cProfile; the profile of each stage is dumped to
+      <profile_dir>/<stage>.pstats by write_report (or dump_profiles). Default is no stage.
+    - profile_dir (str): Directory the .pstats files are written to. Default is the current directory.
+    """
+    global _enabled, _profile_stages, _profile_dir
+    _enabled = True
+    _profile_stages = set(profile)
+    _profile_dir = profile_dir
+
+
+def disable():
+    """
+    Stops collecting statistics; the ones already collected are kept until reset().
+    """
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Forgets the statistics and profiles collected so far.
+    """
+    _stats.clear()
+    _profilers.clear()
+
+
+def report():
+    """
+    Returns the statistics collected since the instrumentation was enabled.
+
+    Returns:
+    - dict: For each stage, its number of calls, total seconds, counters and the hits and misses of each watched cache.
+    """
+    return json.loads(json.dumps(_stats))
+
+
+def dump_profiles():
+    """
+    Writes the cProfile statistics of each profiled stage to <profile_dir>/<stage>.pstats.
+
+    Returns:
+    - list: The paths written.
+    """
+    paths = []
+    for name, profiler in _profilers.items():
+        path = os.path.join(_profile_dir, name.replace(' ', '_') + '.pstats')
+        profiler.dump_stats(path)
+        paths.append(path)
+    return paths
+
+
+def write_report(path):
+    """
+    Writes the report to a JSON file and dumps the profiles of the profiled stages.
+    """
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+    dump_profiles()
+
+
+def _stage_stats(name):
+    if name not in _stats:
+        _stats[name] = {'calls': 0, 'seconds': 0.0, 'counters': {}, 'caches': {}}
+    return _stats[name]
+
+
+def _cache_counts():
+    return {name: cache_info() for name, cache_info in _caches.items()}
+
+
+def _run(name, counters, function, args, kwargs):
+    global _profiling
+    before = _cache_counts()
+    # cProfile cannot nest, so a profiled stage called from another one is only timed
+    profiler = None
+    if name in _profile_stages and not _profiling:
+        import cProfile
+        profiler = _profilers.setdefault(name, cProfile.Profile())
+        _profiling = True
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            _profiling = False
+
+    stats = _stage_stats(name)
+    stats['calls'] += 1
+    stats['seconds'] += seconds
+    for key, counter in counters.items():
+        stats['counters'][key] = stats['counters'].get(key, 0) + int(counter(result))
+    for cache, info in _cache_counts().items():
+        totals = stats['caches'].setdefault(cache, {'hits': 0, 'misses': 0})
+        totals['hits'] += info.hits - before[cache].hits
+        totals['misses'] += info.misses - before[cache].misses
+    return result
+
+
+def _enable_from_environment():
+    # Enable the instrumentation for the whole process when the environment asks for it
+    path = os.environ.get(REPORT_ENV)
+    if not path:
+        return
+    profile = [name.strip() for name in os.environ.get(PROFILE_ENV, '').split(',') if name.strip()]
+    enable(profile, os.path.dirname(os.path.abspath(path)))
+    atexit.register(write_report, path)
+
+
+_enable_from_environment()
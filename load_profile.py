@@ -0,0 +1,191 @@
+import datetime
+import numpy as np
+import cron_occurrences
+import data_preprocessor
+import instrumentation
+import time_zones
+
+
+# Number of peak windows reported, and their length in minutes
+TOP_N = 10
+WINDOW_MINUTES = 60
+
+
+@instrumentation.stage('running_counts', minutes=lambda result: result.size)
+def running_counts(starts, minutes, groups, num_groups, total):
+    """
+    Counts the runs in progress during each minute with one difference array per group.
+
+    Each run adds 1 on its first minute and subtracts 1 after its last one; the cumulative sum of each row is
+    then the number of runs in progress. Runs are clipped to the [0, total) range of minutes.
+
+    Parameters:
+    - starts (numpy array): First minute of each run, as an int64 offset from the start of the range.
+    - minutes (numpy array): Number of minutes each run lasts.
+    - groups (numpy array): Group of each run, between 0 and num_groups - 1.
+    - num_groups (int): Number of groups.
+    - total (int): Number of minutes in the range.
+
+    Returns:
+    - numpy array: int64 array of shape (num_groups, total).
+    """
+    ends = starts + minutes
+    keep = (ends > 0) & (starts < total)
+    row = groups[keep].astype(np.int64) * (total + 1)
+    size = num_groups * (total + 1)
+    diff = (np.bincount(row + np.clip(starts[keep], 0, total), minlength=size)
+            - np.bincount(row + np.clip(ends[keep], 0, total), minlength=size))
+    return np.cumsum(diff.reshape(num_groups, total + 1)[:, :total], axis=1)
+
+
+def expand_runs(tasks, start_time, end_time, workers=None, percentile=None):
+    """
+    Expands the runs of the tasks that are in progress at some point between start_time and end_time.
+
+    Parameters:
+    - tasks (pandas DataFrame): The tasks, with 'schedule' and 'avg_runtime' columns.
+    - start_time (datetime): The start of the range, rounded down to the minute.
+    - end_time (datetime): The end of the range, rounded up to the minute.
+    - workers (int): Number of processes the expansion is spread over. Default is a single process.
+    - percentile (float): Make every run last this percentile of the task's runtimes instead of its average runtime
+      (see data_preprocessor.get_runtimes). Default is None, the average.
+
+    Returns:
+    - tuple: (origin, total, job_index, starts, minutes) where origin is the datetime64[m] start of the range, total
+      its number of minutes, and starts and minutes the first minute (offset from origin) and length in minutes of
+      every run of the job given by job_index. A run lasts at least the minute it starts in.
+    """
+    origin = np.datetime64(start_time, 'm')
+    total = int((np.datetime64(end_time, 's') - origin + np.timedelta64(59, 's')) // np.timedelta64(60, 's'))
+    runtimes = data_preprocessor.get_runtimes(tasks, percentile)
+    minutes = np.maximum(-(-runtimes.to_numpy('timedelta64[s]').astype(np.int64) // 60), 1)
+    longest = int(minutes.max()) if len(minutes) else 0
+
+    # Include the runs that started earlier and are still running at the start of the range
+    job_index, times = cron_occurrences.expand_jobs(tasks['schedule'], (origin - longest).astype(datetime.datetime),
+                                                    (origin + total).astype(datetime.datetime), workers=workers)
+    return origin, total, job_index, (times - origin).astype(np.int64), minutes[job_index]
+
+
+def concurrency_profile(tasks, start_time, end_time, by=None, workers=None, percentile=None):
+    """
+    Computes how many tasks are running during each minute between start_time and end_time.
+
+    Parameters:
+    - tasks (pandas DataFrame): The tasks from data_preprocessor, with 'schedule' and 'avg_runtime' columns (and the
+      columns given in by).
+    - start_time (datetime): The start of the range.
+    - end_time (datetime): The end of the range.
+    - by (str or list of str): Column(s) to break the counts down by, such as 'category' or ['category', 'priority'].
+      Default is no breakdown.
+    - workers (int): Number of processes the expansion is spread over. Default is a single process.
+    - percentile (float): Runtime percentile of the runs (see expand_runs). Default is None, the average runtime.
+
+    Returns:
+    - A pandas DataFrame indexed by minute with one column per group (a single 'running' column without by).
+    """
+    import pandas as pd
+
+    origin, total, job_index, starts, minutes = expand_runs(tasks, start_time, end_time, workers, percentile)
+    if by is None:
+        codes = np.zeros(len(tasks), dtype=np.int64)
+        columns = pd.Index(['running'])
+    else:
+        keys = [by] if isinstance(by, str) else list(by)
+        groups = tasks.groupby(keys, observed=True, sort=True)
+        codes = groups.ngroup().to_numpy(dtype=np.int64)
+        columns = pd.MultiIndex.from_tuples(list(groups.groups), names=keys) if len(keys) > 1 else pd.Index(list(groups.groups), name=keys[0])
+
+    counts = running_counts(starts, minutes, codes[job_index], len(columns), total)
+    index = pd.DatetimeIndex(origin + np.arange(total), name='minute')
+    return pd.DataFrame(counts.T, index=index, columns=columns)
+
+
+def peak_windows(profile, top_n=TOP_N, window=WINDOW_MINUTES):
+    """
+    Finds the top_n non-overlapping windows with the highest average number of running tasks.
+
+    Parameters:
+    - profile (pandas Series or DataFrame): A minute-resolution profile from concurrency_profile; the columns of a
+      DataFrame are added up first.
+    - top_n (int): Number of windows reported. Default is TOP_N.
+    - window (int): Length of the windows in minutes. Default is WINDOW_MINUTES.
+
+    Returns:
+    - A pandas DataFrame with the start, end, peak (largest number of running tasks), peak_time and mean of each
+      window, busiest first.
+    """
+    import pandas as pd
+
+    running = profile.sum(axis=1) if isinstance(profile, pd.DataFrame) else profile
+    values = running.to_numpy(dtype=np.int64)
+    window = max(min(window, len(values)), 1)
+    # Average of every window of consecutive minutes, from a cumulative sum
+    sums = np.cumsum(np.r_[0, values])
+    means = (sums[window:] - sums[:-window]) / window
+
+    windows = []
+    available = np.ones(len(means), dtype=bool)
+    for _ in range(top_n):
+        if not available.any():
+            break
+        first = int(np.argmax(np.where(available, means, -np.inf)))
+        # Windows overlapping the chosen one can no longer be chosen
+        available[max(first - window + 1, 0):first + window] = False
+        peak = first + int(np.argmax(values[first:first + window]))
+        windows.append({'start': running.index[first], 'end': running.index[first] + pd.Timedelta(minutes=window),
+                        'peak': int(values[peak]), 'peak_time': running.index[peak], 'mean': float(means[first])})
+    return pd.DataFrame(windows, columns=['start', 'end', 'peak', 'peak_time', 'mean'])
+
+
+def load_profile(tasks, start_time, end_time, top_n=TOP_N, window=WINDOW_MINUTES, workers=None, percentile=None):
+    """
+    Computes the running tasks per minute in total, by category and by priority, with the busiest windows.
+
+    With a percentile (e.g. 99), every run lasts that percentile of the task's runtimes instead of its average
+    runtime, which shows the load when the runs hit their tail durations.
+
+    Returns:
+    - dict: 'total', 'category' and 'priority' profiles (pandas DataFrames from concurrency_profile, all from a
+      single expansion) and the 'peaks' from peak_windows on the total.
+    """
+    import pandas as pd
+
+    origin, total, job_index, starts, minutes = expand_runs(tasks, start_time, end_time, workers, percentile)
+    index = pd.DatetimeIndex(origin + np.arange(total), name='minute')
+    profiles = {'total': pd.DataFrame(running_counts(starts, minutes, np.zeros(len(starts), dtype=np.int64), 1, total).T,
+                                      index=index, columns=['running'])}
+    for column in ('category', 'priority'):
+        codes, uniques = pd.factorize(tasks[column], sort=True)
+        counts = running_counts(starts, minutes, codes[job_index], len(uniques), total)
+        profiles[column] = pd.DataFrame(counts.T, index=index, columns=pd.Index(uniques, name=column))
+    profiles['peaks'] = peak_windows(profiles['total']['running'], top_n, window)
+    return profiles
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Report the busiest windows of concurrently running jobs.')
+    parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+    parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+    parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+    parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+    parser.add_argument('--days', type=int, default=7, help='days of runs profiled from now (default 7)')
+    parser.add_argument('--top-n', type=int, default=TOP_N, help='number of windows reported (default {})'.format(TOP_N))
+    parser.add_argument('--window', type=int, default=WINDOW_MINUTES,
+                        help='length of the windows in minutes (default {})'.format(WINDOW_MINUTES))
+    parser.add_argument('--workers', type=int, help='number of processes to expand the schedules with')
+    parser.add_argument('--percentile', type=float,
+                        help='make every run last this percentile of its runtimes (e.g. 99) instead of the average runtime')
+    args = parser.parse_args(argv)
+
+    cron_data = data_preprocessor.load_data(args.functions, args.dags, args.priority, table_path=args.table)
+    start_time = time_zones.utc_now().replace(second=0, microsecond=0)
+    end_time = start_time + datetime.timedelta(days=args.days)
+    profiles = load_profile(cron_data, start_time, end_time, args.top_n, args.window, args.workers, args.percentile)
+    print(profiles['peaks'].to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import datetime
+import io
+import json
+import sqlite3
+import time
+import numpy as np
+import data_preprocessor
+import instrumentation
+import time_zones
+
+
+# Days of run history the average runtimes are computed over
+HISTORY_DAYS = 30
+
+# File the job table is written to by the command line
+OUTPUT_PATH = './cron_data_db.npz'
+
+# Number of rows fetched from a cursor at a time
+FETCH_SIZE = 50000
+
+# Table names of the pg_cron and Airflow metadata in each dialect; SQLite has no schemas, so the pg_cron tables
+# of a fixture database are prefixed instead
+TABLES = {
+    'postgres': {'job': 'cron.job', 'job_run': 'cron.job_run_details', 'dag': 'dag', 'dag_run': 'dag_run'},
+    'sqlite': {'job': 'cron_job', 'job_run': 'cron_job_run_details', 'dag': 'dag', 'dag_run': 'dag_run'},
+}
+
+# Duration of a run in seconds, computed by the database
+DURATION_SECONDS = {
+    'postgres': "EXTRACT(epoch FROM {end} - {start})",
+    'sqlite': "(julianday({end}) - julianday({start})) * 86400.0",
+}
+
+# Bound parameter of the start of the run history
+SINCE_PARAMETER = {'postgres': '%(since)s', 'sqlite': ':since'}
+
+# Average and percentiles (nearest rank) of the durations of the successful runs of every job since the start of the
+# history, computed with window functions both Postgres and SQLite support
+RUNTIME_STATS = """
+WITH durations AS (
+    SELECT r.{key} AS {key}, {duration} AS seconds
+    FROM {runs} r
+    WHERE r.{state} = '{success}' AND r.{end} IS NOT NULL AND r.{start} >= {since}
+), ranked AS (
+    SELECT {key}, seconds, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY seconds) AS position,
+           COUNT(*) OVER (PARTITION BY {key}) AS num_runs
+    FROM durations
+)
+SELECT {key}, AVG(seconds) AS avg_seconds, {percentiles}
+FROM ranked
+GROUP BY {key}
+"""
+
+# Runtime statistics of every active pg_cron job
+FUNCTIONS_QUERY = """
+SELECT COALESCE(j.jobname, j.command) AS func_name, j.schedule AS schedule, {columns}
+FROM {job} j
+LEFT JOIN ({stats}) s ON s.jobid = j.jobid
+WHERE j.active
+ORDER BY j.jobid
+"""
+
+# Runtime statistics of every active, unpaused Airflow dag
+DAGS_QUERY = """
+SELECT d.dag_id AS dag_id, d.schedule_interval AS schedule, {columns}
+FROM {dag} d
+LEFT JOIN ({stats}) s ON s.dag_id = d.dag_id
+WHERE d.is_active AND NOT d.is_paused
+ORDER BY d.dag_id
+"""
+
+# Columns of the run tables of pg_cron and Airflow the statistics are computed from
+RUN_COLUMNS = {
+    'func_name': {'runs': 'job_run', 'key': 'jobid', 'state': 'status', 'success': 'succeeded', 'start': 'start_time',
+                  'end': 'end_time'},
+    'dag_id': {'runs': 'dag_run', 'key': 'dag_id', 'state': 'state', 'success': 'success', 'start': 'start_date',
+               'end': 'end_date'},
+}
+
+# Airflow schedules that are not crontab expressions; the dags using them are left out of the job table
+NON_CRON_SCHEDULES = {'@once', '@continuous', 'None', ''}
+
+# Tables of a SQLite fixture database, with the columns of pg_cron and Airflow the loader reads
+SQLITE_SCHEMA = """
+CREATE TABLE cron_job (jobid INTEGER PRIMARY KEY, jobname TEXT, command TEXT, schedule TEXT NOT NULL, active BOOLEAN NOT NULL DEFAULT 1);
+CREATE TABLE cron_job_run_details (runid INTEGER PRIMARY KEY, jobid INTEGER NOT NULL, status TEXT, start_time TEXT, end_time TEXT);
+CREATE INDEX cron_job_run_details_jobid ON cron_job_run_details (jobid, start_time);
+CREATE TABLE dag (dag_id TEXT PRIMARY KEY, schedule_interval TEXT, is_active BOOLEAN NOT NULL DEFAULT 1, is_paused BOOLEAN NOT NULL DEFAULT 0);
+CREATE TABLE dag_run (id INTEGER PRIMARY KEY, dag_id TEXT NOT NULL, state TEXT, start_date TEXT, end_date TEXT);
+CREATE INDEX dag_run_dag_id ON dag_run (dag_id, start_date);
+"""
+
+
+@instrumentation.stage('load_from_database', rows=len)
+def load_from_database(connection, priority_path=None, dialect=None, since=None, airflow_connection=None):
+    """
+    Builds the merged job table of data_preprocessor from the pg_cron and Airflow metadata, instead of exports.
+
+    The average runtime of each job and its percentiles (data_preprocessor.RUNTIME_PERCENTILES) are computed by the
+    database over its succeeded runs since the start of the history, so only one row per job is transferred. On Postgres the rows are read with COPY when the driver
+    supports it (psycopg2), otherwise with a server-side cursor.
+
+    Parameters:
+    - connection: A DB-API connection to the database holding the pg_cron tables (psycopg2, psycopg or sqlite3).
+    - priority_path (str): Path of the "priority" dataset. Default is None, which gives every job priority 5.
+    - dialect (str): 'postgres' or 'sqlite'. Default is None, which is 'sqlite' for sqlite3 connections and
+      'postgres' otherwise.
+    - since (datetime): Start of the run history, naive in UTC or time zone aware. Default is HISTORY_DAYS days ago.
+    - airflow_connection: A connection to the Airflow metadata database, when it is not the same database.
+
+    Returns:
+    - pandas DataFrame: The job table, in the same format as data_preprocessor.process_data, plus the
+      'runtime_p50', 'runtime_p90' and 'runtime_p99' columns. Jobs with no run in the history have NaT runtimes.
+    """
+    import pandas as pd
+
+    if since is None:
+        since = time_zones.utc_now() - datetime.timedelta(days=HISTORY_DAYS)
+    if priority_path is not None:
+        priority = data_preprocessor.read_priority(priority_path)
+    else:
+        priority = pd.Series(dtype='Int64')
+
+    chunks = []
+    for name_column, conn in (('func_name', connection), ('dag_id', airflow_connection or connection)):
+        conn_dialect = dialect or _dialect(conn)
+        jobs = read_query(conn, _format_query(name_column, conn_dialect), {'since': _since(since, conn_dialect)}, conn_dialect)
+        if name_column == 'dag_id':
+            jobs['schedule'] = airflow_schedules(jobs['schedule'])
+            jobs = jobs[jobs['schedule'].notna()]
+        jobs = jobs.astype({name_column: 'str', 'schedule': 'str'})
+        jobs = jobs.assign(**{column: pd.to_timedelta(pd.to_numeric(jobs[seconds]), unit='s').astype('timedelta64[ns]')
+                              for column, seconds in zip(['avg_runtime'] + data_preprocessor.percentile_columns(), _stat_columns())})
+        chunks.append(data_preprocessor.merge_jobs(jobs, name_column, priority))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_query(connection, query, params, dialect):
+    """
+    Reads the rows of a query into a pandas DataFrame, with COPY on psycopg2 connections and a cursor fetching
+    FETCH_SIZE rows at a time (server-side on Postgres) otherwise.
+    """
+    import pandas as pd
+
+    if dialect == 'postgres':
+        cursor = connection.cursor()
+        if hasattr(cursor, 'copy_expert'):
+            # COPY streams the rows as CSV in one round trip; the parameters are bound by the driver beforehand
+            buffer = io.BytesIO()
+            cursor.copy_expert("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(
+                cursor.mogrify(query, params).decode()), buffer)
+            cursor.close()
+            buffer.seek(0)
+            return pd.read_csv(buffer, dtype={'func_name': 'str', 'dag_id': 'str', 'schedule': 'str'},
+                               keep_default_na=False, na_values={column: [''] for column in _stat_columns()})
+        cursor.close()
+        cursor = connection.cursor(name='metadata_loader')
+    else:
+        cursor = connection.cursor()
+    try:
+        cursor.execute(query, params)
+        columns = None
+        rows = []
+        while True:
+            batch = cursor.fetchmany(FETCH_SIZE)
+            if columns is None:
+                columns = [column[0] for column in cursor.description]
+            if not batch:
+                break
+            rows.extend(batch)
+    finally:
+        cursor.close()
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+
+def airflow_schedules(schedules):
+    """
+    Converts the schedule_interval column of the Airflow dag table to crontab expressions.
+
+    Airflow stores the schedule JSON-encoded ('"0 5 * * *"', 'null', or an object for timedelta schedules); the
+    schedules that are not crontab expressions or presets become None.
+    """
+    import pandas as pd
+
+    def convert(value):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        value = str(value).strip()
+        if value.startswith(('"', '{', 'null')):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return None
+        if not isinstance(value, str) or value.strip() in NON_CRON_SCHEDULES:
+            return None
+        return value.strip()
+
+    return pd.Series([convert(value) for value in schedules], index=schedules.index, dtype=object)
+
+
+def create_fixture(connection):
+    """
+    Creates the pg_cron and Airflow tables the loader reads in an empty SQLite database.
+    """
+    connection.executescript(SQLITE_SCHEMA)
+    connection.commit()
+
+
+def _dialect(connection):
+    return 'sqlite' if isinstance(connection, sqlite3.Connection) else 'postgres'
+
+
+def _format_query(name_column, dialect):
+    tables = TABLES[dialect]
+    columns = dict(RUN_COLUMNS[name_column])
+    duration = DURATION_SECONDS[dialect].format(start='r.' + columns['start'], end='r.' + columns['end'])
+    percentiles = ", ".join("MIN(CASE WHEN position >= {} * num_runs THEN seconds END) AS p{}_seconds".format(percentile / 100, percentile)
+                            for percentile in data_preprocessor.RUNTIME_PERCENTILES)
+    columns['runs'] = tables[columns['runs']]
+    stats = RUNTIME_STATS.format(duration=duration, since=SINCE_PARAMETER[dialect], percentiles=percentiles, **columns)
+    query = FUNCTIONS_QUERY if name_column == 'func_name' else DAGS_QUERY
+    columns = ", ".join("s." + column for column in _stat_columns())
+    return query.format(stats=stats.strip(), columns=columns, **tables)
+
+
+def _stat_columns():
+    return ['avg_seconds'] + ['p{}_seconds'.format(percentile) for percentile in data_preprocessor.RUNTIME_PERCENTILES]
+
+
+def _since(since, dialect):
+    # Naive datetimes are UTC like everywhere else. SQLite stores the timestamps as naive UTC ISO 8601 text, which
+    # compares in time order; Postgres gets an aware value, as a naive one would be read in the session time zone
+    # when compared with the timestamptz columns of pg_cron and Airflow
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return since.isoformat(sep=' ') if dialect == 'sqlite' else since.replace(tzinfo=datetime.timezone.utc)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the job table from the pg_cron and Airflow metadata databases.')
+    parser.add_argument('--dsn', help='connection string of the Postgres database holding the pg_cron tables')
+    parser.add_argument('--airflow-dsn', help='connection string of the Airflow metadata database, if it is another one')
+    parser.add_argument('--sqlite', help='path of a SQLite database with the same tables, instead of Postgres')
+    parser.add_argument('--priority', help='path to the "priority" dataset')
+    parser.add_argument('--days', type=int, default=HISTORY_DAYS,
+                        help='days of run history the average runtimes are computed over (default {})'.format(HISTORY_DAYS))
+    parser.add_argument('--output', default=OUTPUT_PATH,
+                        help='file the job table is written to, read back with data_preprocessor.read_table (default {})'.format(OUTPUT_PATH))
+    args = parser.parse_args(argv)
+    if (args.dsn is None) == (args.sqlite is None):
+        parser.error('exactly one of --dsn and --sqlite is required')
+
+    if args.sqlite is not None:
+        connection, airflow_connection = sqlite3.connect(args.sqlite), None
+    else:
+        import psycopg2
+        connection = psycopg2.connect(args.dsn)
+        airflow_connection = psycopg2.connect(args.airflow_dsn) if args.airflow_dsn else None
+
+    start = time.perf_counter()
+    since = time_zones.utc_now() - datetime.timedelta(days=args.days)
+    try:
+        cron_data = load_from_database(connection, args.priority, since=since, airflow_connection=airflow_connection)
+    finally:
+        connection.close()
+        if airflow_connection is not None:
+            airflow_connection.close()
+    data_preprocessor.write_table(cron_data, args.output)
+    print("Loaded {} jobs in {:.2f} s, written to {}".format(len(cron_data), time.perf_counter() - start, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+import datetime
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import numpy as np
+import cron_occurrences
+import cron_schedule_lookup
+import cron_task_scheduler
+import data_preprocessor
+import instrumentation
+import schedule_index
+import schedule_intervals
+import time_zones
+
+
+# Days after the current one the runs are kept expanded for; queries outside the warm horizon (which also covers
+# the previous day) are answered by the functions of the scripts, as if run from the command line
+HORIZON_DAYS = 7
+
+# Seconds between two checks of the datasets for changes
+RELOAD_SECONDS = 5
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 64 * 2**20
+
+
+class ServerState:
+    """
+    The job table with everything the queries need kept warm: the inverted index of schedule_index, the runs of
+    every job over the horizon sorted by start time, the busy intervals (in total and by category) and the runs
+    of the priority jobs. A state is never modified once built; reloading builds a new one.
+
+    Parameters:
+    - cron_data (pandas DataFrame): The job table from data_preprocessor.
+    - now (datetime): The current UTC time; the horizon covers its day, the previous one and HORIZON_DAYS more.
+      Default is now.
+    - days (int): Number of days of the horizon after the current one. Default is HORIZON_DAYS.
+    - index_path (str): File the inverted index is persisted to, or None to keep it in memory only.
+    """
+
+    def __init__(self, cron_data, now=None, days=HORIZON_DAYS, index_path=schedule_index.INDEX_PATH):
+        import pandas as pd
+
+        if now is None:
+            now = time_zones.utc_now()
+        self.cron_data = cron_data
+        self.job_names = cron_data['job_name'].to_numpy(dtype=object)
+        # The JSON encoding of every job name, joined into the answers listing jobs instead of encoding them each time
+        self.encoded_names = np.array([json.dumps(name).encode() for name in self.job_names.tolist()], dtype=object)
+        self.index = schedule_index.load_index(cron_data, index_path)
+        self.loaded_at = now
+        day = np.datetime64(now, 'D')
+        self.horizon_start = (day - 1).astype('datetime64[ns]')
+        self.horizon_end = (day + days + 1).astype('datetime64[ns]')
+
+        runtimes = pd.to_timedelta(cron_data['avg_runtime']).fillna(pd.Timedelta(0)).to_numpy('timedelta64[ns]')
+        self.runtimes = runtimes
+        self.longest = runtimes.max() if len(runtimes) else np.timedelta64(0, 'ns')
+        # The runs started early enough to still be running at the start of the horizon are kept too
+        table = cron_occurrences.OccurrenceTable.from_schedules(cron_data['schedule'], self.horizon_start - self.longest,
+                                                                self.horizon_end, runtimes=runtimes)
+        order = np.argsort(table.starts, kind='stable')
+        self.starts = table.starts[order]
+        self.ends = table.ends[order]
+        self.jobs = table.job_index[order]
+        self._local = {}
+
+        # Busy intervals for the free time queries
+        self.categories = list(pd.unique(cron_data['category']))
+        codes = np.asarray(pd.Categorical(cron_data['category'], categories=self.categories).codes)[self.jobs]
+        self.busy = {None: schedule_intervals.merge_intervals(self.starts, self.ends)}
+        for code, category in enumerate(self.categories):
+            self.busy[category] = schedule_intervals.merge_intervals(self.starts[codes == code], self.ends[codes == code])
+
+        # Runs of the priority jobs for the overlap queries, their starts and ends sorted separately
+        in_priority = (cron_data['priority'].to_numpy() != 5)[self.jobs]
+        self.priority_starts = np.sort(self.starts[in_priority])
+        self.priority_ends = np.sort(self.ends[in_priority])
+
+    def __len__(self):
+        return len(self.job_names)
+
+    def covers(self, start, end):
+        # Whether a UTC range lies within the warm horizon
+        return np.datetime64(start, 'ns') >= self.horizon_start and np.datetime64(end, 'ns') <= self.horizon_end
+
+    def datetimes(self, query):
+        """
+        The get_task_datetimes-equivalent query: the runs of every job within the time interval and date range.
+
+        The query has the keys 'start_date', 'end_date', 'time_interval' and optionally 'time_zone' and 'jobs' (a
+        list of job names to restrict the answer to). Returns a dict of lists of 'YYYY-MM-DD HH:MM' local datetimes
+        by job name, for the jobs that run at least once.
+        """
+        zone = time_zones.get_zone(query.get('time_zone'))
+        start_date, end_date = _parse_time(query['start_date']), _parse_time(query['end_date'])
+        window_start, window_end = cron_schedule_lookup._window(start_date, end_date, zone)
+        time_interval = tuple(query['time_interval'])
+        if not self.covers(window_start, window_end):
+            table = cron_schedule_lookup.get_task_occurrences(self.cron_data, start_date, end_date, time_interval, zone)
+            jobs, times = table.job_index, table.start_times()
+        else:
+            first, last = np.searchsorted(self.starts, [np.datetime64(window_start, 'ns').view(np.int64),
+                                                        np.datetime64(window_end, 'ns').view(np.int64)])
+            local = self._local_starts(zone)[first:last]
+            keep = cron_schedule_lookup._in_time_interval((local // (3600 * 10**9)) % 24, time_interval)
+            jobs, times = self.jobs[first:last][keep], local[keep].view('datetime64[ns]')
+        if query.get('jobs') is not None:
+            keep = np.isin(self.job_names[jobs], list(query['jobs']))
+            jobs, times = jobs[keep], times[keep]
+        # Group the runs by job, in the order of the job table
+        order = np.lexsort((times, jobs))
+        jobs, times = jobs[order], cron_schedule_lookup._format_datetimes(times[order])
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(jobs)) + 1, [len(jobs)]]) if len(jobs) else []
+        return {self.job_names[jobs[first]]: times[first:last] for first, last in zip(bounds[:-1], bounds[1:])}
+
+    def jobs_between(self, query):
+        """
+        The names of the jobs that run at least once within the time interval and date range, from the index.
+        """
+        return self.index.job_names_of(self.job_ids_between(query)).tolist()
+
+    def job_ids_between(self, query):
+        """
+        The sorted row numbers of the jobs answered by jobs_between.
+        """
+        return self.index.query(_parse_time(query['start_date']), _parse_time(query['end_date']),
+                                tuple(query['time_interval']), query.get('time_zone'))
+
+    def running(self, query):
+        """
+        The names of the jobs running at a moment ('time', on the wall clock of the optional 'time_zone').
+        """
+        return self.job_names[self.running_job_ids(query)].tolist()
+
+    def running_job_ids(self, query):
+        """
+        The sorted row numbers of the jobs answered by running.
+        """
+        moment = np.datetime64(time_zones.to_utc(_parse_time(query['time']), query.get('time_zone')), 'ns')
+        if not self.covers(moment, moment):
+            table = cron_occurrences.OccurrenceTable.from_schedules(
+                self.cron_data['schedule'], moment - self.longest, moment + np.timedelta64(1, 'm'),
+                runtimes=self.runtimes)
+            starts, ends, jobs = table.starts, table.ends, table.job_index
+        else:
+            first, last = np.searchsorted(self.starts, [(moment - self.longest).view(np.int64), moment.view(np.int64)],
+                                          side='right')
+            starts, ends, jobs = self.starts[first:last], self.ends[first:last], self.jobs[first:last]
+        value = moment.view(np.int64)
+        # Flag the jobs rather than np.unique their runs: a long runtime keeps many runs of a job in the scan
+        running = np.zeros(len(self.job_names), dtype=bool)
+        running[jobs[(starts <= value) & (ends > value)]] = True
+        return np.flatnonzero(running)
+
+    def free_times(self, query):
+        """
+        The find_free_times-equivalent query: the gaps between the runs within 'start_time' and 'end_time'
+        (UTC), by category when 'consider_category' is true, of at least 'min_minutes' minutes (default 0).
+
+        Returns a list of dicts with 'start_time', 'end_time' (and 'category').
+        """
+        start, end = _parse_time(query['start_time']), _parse_time(query['end_time'])
+        consider_category = bool(query.get('consider_category', False))
+        min_length = np.timedelta64(int(round(float(query.get('min_minutes', 0)) * 60)), 's')
+        if not self.covers(start, end):
+            # An empty table gives an empty (but typed) frame, so there is no group and no free time by category
+            free = cron_task_scheduler.find_free_times(self.cron_data, start, end, consider_category)
+            groups = free.groupby('category', sort=False) if consider_category else [(None, free)]
+            gaps = [(category, group['start_time'].to_numpy('datetime64[ns]'), group['end_time'].to_numpy('datetime64[ns]'))
+                    for category, group in groups]
+        else:
+            gaps = []
+            window_start, window_end = np.datetime64(start, 'ns').view(np.int64), np.datetime64(end, 'ns').view(np.int64)
+            for category in (self.categories if consider_category else [None]):
+                busy_starts, busy_ends = self.busy[category]
+                # Only the busy intervals overlapping the window matter
+                first = np.searchsorted(busy_ends, window_start, side='right')
+                last = np.searchsorted(busy_starts, window_end, side='left')
+                free_starts, free_ends = schedule_intervals.free_gaps(busy_starts[first:last], busy_ends[first:last],
+                                                                      window_start, window_end)
+                gaps.append((category, free_starts.view('datetime64[ns]'), free_ends.view('datetime64[ns]')))
+        results = []
+        for category, free_starts, free_ends in gaps:
+            keep = free_ends - free_starts >= min_length
+            for free_start, free_end in zip(np.datetime_as_string(free_starts[keep], unit='s'),
+                                            np.datetime_as_string(free_ends[keep], unit='s')):
+                result = {'start_time': str(free_start), 'end_time': str(free_end)}
+                if consider_category:
+                    result['category'] = category
+                results.append(result)
+        return results
+
+    def priority_check(self, query):
+        """
+        The priority_check-equivalent query: for each of the crontab 'schedules', the number of its runs between
+        'start_time' and 'end_time' (UTC, default the next day) that start while a priority job is running.
+        """
+        start = _parse_time(query.get('start_time', 'now'))
+        end = _parse_time(query['end_time']) if query.get('end_time') else start + datetime.timedelta(days=1)
+        schedules = list(query['schedules'])
+        if not self.covers(start, end):
+            jobs = self.cron_data[self.cron_data['priority'] != 5]
+            return cron_task_scheduler.count_overlaps(schedules, jobs, start, end).tolist()
+        job_index, times = cron_occurrences.expand_jobs(schedules, start, end)
+        points = times.astype('datetime64[ns]').view(np.int64)
+        # Every priority run that started before a point contains it, unless it also ended before it
+        counts = (np.searchsorted(self.priority_starts, points, side='left')
+                  - np.searchsorted(self.priority_ends, points, side='left'))
+        return np.bincount(job_index, weights=counts, minlength=len(schedules)).astype(np.int64).tolist()
+
+    def _local_starts(self, zone):
+        # The sorted starts projected onto a time zone, computed once per zone
+        name = time_zones.zone_name(zone)
+        if name not in self._local:
+            self._local[name] = time_zones.to_local(self.starts.view('datetime64[ns]'), zone).view(np.int64)
+        return self._local[name]
+
+
+class QueryServer:
+    """
+    Answers schedule queries from a warm ServerState, reloading it when the datasets change.
+
+    Every endpoint takes a JSON body holding either one query or {"queries": [...]} and answers {"result": ...}
+    or {"results": [...]} respectively:
+
+    - /datetimes: runs of every job within a time interval and date range (see ServerState.datetimes)
+    - /jobs: names of the jobs running within a time interval and date range (ServerState.jobs_between)
+    - /running: names of the jobs running at a moment (ServerState.running)
+    - /free_times: free times between the runs (ServerState.free_times)
+    - /priority_check: overlaps of crontab schedules with the priority jobs (ServerState.priority_check)
+
+    GET /status reports the size of the job table, the horizon and the number of reloads and queries.
+
+    Parameters:
+    - functions_path, dags_path, priority_path (str): Paths of the datasets.
+    - days (int): Number of days of the warm horizon. Default is HORIZON_DAYS.
+    - cache_path (str): Binary cache of the job table (see data_preprocessor.load_data).
+    - index_path (str): File the inverted index is persisted to.
+    - table_path (str): Job table stored by data_preprocessor.write_table (e.g. by metadata_loader), read and watched
+      instead of the datasets. Default is None.
+    """
+
+    ENDPOINTS = {'/datetimes': 'datetimes', '/jobs': 'jobs_between', '/running': 'running', '/free_times': 'free_times',
+                 '/priority_check': 'priority_check'}
+
+    # Endpoints answering lists of job names, and the ServerState methods giving the row numbers of those jobs
+    JOB_LIST_ENDPOINTS = {'/jobs': 'job_ids_between', '/running': 'running_job_ids'}
+
+    def __init__(self, functions_path, dags_path, priority_path, days=HORIZON_DAYS, cache_path=data_preprocessor.CACHE_PATH,
+                 index_path=schedule_index.INDEX_PATH, table_path=None):
+        self.paths = [functions_path, dags_path, priority_path]
+        self.table_path = table_path
+        self.days = days
+        self.cache_path = cache_path
+        self.index_path = index_path
+        self.reloads = 0
+        self.queries = 0
+        self.state = None
+        self._signatures = None
+        self._stopped = threading.Event()
+        self.reload()
+
+    @instrumentation.stage('server_reload')
+    def reload(self, force=False):
+        """
+        Rebuilds the state if a dataset changed, the horizon is ending (less than a day left) or force is true.
+
+        Returns:
+        - bool: Whether the state was rebuilt. Queries keep being answered by the previous state meanwhile.
+        """
+        signatures = data_preprocessor.file_signatures([self.table_path] if self.table_path is not None else self.paths)
+        now = time_zones.utc_now()
+        if not force and self.state is not None and signatures == self._signatures \
+                and np.datetime64(now, 'ns') < self.state.horizon_end - np.timedelta64(1, 'D'):
+            return False
+        cron_data = data_preprocessor.load_data(*self.paths, cache_path=self.cache_path, table_path=self.table_path)
+        self.state = ServerState(cron_data, now, self.days, self.index_path)
+        self._signatures = signatures
+        self.reloads += 1
+        return True
+
+    def handle(self, endpoint, body):
+        """
+        Answers the body of a request to an endpoint.
+
+        Returns:
+        - dict: The answer, {"result": ...} for a single query or {"results": [...]} for a batch.
+        """
+        if endpoint == '/status':
+            state = self.state
+            return {'jobs': len(state), 'runs': len(state.starts), 'horizon_start': str(state.horizon_start),
+                    'horizon_end': str(state.horizon_end), 'loaded_at': str(state.loaded_at), 'reloads': self.reloads,
+                    'queries': self.queries}
+        if endpoint not in self.ENDPOINTS:
+            raise KeyError(endpoint)
+        # Every query of a batch is answered by the same state, even if a reload happens meanwhile
+        method = getattr(self.state, self.ENDPOINTS[endpoint])
+        if isinstance(body, dict) and 'queries' in body:
+            self.queries += len(body['queries'])
+            return {'results': [method(query) for query in body['queries']]}
+        self.queries += 1
+        return {'result': method(body)}
+
+    def encode(self, endpoint, body):
+        """
+        Answers the body of a request to an endpoint like handle, as the bytes of the JSON encoding of the answer.
+
+        Encoding the answer is most of the cost of a query returning thousands of job names, so the answers of
+        JOB_LIST_ENDPOINTS are joined from the encoded names kept by the state rather than encoded name by name;
+        the bytes are the same as json.dumps gives.
+        """
+        if endpoint not in self.JOB_LIST_ENDPOINTS:
+            return json.dumps(self.handle(endpoint, body)).encode()
+        state = self.state
+        method = getattr(state, self.JOB_LIST_ENDPOINTS[endpoint])
+
+        def names(query):
+            return b'[' + b', '.join(state.encoded_names[method(query)].tolist()) + b']'
+
+        if isinstance(body, dict) and 'queries' in body:
+            self.queries += len(body['queries'])
+            return b'{"results": [' + b', '.join([names(query) for query in body['queries']]) + b']}'
+        self.queries += 1
+        return b'{"result": ' + names(body) + b'}'
+
+    def watch(self, interval=RELOAD_SECONDS):
+        """
+        Starts a thread checking the datasets every interval seconds and reloading the state when they change.
+        """
+        def loop():
+            while not self._stopped.wait(interval):
+                try:
+                    self.reload()
+                except Exception as error:
+                    # A dataset being rewritten may not parse; keep the current state and try again later
+                    print("Reload failed: {}".format(error))
+        thread = threading.Thread(target=loop, name='query-server-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, reload_seconds=RELOAD_SECONDS):
+        """
+        Serves the queries over HTTP on host:port, or on a Unix socket when socket_path is given, until interrupted.
+        """
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = _UnixHTTPServer(socket_path, _UnixHandler)
+        else:
+            server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        server.query_server = self
+        self.watch(reload_seconds)
+        try:
+            server.serve_forever()
+        finally:
+            self._stopped.set()
+            server.server_close()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests, so clients are not limited by connection setup
+    protocol_version = 'HTTP/1.1'
+    # Send the answers as soon as they are written instead of waiting for the client's acknowledgements
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._answer(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self._send(413, {'error': 'request body too large'})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as error:
+            self._send(400, {'error': 'invalid JSON: {}'.format(error)})
+            return
+        self._answer(body)
+
+    def _answer(self, body):
+        endpoint = self.path.split('?', 1)[0]
+        if endpoint not in QueryServer.ENDPOINTS and endpoint != '/status':
+            self._send(404, {'error': 'unknown endpoint {}'.format(endpoint)})
+            return
+        try:
+            payload = self.server.query_server.encode(endpoint, body)
+        except KeyError as error:
+            self._send(400, {'error': 'missing key {}'.format(error)})
+            return
+        except (ValueError, TypeError) as error:
+            self._send(400, {'error': str(error)})
+            return
+        self._send(200, payload)
+
+    def _send(self, status, answer):
+        payload = answer if isinstance(answer, bytes) else json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Logging every request would cost more than answering it
+        pass
+
+
+class _UnixHandler(_Handler):
+    # Unix sockets have no Nagle algorithm to disable
+    disable_nagle_algorithm = False
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # http.server expects (host, port) client addresses
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def _parse_time(value):
+    # Datetimes, 'YYYY-MM-DD[ HH:MM[:SS]]' strings and 'now' (UTC)
+    if isinstance(value, datetime.datetime):
+        return value
+    if value == 'now':
+        return time_zones.utc_now()
+    return datetime.datetime.fromisoformat(value)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve schedule lookups, free times and priority overlaps over HTTP.')
+    parser.add_argument('--functions', default='./functions.csv', help='path to the "functions" dataset')
+    parser.add_argument('--dags', default='./dags.csv', help='path to the "dags" dataset')
+    parser.add_argument('--priority', default='./priority.csv', help='path to the "priority" dataset')
+    parser.add_argument('--table', help='job table written by metadata_loader.py, read instead of the datasets')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on (default {})'.format(DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on (default {})'.format(DEFAULT_PORT))
+    parser.add_argument('--socket', help='listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--days', type=int, default=HORIZON_DAYS,
+                        help='days of runs kept expanded after the current one (default {})'.format(HORIZON_DAYS))
+    parser.add_argument('--reload-seconds', type=float, default=RELOAD_SECONDS,
+                        help='seconds between two checks of the datasets for changes (default {})'.format(RELOAD_SECONDS))
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    server = QueryServer(args.functions, args.dags, args.priority, args.days, table_path=args.table)
+    print("Loaded {} jobs and {} runs in {:.1f} s".format(len(server.state), len(server.state.starts), time.perf_counter() - start))
+    print("Listening on {}".format(args.socket or "http://{}:{}".format(args.host, args.port)))
+    try:
+        server.serve(args.host, args.port, args.socket, args.reload_seconds)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
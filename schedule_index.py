@@ -0,0 +1,308 @@
+import datetime
+import hashlib
+import os
+import numpy as np
+import cron_occurrences
+import instrumentation
+import time_zones
+
+
+# Width of the time buckets in minutes; every offset from UTC in use is a multiple of a quarter of an hour, so the
+# local hour windows of the queries always start and end on a bucket boundary
+BUCKET_MINUTES = 15
+BUCKETS_PER_HOUR = 60 // BUCKET_MINUTES
+BUCKETS_PER_DAY = 24 * BUCKETS_PER_HOUR
+BUCKETS_PER_WEEK = 7 * BUCKETS_PER_DAY
+MINUTES_PER_DAY = 1440
+
+# File the index is persisted to by load_index
+INDEX_PATH = './schedule_index.npz'
+
+# Layers of the index a schedule belongs to
+WEEKLY, EXCEPTION, EXPANDED = 0, 1, 2
+
+
+class ScheduleIndex:
+    """
+    An inverted index from time buckets to the jobs firing in them, answering "which jobs run between X and Y"
+    with bitset unions instead of expanding every schedule.
+
+    The jobs are bits of packed uint64 bitsets. Schedules firing every day of every month repeat every week and
+    are indexed by quarter of an hour of the week (minute 0 is Monday 00:00 UTC). The others, restricted to some
+    days of the month or months, form an exceptions layer of one bitset per month, day of the month, day of the
+    week and quarter of an hour of the day, combined with cron's rules for each date queried. Schedules that
+    cannot be represented by field masks (L, #, seconds) are expanded at query time.
+
+    Build it with ScheduleIndex.build(job_names, schedules), or with load_index(cron_data) to reuse the one
+    persisted for the same job table.
+    """
+
+    def __init__(self, arrays):
+        self.job_names = arrays['job_names']
+        self.schedules = arrays['schedules']
+        self.digest = str(arrays['digest'])
+        self.weekly = arrays['weekly']
+        self.month = arrays['month']
+        self.day = arrays['day']
+        self.dow = arrays['dow']
+        self.slot = arrays['slot']
+        self.day_or = arrays['day_or']
+        self.minute_masks = arrays['minute_masks']
+        self.expanded = arrays['expanded']
+        self.has_exceptions = bool(self.slot.any())
+
+    @classmethod
+    @instrumentation.stage('build_index', rows=len)
+    def build(cls, job_names, schedules):
+        """
+        Builds the index of the jobs, compiling every distinct schedule once.
+
+        Parameters:
+        - job_names (iterable of str): The names of the jobs.
+        - schedules (iterable of str): Their crontab schedules, in UTC.
+        """
+        job_names = np.asarray(list(job_names), dtype=str)
+        schedules = np.asarray(list(schedules), dtype=str)
+        uniques, codes = np.unique(schedules, return_inverse=True)
+        num = len(uniques)
+        kinds = np.empty(num, dtype=np.int64)
+        weekly = np.zeros((num, BUCKETS_PER_WEEK), dtype=bool)
+        month = np.zeros((num, 13), dtype=bool)
+        day = np.zeros((num, 32), dtype=bool)
+        dow = np.zeros((num, 7), dtype=bool)
+        slot = np.zeros((num, BUCKETS_PER_DAY), dtype=bool)
+        day_or = np.zeros((num, 1), dtype=bool)
+        minute_masks = np.zeros(num, dtype=np.uint64)
+
+        for i, expression in enumerate(uniques):
+            schedule = cron_occurrences.compile_cron(expression)
+            if schedule.fallback:
+                kinds[i] = EXPANDED
+                continue
+            minute_masks[i] = schedule.minute_mask
+            # The buckets of the day a schedule fires in: its hours times the quarters holding one of its minutes
+            quarters = [(schedule.minute_mask >> (quarter * BUCKET_MINUTES)) & ((1 << BUCKET_MINUTES) - 1) != 0
+                        for quarter in range(BUCKETS_PER_HOUR)]
+            day_slots = (cron_occurrences._bits(schedule.hour_mask, 24)[:, None] & np.array(quarters)[None, :]).ravel()
+            days = cron_occurrences._bits(schedule.dow_mask, 7)
+            if schedule.day_mask == (1 << 32) - 1 and schedule.month_mask == (1 << 13) - 1:
+                kinds[i] = WEEKLY
+                # cron counts the days of the week from Sunday, the index from Monday
+                weekly[i] = (np.roll(days, -1)[:, None] & day_slots[None, :]).ravel()
+            else:
+                kinds[i] = EXCEPTION
+                month[i] = cron_occurrences._bits(schedule.month_mask, 13)
+                day[i] = cron_occurrences._bits(schedule.day_mask, 32)
+                dow[i] = days
+                slot[i] = day_slots
+                day_or[i] = schedule.day_or
+
+        return cls({
+            'job_names': job_names, 'schedules': schedules, 'digest': table_digest(job_names, schedules),
+            'weekly': _pack(weekly[codes]), 'month': _pack(month[codes]), 'day': _pack(day[codes]),
+            'dow': _pack(dow[codes]), 'slot': _pack(slot[codes]), 'day_or': _pack(day_or[codes])[0],
+            'minute_masks': minute_masks[codes], 'expanded': np.flatnonzero(kinds[codes] == EXPANDED),
+        })
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index written by save().
+        """
+        with np.load(path, allow_pickle=False) as stored:
+            return cls({name: stored[name] for name in stored.files})
+
+    def save(self, path):
+        """
+        Writes the index to a .npz file.
+        """
+        arrays = {'job_names': self.job_names, 'schedules': self.schedules, 'digest': np.array(self.digest),
+                  'weekly': self.weekly, 'month': self.month, 'day': self.day, 'dow': self.dow, 'slot': self.slot,
+                  'day_or': self.day_or, 'minute_masks': self.minute_masks, 'expanded': self.expanded}
+        # Write to a temporary file first so a crash never leaves a half-written index behind
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    def __len__(self):
+        return len(self.job_names)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.weekly, self.month, self.day, self.dow, self.slot, self.day_or,
+                                              self.minute_masks))
+
+    @instrumentation.stage('query_index', jobs=len)
+    def query(self, start_date, end_date, time_interval, time_zone=None):
+        """
+        Finds the jobs that run at least once within a time interval and date range.
+
+        The arguments have the same meaning as for cron_schedule_lookup.get_task_datetimes: the runs are taken
+        strictly after start_date and up to and including end_date, between start_hour (included) and end_hour
+        (excluded) on the wall clock of the time zone, the interval wrapping around midnight when start_hour is
+        after end_hour.
+
+        Returns:
+        - numpy array: The sorted int64 ids (row numbers) of the jobs.
+        """
+        start_date, end_date = _parse_date(start_date), _parse_date(end_date)
+        low = _first_minute_after(time_zones.to_utc(start_date, time_zone))
+        high = _first_minute_after(time_zones.to_utc(end_date, time_zone))
+        starts, ends = _utc_ranges(low, high, time_interval, time_zones.get_zone(time_zone))
+        return self.query_ranges(starts, ends)
+
+    def query_ranges(self, starts, ends):
+        """
+        Finds the jobs that run at least once within sorted, disjoint UTC ranges of epoch minutes [starts, ends).
+
+        Returns:
+        - numpy array: The sorted int64 ids of the jobs.
+        """
+        bits = np.zeros(self.weekly.shape[1], dtype=np.uint64)
+        first = -(-starts // BUCKET_MINUTES)
+        last = ends // BUCKET_MINUTES
+        # Whole buckets: one union of the weekly bitsets, and one per date for the exceptions layer
+        counts = np.maximum(last - first, 0)
+        buckets = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        if len(buckets):
+            bits |= np.bitwise_or.reduce(self.weekly[np.unique(_week_bucket(buckets))], axis=0)
+            if self.has_exceptions:
+                dates, inverse = np.unique(buckets // BUCKETS_PER_DAY, return_inverse=True)
+                pairs = np.unique(inverse * BUCKETS_PER_DAY + buckets % BUCKETS_PER_DAY)
+                bits |= np.bitwise_or.reduce(self.slot[pairs % BUCKETS_PER_DAY]
+                                             & self._date_bits(dates)[pairs // BUCKETS_PER_DAY], axis=0)
+
+        jobs = _unpack(bits, len(self))
+        # Partial buckets at the ends of the ranges: keep the jobs of the bucket firing at one of its minutes
+        partial = []
+        for start, end in zip(starts, ends):
+            if start >= end:
+                continue
+            # A range starting on a bucket boundary has no partial head, and may end within that same bucket
+            head_end = start
+            if start % BUCKET_MINUTES:
+                head_end = min(end, (start // BUCKET_MINUTES + 1) * BUCKET_MINUTES)
+                partial.append(self._partial_bucket(start, head_end))
+            if end % BUCKET_MINUTES and end // BUCKET_MINUTES * BUCKET_MINUTES >= head_end:
+                partial.append(self._partial_bucket(end // BUCKET_MINUTES * BUCKET_MINUTES, end))
+        if len(self.expanded) and len(starts):
+            partial.append(self._expanded_jobs(starts, ends))
+        if partial:
+            jobs = np.union1d(jobs, np.concatenate(partial))
+        return jobs
+
+    def job_names_of(self, jobs):
+        return self.job_names[jobs]
+
+    def _date_bits(self, dates):
+        # The jobs of the exceptions layer firing on each date (epoch day), by the same rules as the occurrences
+        return cron_occurrences.CronSchedule.days_matching(np.asarray(dates).astype('datetime64[D]'), self.month, self.day,
+                                                           self.dow, self.day_or)
+
+    def _partial_bucket(self, start, end):
+        # The jobs firing within [start, end), a part of a single bucket
+        bucket = start // BUCKET_MINUTES
+        bits = self.weekly[_week_bucket(bucket)]
+        if self.has_exceptions:
+            bits = bits | (self.slot[bucket % BUCKETS_PER_DAY] & self._date_bits(bucket // BUCKETS_PER_DAY))
+        jobs = _unpack(bits, len(self))
+        # Within an hour, the minute field alone tells whether a job fires at one of the minutes
+        minutes = np.uint64(((1 << (end - start)) - 1) << (start % 60))
+        return jobs[(self.minute_masks[jobs] & minutes) != 0]
+
+    def _expanded_jobs(self, starts, ends):
+        # The jobs whose schedules are expanded, firing within one of the ranges
+        low, high = np.datetime64(int(starts.min()), 'm'), np.datetime64(int(ends.max()), 'm')
+        found = []
+        for job in self.expanded:
+            times = cron_occurrences.occurrences(str(self.schedules[job]), low, high).astype(np.int64)
+            i = np.searchsorted(starts, times, side='right') - 1
+            if ((i >= 0) & (times < ends[np.maximum(i, 0)])).any():
+                found.append(job)
+        return np.array(found, dtype=np.int64)
+
+
+def table_digest(job_names, schedules):
+    """
+    SHA-256 digest of the job names and schedules an index is built from.
+    """
+    sha = hashlib.sha256()
+    for name, schedule in zip(job_names, schedules):
+        sha.update("{}\t{}\n".format(name, schedule).encode())
+    return sha.hexdigest()
+
+
+def load_index(cron_data, path=INDEX_PATH):
+    """
+    Returns the index of a job table, read from path when it was built from the same job names and schedules,
+    otherwise built and written to path (not written when path is None).
+    """
+    job_names, schedules = cron_data['job_name'].to_numpy(dtype=str), cron_data['schedule'].to_numpy(dtype=str)
+    if path is not None and os.path.exists(path):
+        index = ScheduleIndex.load(path)
+        if index.digest == table_digest(job_names, schedules):
+            return index
+    index = ScheduleIndex.build(job_names, schedules)
+    if path is not None:
+        index.save(path)
+    return index
+
+
+def _utc_ranges(low, high, time_interval, zone):
+    # The UTC ranges of epoch minutes within [low, high) whose wall clock hour is within the time interval
+    start_hour, end_hour = time_interval
+    if start_hour == end_hour or low >= high:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if isinstance(zone, datetime.timezone):
+        changes = np.array([low], dtype=np.int64)
+        offsets = np.array([int(zone.utcoffset(None).total_seconds() // 60)], dtype=np.int64)
+    else:
+        changes, offsets = time_zones.offset_table(zone, np.datetime64(int(low), 'm'), np.datetime64(int(high), 'm'))
+    bounds = np.append(changes[1:], high)
+    starts, ends = [], []
+    # Within each period of constant offset, the local hour windows of every day shifted back to UTC
+    for change, bound, offset in zip(changes, bounds, offsets):
+        first, last = max(change, low) + offset, min(bound, high) + offset
+        if first >= last:
+            continue
+        days = np.arange(first // MINUTES_PER_DAY, (last - 1) // MINUTES_PER_DAY + 1) * MINUTES_PER_DAY
+        if start_hour < end_hour:
+            window_starts, window_ends = days + start_hour * 60, days + end_hour * 60
+        else:
+            window_starts = np.concatenate([days, days + start_hour * 60])
+            window_ends = np.concatenate([days + end_hour * 60, days + MINUTES_PER_DAY])
+        window_starts, window_ends = np.maximum(window_starts, first), np.minimum(window_ends, last)
+        keep = window_starts < window_ends
+        starts.append(window_starts[keep] - offset)
+        ends.append(window_ends[keep] - offset)
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+    order = np.argsort(starts, kind='stable')
+    return starts[order], ends[order]
+
+
+def _week_bucket(buckets):
+    # Bucket of the week of absolute buckets; epoch day 0 was a Thursday, day 3 of a week starting on Monday
+    return (buckets + 3 * BUCKETS_PER_DAY) % BUCKETS_PER_WEEK
+
+
+def _pack(matrix):
+    # Pack a (jobs, buckets) boolean matrix into one bitset of uint64 words per bucket
+    words = -(-matrix.shape[0] // 64)
+    packed = np.zeros((matrix.shape[1], words * 8), dtype=np.uint8)
+    packed[:, :-(-matrix.shape[0] // 8) or None] = np.packbits(matrix.T, axis=1, bitorder='little')
+    return packed.view(np.uint64)
+
+
+def _unpack(bits, size):
+    return np.flatnonzero(np.unpackbits(bits.view(np.uint8), bitorder='little')[:size])
+
+
+def _parse_date(date):
+    if isinstance(date, str):
+        return datetime.datetime.fromisoformat(date)
+    return date
+
+
+def _first_minute_after(moment):
+    # The first epoch minute strictly after a naive UTC datetime
+    return int(np.datetime64(moment, 'us').astype('datetime64[m]').astype(np.int64)) + 1
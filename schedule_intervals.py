@@ -0,0 +1,157 @@
+import numpy as np
+import instrumentation
+
+
+@instrumentation.stage('merge_intervals', intervals=lambda result: len(result[0]))
+def merge_intervals(starts, ends):
+    """
+    Merges possibly overlapping intervals into disjoint busy intervals with a sorted sweep line.
+
+    Parameters:
+    - starts (numpy array): Start of each interval (datetime64 or integers).
+    - ends (numpy array): End of each interval, same type and length as starts.
+
+    Returns:
+    - tuple: (busy_starts, busy_ends) arrays of the disjoint, sorted busy intervals.
+    """
+    if len(starts) == 0:
+        return starts[:0], ends[:0]
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+    # The furthest end seen so far; an interval opens a new busy block when it starts after it
+    reach = np.maximum.accumulate(ends)
+    opens = np.ones(len(starts), dtype=bool)
+    opens[1:] = starts[1:] > reach[:-1]
+    first = np.flatnonzero(opens)
+    last = np.append(first[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+
+def free_gaps(busy_starts, busy_ends, window_start, window_end):
+    """
+    Returns the complement of disjoint busy intervals within a window.
+
+    Parameters:
+    - busy_starts (numpy array): Sorted starts of disjoint busy intervals.
+    - busy_ends (numpy array): Matching ends of the busy intervals.
+    - window_start: Start of the window, same type as the interval bounds.
+    - window_end: End of the window, same type as the interval bounds.
+
+    Returns:
+    - tuple: (free_starts, free_ends) arrays of the non-empty free gaps.
+    """
+    gap_starts = np.concatenate([[window_start], busy_ends]).astype(busy_ends.dtype)
+    gap_ends = np.concatenate([busy_starts, [window_end]]).astype(busy_starts.dtype)
+    # Clip the gaps to the window and drop the empty ones
+    gap_starts = np.maximum(gap_starts, np.array(window_start, dtype=gap_starts.dtype))
+    gap_ends = np.minimum(gap_ends, np.array(window_end, dtype=gap_ends.dtype))
+    keep = gap_ends > gap_starts
+    return gap_starts[keep], gap_ends[keep]
+
+
+def free_gaps_by_group(groups, busy_starts, busy_ends, window_start, window_end, num_groups):
+    """
+    Returns the complement within a window of the disjoint busy intervals of each group.
+
+    Parameters:
+    - groups (numpy array): Integer group (0 to num_groups - 1) of each busy interval.
+    - busy_starts (numpy array): Starts of the busy intervals, disjoint and sorted by group then start
+      (as returned by merge_intervals_by_group).
+    - busy_ends (numpy array): Matching ends of the busy intervals.
+    - window_start: Start of the window, same type as the interval bounds.
+    - window_end: End of the window, same type as the interval bounds.
+    - num_groups (int): Number of groups; a group without busy intervals is free during the whole window.
+
+    Returns:
+    - tuple: (groups, free_starts, free_ends) arrays of the non-empty free gaps, sorted by group then start.
+    """
+    # Each busy interval closes the gap opened by the previous one of its group (or by the window start), and the
+    # last busy interval of each group opens a gap up to the window end
+    same_group = np.r_[False, groups[1:] == groups[:-1]]
+    last = np.r_[~same_group[1:], True] if len(groups) else np.zeros(0, dtype=bool)
+    idle = np.setdiff1d(np.arange(num_groups), groups)
+    window_starts = np.full(len(idle), window_start, dtype=busy_starts.dtype)
+    window_ends = np.full(len(idle), window_end, dtype=busy_ends.dtype)
+    gap_groups = np.concatenate([groups, groups[last], idle]).astype(np.int64)
+    gap_starts = np.concatenate([np.where(same_group, np.r_[busy_ends[:1], busy_ends[:-1]], window_start),
+                                 busy_ends[last], window_starts]).astype(busy_ends.dtype)
+    gap_ends = np.concatenate([busy_starts, np.full(last.sum(), window_end, dtype=busy_starts.dtype),
+                               window_ends]).astype(busy_starts.dtype)
+    # Clip the gaps to the window, drop the empty ones and put them back in order
+    gap_starts = np.maximum(gap_starts, np.array(window_start, dtype=gap_starts.dtype))
+    gap_ends = np.minimum(gap_ends, np.array(window_end, dtype=gap_ends.dtype))
+    keep = gap_ends > gap_starts
+    gap_groups, gap_starts, gap_ends = gap_groups[keep], gap_starts[keep], gap_ends[keep]
+    order = np.lexsort((gap_starts, gap_groups))
+    return gap_groups[order], gap_starts[order], gap_ends[order]
+
+
+def count_containing(starts, ends, points):
+    """
+    Counts, for each point, the intervals (start, end] that contain it, using binary search on sorted bounds.
+
+    Parameters:
+    - starts (numpy array): Start of each interval (exclusive).
+    - ends (numpy array): End of each interval (inclusive), same type and length as starts.
+    - points (numpy array): The points to check, same type as the interval bounds.
+
+    Returns:
+    - numpy array: int64 array with the number of intervals containing each point.
+    """
+    # Every interval that started before a point contains it, unless it also ended before it
+    started = np.searchsorted(np.sort(starts), points, side='left')
+    ended = np.searchsorted(np.sort(ends), points, side='left')
+    return (started - ended).astype(np.int64)
+
+
+def merge_intervals_by_group(groups, starts, ends, gap=0, weights=None):
+    """
+    Merges the intervals of each group separately, also joining intervals separated by at most gap.
+
+    Parameters:
+    - groups (numpy array): Integer group of each interval.
+    - starts (numpy array): Start of each interval (integers).
+    - ends (numpy array): End of each interval, same type and length as starts.
+    - gap (int): Largest distance between two intervals of a group that still get merged. Default is 0.
+    - weights (numpy array): Integer weight of each interval, summed into the counts. Default is 1 for every interval.
+
+    Returns:
+    - tuple: (groups, starts, ends, counts) arrays of the merged intervals, sorted by group then start,
+      where counts is the total weight (by default the number) of the original intervals in each merged one.
+    """
+    if len(starts) == 0:
+        return groups[:0], starts[:0], ends[:0], np.zeros(0, dtype=np.int64)
+    if weights is None:
+        weights = np.ones(len(starts), dtype=np.int64)
+    # Occurrence tables are already sorted by job then start, so only sort when needed
+    new_group = groups[1:] != groups[:-1]
+    if not (np.all(groups[1:] >= groups[:-1]) and np.all(new_group | (starts[1:] >= starts[:-1]))):
+        order = np.lexsort((starts, groups))
+        groups = groups[order]
+        starts = starts[order]
+        ends = ends[order]
+        weights = weights[order]
+        new_group = groups[1:] != groups[:-1]
+    first_of_group = np.flatnonzero(np.r_[True, new_group])
+    group_rank = np.cumsum(np.r_[0, new_group])
+
+    # Measure every bound from the start of its group, then shift each group above the previous ones so a single
+    # running maximum gives the furthest (gap-extended) end seen so far within each group; groups are handled in
+    # as few runs as needed to keep the shifted values within int64
+    origin = starts[first_of_group][group_rank]
+    reach_ends = (ends - origin) + gap
+    stride = int(max(reach_ends.max(), (starts - origin).max())) + 1
+    groups_per_run = max((1 << 62) // stride, 1)
+    reach = np.empty(len(starts), dtype=reach_ends.dtype)
+    for first_group in range(0, len(first_of_group), groups_per_run):
+        lo = first_of_group[first_group]
+        hi = first_of_group[first_group + groups_per_run] if first_group + groups_per_run < len(first_of_group) else len(starts)
+        shift = (group_rank[lo:hi] - first_group) * stride
+        reach[lo:hi] = np.maximum.accumulate(reach_ends[lo:hi] + shift) - shift
+
+    opens = np.ones(len(starts), dtype=bool)
+    opens[1:] = new_group | (starts[1:] - origin[1:] > reach[:-1])
+    first = np.flatnonzero(opens)
+    merged_ends = np.maximum.reduceat(ends, first)
+    return groups[first], starts[first], merged_ends, np.add.reduceat(weights, first)
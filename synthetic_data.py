@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import sqlite3
+import numpy as np
+import data_preprocessor
+import metadata_loader
+import time_zones
+
+
+# Kinds of crontab schedules generated and the share of jobs using each of them
+SCHEDULE_MIX = {
+    'daily': 0.40,        # 43 3 * * *
+    'hours': 0.20,        # 27 05,07,08,10,12 * * *
+    'hour_range': 0.10,   # 10 6-23/2 * * *
+    'every_minutes': 0.10,  # */15 * * * *
+    'hourly': 0.10,       # 5 * * * *
+    'weekly': 0.07,       # 30 2 * * 1
+    'monthly': 0.03,      # 0 4 1 * *
+}
+
+# Share of the jobs that are dags (the rest are functions) and share of the jobs with a priority
+DAG_FRACTION = 0.3
+PRIORITY_FRACTION = 0.1
+
+# Median and spread (of the logarithm) of the average runtimes, in seconds, and their upper bound
+RUNTIME_MEDIAN = 90
+RUNTIME_SIGMA = 1.2
+RUNTIME_MAX = 2 * 3600
+
+# Share of the runs of the fixture database that failed, and spread (of the logarithm) of the run durations
+# around the average runtime of their job
+FAILED_FRACTION = 0.05
+DURATION_SIGMA = 0.3
+
+
+def generate_schedules(rng, size):
+    """
+    Draw size crontab schedules following SCHEDULE_MIX.
+    """
+    kinds = rng.choice(list(SCHEDULE_MIX), size=size, p=list(SCHEDULE_MIX.values()))
+    minutes = rng.integers(0, 60, size)
+    hours = rng.integers(0, 24, size)
+    schedules = []
+    for kind, minute, hour in zip(kinds, minutes, hours):
+        if kind == 'daily':
+            # Some schedules write the hour with a leading zero, as in the real datasets
+            schedules.append("{} {:0{}d} * * *".format(minute, hour, 2 if rng.random() < 0.2 else 1))
+        elif kind == 'hours':
+            run_hours = np.sort(rng.choice(24, size=rng.integers(2, 7), replace=False))
+            schedules.append("{} {} * * *".format(minute, ",".join("{:02d}".format(h) for h in run_hours)))
+        elif kind == 'hour_range':
+            schedules.append("{} {}-23/{} * * *".format(minute, hour % 12, rng.integers(2, 5)))
+        elif kind == 'every_minutes':
+            schedules.append("*/{} * * * *".format(rng.choice([5, 10, 15, 20, 30])))
+        elif kind == 'hourly':
+            schedules.append("{} * * * *".format(minute))
+        elif kind == 'weekly':
+            schedules.append("{} {} * * {}".format(minute, hour, rng.integers(0, 7)))
+        else:
+            schedules.append("{} {} {} * *".format(minute, hour, rng.integers(1, 29)))
+    return schedules
+
+
+def generate_runtimes(rng, size):
+    """
+    Draw size average runtimes, in seconds, from a log-normal distribution.
+    """
+    return np.clip(rng.lognormal(np.log(RUNTIME_MEDIAN), RUNTIME_SIGMA, size), 0.5, RUNTIME_MAX)
+
+
+def generate_names(rng, prefix, size):
+    """
+    Generate size job names, some of them containing a category keyword.
+    """
+    keywords = rng.choice(data_preprocessor.CATEGORIES + [None], size=size)
+    return ["{}{}{}".format(prefix, i, "" if keyword is None else "_" + keyword) for i, keyword in enumerate(keywords)]
+
+
+def postgres_interval(seconds):
+    # Format a number of seconds as a Postgres interval, as in the functions dataset
+    hours, rest = divmod(float(seconds), 3600)
+    mins, secs = divmod(rest, 60)
+    return "0 years 0 mons 0 days {} hours {} mins {:.6f} secs".format(int(hours), int(mins), secs)
+
+def pandas_timedelta(seconds):
+    # Format a number of seconds as a pandas Timedelta string, as in the dags dataset
+    hours, rest = divmod(float(seconds), 3600)
+    mins, secs = divmod(rest, 60)
+    return "0 days {:02d}:{:02d}:{:05.2f}".format(int(hours), int(mins), secs)
+
+
+def generate_datasets(num_jobs, directory='.', seed=0, dag_fraction=DAG_FRACTION, priority_fraction=PRIORITY_FRACTION):
+    """
+    Write synthetic functions.csv, dags.csv and priority.csv datasets in the formats of data_preprocessor.
+
+    Parameters:
+    - num_jobs (int): Total number of jobs (functions and dags).
+    - directory (str): Directory the datasets are written to. Default is the current directory.
+    - seed (int): Seed of the random generator; the same seed always gives the same datasets. Default is 0.
+    - dag_fraction (float): Share of the jobs that are dags. Default is DAG_FRACTION.
+    - priority_fraction (float): Share of the jobs listed in the priority dataset. Default is PRIORITY_FRACTION.
+
+    Returns:
+    - tuple: The paths of the functions, dags and priority datasets.
+    """
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    num_dags = int(round(num_jobs * dag_fraction))
+    num_functions = num_jobs - num_dags
+    os.makedirs(directory, exist_ok=True)
+    paths = tuple(os.path.join(directory, name) for name in ('functions.csv', 'dags.csv', 'priority.csv'))
+
+    function_names = generate_names(rng, 'function', num_functions)
+    functions = pd.DataFrame({
+        'jobid': np.arange(num_functions),
+        'func_name': function_names,
+        'schedule': generate_schedules(rng, num_functions),
+        'avg_runtime': [postgres_interval(seconds) for seconds in generate_runtimes(rng, num_functions)],
+    })
+    functions.to_csv(paths[0], index=False)
+
+    dag_names = generate_names(rng, 'dag', num_dags)
+    runtimes = generate_runtimes(rng, num_dags)
+    fails = rng.poisson(0.5, num_dags)
+    dags = pd.DataFrame({
+        'dag_id': dag_names,
+        'max_runtime': [pandas_timedelta(seconds) for seconds in runtimes * rng.uniform(1, 3, num_dags)],
+        'avg_runtime': [pandas_timedelta(seconds) for seconds in runtimes],
+        'failed_runs': ["{{'num_fails': {}, 'avg_run_time': NaT, 'max_run_time': NaT}}".format(count) for count in fails],
+        'schedule': generate_schedules(rng, num_dags),
+    })
+    dags.to_csv(paths[1], index=False)
+
+    names = np.array(function_names + dag_names, dtype=object)
+    chosen = rng.choice(len(names), size=int(round(len(names) * priority_fraction)), replace=False)
+    priority = pd.DataFrame({
+        'function_name': names[chosen],
+        'priority': rng.integers(1, 5, len(chosen)),
+        'avg_executaion_in_min': rng.integers(1, 240, len(chosen)),
+    })
+    priority.to_csv(paths[2], index=False)
+    return paths
+
+
+def generate_database(path, num_jobs, num_runs=100000, seed=0, dag_fraction=DAG_FRACTION, now=None):
+    """
+    Write a SQLite database with the pg_cron and Airflow tables read by metadata_loader, as a local stand-in for
+    the Postgres databases.
+
+    Parameters:
+    - path (str): Path of the database; an existing file is replaced.
+    - num_jobs (int): Total number of jobs (pg_cron jobs and dags).
+    - num_runs (int): Total number of runs in the run history of the jobs. Default is 100000.
+    - seed (int): Seed of the random generator. Default is 0.
+    - dag_fraction (float): Share of the jobs that are dags. Default is DAG_FRACTION.
+    - now (datetime): End of the run history, which covers metadata_loader.HISTORY_DAYS days. Default is now.
+
+    Returns:
+    - str: The path of the database.
+    """
+    rng = np.random.default_rng(seed)
+    if now is None:
+        now = time_zones.utc_now()
+    num_dags = int(round(num_jobs * dag_fraction))
+    num_functions = num_jobs - num_dags
+    if os.path.exists(path):
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    try:
+        metadata_loader.create_fixture(connection)
+        function_names = generate_names(rng, 'function', num_functions)
+        connection.executemany("INSERT INTO cron_job (jobid, jobname, command, schedule) VALUES (?, ?, ?, ?)",
+                               [(jobid, name, "SELECT {}()".format(name), schedule) for jobid, (name, schedule)
+                                in enumerate(zip(function_names, generate_schedules(rng, num_functions)))])
+        dag_names = generate_names(rng, 'dag', num_dags)
+        # Airflow stores the schedules JSON-encoded
+        connection.executemany("INSERT INTO dag (dag_id, schedule_interval) VALUES (?, ?)",
+                               [(name, json.dumps(schedule)) for name, schedule in zip(dag_names, generate_schedules(rng, num_dags))])
+
+        # Spread the runs over the jobs, with durations around the average runtime of their job
+        jobs = rng.integers(0, num_jobs, num_runs)
+        runtimes = generate_runtimes(rng, num_jobs)
+        durations = runtimes[jobs] * rng.lognormal(0, DURATION_SIGMA, num_runs)
+        history = metadata_loader.HISTORY_DAYS * 86400
+        starts = np.datetime64(now, 'us') - (rng.uniform(0, history - RUNTIME_MAX * 4, num_runs) * 1e6).astype('timedelta64[us]')
+        ends = starts + (durations * 1e6).astype('timedelta64[us]')
+        failed = rng.random(num_runs) < FAILED_FRACTION
+        starts = np.datetime_as_string(starts, unit='us')
+        ends = np.datetime_as_string(ends, unit='us')
+        is_function = jobs < num_functions
+        connection.executemany(
+            "INSERT INTO cron_job_run_details (jobid, status, start_time, end_time) VALUES (?, ?, ?, ?)",
+            [(int(job), 'failed' if fail else 'succeeded', start.replace('T', ' '), end.replace('T', ' '))
+             for job, fail, start, end in zip(jobs[is_function], failed[is_function], starts[is_function], ends[is_function])])
+        connection.executemany(
+            "INSERT INTO dag_run (dag_id, state, start_date, end_date) VALUES (?, ?, ?, ?)",
+            [(dag_names[job - num_functions], 'failed' if fail else 'success', start.replace('T', ' '), end.replace('T', ' '))
+             for job, fail, start, end in zip(jobs[~is_function], failed[~is_function], starts[~is_function], ends[~is_function])])
+        connection.commit()
+    finally:
+        connection.close()
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic functions, dags and priority datasets.")
+    parser.add_argument('--jobs', type=int, default=10000, help="Total number of jobs (default 10000)")
+    parser.add_argument('--output', default='.', help="Directory the datasets are written to (default the current directory)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random generator (default 0)")
+    parser.add_argument('--database', help="Also write a SQLite stand-in of the pg_cron and Airflow databases to this path")
+    parser.add_argument('--runs', type=int, default=100000, help="Number of runs in the run history of the database (default 100000)")
+    args = parser.parse_args(argv)
+    for path in generate_datasets(args.jobs, args.output, args.seed):
+        print(path)
+    if args.database is not None:
+        print(generate_database(args.database, args.jobs, args.runs, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import datetime
+import sys
+import numpy as np
+import conftest
+import cron_daemon
+
+
+START = datetime.datetime(2024, 1, 1)
+
+
+def run_daemon(cron_data, minutes, concurrency=cron_daemon.DEFAULT_CONCURRENCY):
+    """
+    Runs the daemon on a fake clock for a number of minutes from START.
+
+    Returns the daemon and the (job name, fire time, start time) of every run, in order of start.
+    """
+    runs = []
+
+    async def drive():
+        clock = cron_daemon.FakeClock(START)
+        daemon = cron_daemon.Daemon(cron_data, concurrency=concurrency, clock=clock)
+
+        async def runner(job, fire_time):
+            runs.append((job['job_name'], str(fire_time), str(clock.now().astype('datetime64[m]'))))
+            await clock.sleep(job['avg_runtime'])
+
+        daemon.runner = runner
+        task = asyncio.ensure_future(daemon.run(until=START + datetime.timedelta(minutes=minutes), drain=False))
+        await clock.advance(minutes * 60)
+        await task
+        return daemon
+
+    return asyncio.run(drive()), runs
+
+
+def test_jobs_fire_at_their_schedule():
+    daemon, runs = run_daemon(conftest.make_jobs([('quarterly', '*/15 * * * *', 1, 'bus', 5),
+                                         ('half_past', '30 * * * *', 1, 'bus', 5)]), 60)
+    assert sorted(runs) == [('half_past', '2024-01-01T00:30', '2024-01-01T00:30'),
+                            ('quarterly', '2024-01-01T00:15', '2024-01-01T00:15'),
+                            ('quarterly', '2024-01-01T00:30', '2024-01-01T00:30'),
+                            ('quarterly', '2024-01-01T00:45', '2024-01-01T00:45')]
+    assert daemon.status()['stats']['fired'] == 4
+    assert daemon.next_fire_times() == {'quarterly': np.datetime64('2024-01-01T01:00'),
+                                        'half_past': np.datetime64('2024-01-01T01:30')}
+
+
+def test_concurrency_limit_by_category():
+    daemon, runs = run_daemon(conftest.make_jobs([('pay_1', '5 * * * *', 10, 'payment', 5),
+                                         ('pay_2', '5 * * * *', 10, 'payment', 5),
+                                         ('pay_3', '5 * * * *', 10, 'payment', 5),
+                                         ('bus_1', '5 * * * *', 10, 'bus', 5),
+                                         ('bus_2', '5 * * * *', 10, 'bus', 5)]), 60, concurrency={'payment': 1})
+    starts = {name: start for name, _, start in runs}
+    # The payment jobs run one after another, the bus jobs (default limit) at once
+    assert sorted(starts[name] for name in ('pay_1', 'pay_2', 'pay_3')) == \
+        ['2024-01-01T00:05', '2024-01-01T00:15', '2024-01-01T00:25']
+    assert starts['bus_1'] == starts['bus_2'] == '2024-01-01T00:05'
+    assert daemon.status()['running'] == {}
+
+
+def test_priority_order_of_competing_jobs():
+    _, runs = run_daemon(conftest.make_jobs([('low', '5 * * * *', 10, 'payment', 5),
+                                    ('high', '5 * * * *', 10, 'payment', 1),
+                                    ('medium', '5 * * * *', 10, 'payment', 3)]), 60, concurrency=1)
+    assert [name for name, _, _ in runs] == ['high', 'medium', 'low']
+
+
+def test_job_skipped_while_pending():
+    # The blocker holds the only slot, so the minutely job stays queued and its next fires are skipped
+    daemon, runs = run_daemon(conftest.make_jobs([('blocker', '1 0 * * *', 30, 'payment', 1),
+                                         ('minutely', '* * * * *', 0, 'payment', 5)]), 5, concurrency=1)
+    assert runs == [('blocker', '2024-01-01T00:01', '2024-01-01T00:01')]
+    status = daemon.status()
+    assert status['queued'] == {'payment': 1}
+    assert status['stats']['skipped'] == 3
+    assert status['stats']['fired'] == 5
+
+
+def test_reload_reschedules_only_changed_jobs():
+    old_data = conftest.make_jobs([('kept', '0 * * * *', 5, 'bus', 5), ('moved', '0 * * * *', 5, 'bus', 5),
+                          ('promoted', '0 * * * *', 5, 'bus', 5), ('dropped', '0 * * * *', 5, 'bus', 5)])
+    new_data = conftest.make_jobs([('kept', '0 * * * *', 5, 'bus', 5), ('moved', '30 * * * *', 5, 'bus', 5),
+                          ('promoted', '0 * * * *', 5, 'bus', 1), ('added', '45 * * * *', 5, 'bus', 5)])
+    daemon = cron_daemon.Daemon(old_data, clock=cron_daemon.FakeClock(START))
+    timers = list(daemon._timers)
+
+    changes = daemon.reload(new_data)
+    assert changes == {'added': 1, 'removed': 1, 'rescheduled': 1, 'updated': 1}
+    # Only the rescheduled and the added job get a new timer; the other ones are left in the heap as they were
+    assert sorted(name for _, _, name, _ in set(daemon._timers) - set(timers)) == ['added', 'moved']
+    assert set(timers) <= set(daemon._timers)
+    assert daemon.jobs['promoted']['priority'] == 1
+    assert daemon.next_fire_times() == {'kept': np.datetime64('2024-01-01T01:00'),
+                                        'moved': np.datetime64('2024-01-01T00:30'),
+                                        'promoted': np.datetime64('2024-01-01T01:00'),
+                                        'added': np.datetime64('2024-01-01T00:45')}
+
+
+def test_command_runner_passes_fields_as_single_arguments(tmp_path):
+    # A job name made of shell syntax reaches the command as one argument and is never run
+    output = tmp_path / 'argument.txt'
+    name = 'report; touch {0}/injected $(touch {0}/substituted)'.format(tmp_path)
+    command = '{} -c "import sys; open(sys.argv[1], \'w\').write(sys.argv[2])" {} {{job_name}}'.format(sys.executable, output)
+    asyncio.run(cron_daemon.command_runner(command)({'job_name': name}, START))
+    assert output.read_text() == name
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['argument.txt']
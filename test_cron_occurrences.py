@@ -0,0 +1,43 @@
+import datetime
+import croniter
+import numpy as np
+import cron_occurrences
+
+
+START_TIME = datetime.datetime(2024, 2, 27, 13, 30, 20)
+END_TIME = datetime.datetime(2024, 3, 3, 0, 1)
+
+# Plain expressions parsed without croniter, including the cases where croniter writes a full field as '*' or not
+EXPRESSIONS = ['* * * * *', '*/15 * * * *', '0-59 * * * *', '1-10/3 2,4 * * *', '0 0 */2 * *', '0 0 1-31 * 1',
+                 '0 0 1-31 * *', '0 0 * * 0-6', '0 0 15 * 0-6', '0 0 15 * 1-5', '*/7 * 29 2 *', '0 0 31 * 1', '00 01 * * *',
+                 '5,*/20 */6 * 1-12/3 *', '59 23 1,15 * 0,6']
+
+# Expressions left to croniter: aliases, names, L, #, wrapping ranges, Sunday as 7
+CRONITER_EXPRESSIONS = ['@daily', '0 0 * * mon-fri', '0 0 L * *', '0 12 * * 5#2', '10-5 * * * *', '3-3 * * * *',
+                          '0 0 * * 7', '5/15 * * * *']
+
+
+def croniter_fields(expression):
+    expanded = croniter.croniter.expand(expression)[0]
+    masks = [(1 << size) - 1 if values[0] == '*' else sum(1 << int(value) for value in set(values))
+             for values, size in zip(expanded, cron_occurrences.FIELD_SIZES)]
+    return masks + [expanded[2][0] != '*' and expanded[4][0] != '*']
+
+
+def test_plain_expressions_compile_like_croniter():
+    for expression in EXPRESSIONS:
+        assert cron_occurrences._expand_simple(expression) is not None, expression
+        schedule = cron_occurrences.CronSchedule(expression)
+        assert [schedule.minute_mask, schedule.hour_mask, schedule.day_mask, schedule.month_mask, schedule.dow_mask,
+                schedule.day_or] == croniter_fields(expression), expression
+    for expression in CRONITER_EXPRESSIONS:
+        assert cron_occurrences._expand_simple(expression) is None, expression
+
+
+def test_expand_jobs_matches_occurrences():
+    schedules = EXPRESSIONS + CRONITER_EXPRESSIONS + EXPRESSIONS[:3]
+    job_index, times = cron_occurrences.expand_jobs(schedules, START_TIME, END_TIME)
+    expected = [cron_occurrences.compile_cron(schedule).occurrences(START_TIME, END_TIME) for schedule in schedules]
+    np.testing.assert_array_equal(job_index, np.repeat(np.arange(len(schedules)), [len(times) for times in expected]))
+    np.testing.assert_array_equal(times, np.concatenate(expected))
+    assert times.dtype == np.dtype('datetime64[m]')
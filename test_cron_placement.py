@@ -0,0 +1,40 @@
+import datetime
+import numpy as np
+import pandas as pd
+import cron_placement
+import load_profile
+
+
+START_TIME = datetime.datetime(2024, 1, 3)
+
+# Weekly schedules (every day of every month) and ones that are not, with runs crossing the end of the week
+JOBS = pd.DataFrame({
+    'job_name': ['sunday_late', 'hourly', 'weekdays', 'first_of_month', 'spring', 'long'],
+    'schedule': ['50 23 * * 0', '0 * * * *', '*/20 9-17 * * 1-5', '0 3 1 * *', '15 4 * 3 *', '30 22 * * 6'],
+    'avg_runtime': pd.to_timedelta([30, 5, 1, 90, 20, 600], unit='m'),
+    'category': ['bus', 'bus', 'train', 'train', 'bus', 'train'],
+    'priority': [5, 1, 5, 2, 5, 5],
+})
+
+
+def expanded_histogram(tasks, weeks=cron_placement.HISTOGRAM_WEEKS):
+    # Every run expanded over all the weeks, as the histograms were first built
+    day = np.datetime64(START_TIME, 'D')
+    window_start = (day - (day.astype(np.int64) - 4) % 7).astype('datetime64[m]')
+    window_end = window_start + weeks * cron_placement.MINUTES_PER_WEEK
+    _, total, _, starts, minutes = load_profile.expand_runs(tasks, window_start.astype(datetime.datetime),
+                                                             window_end.astype(datetime.datetime))
+    running = load_profile.running_counts(starts, minutes, np.zeros(len(starts), dtype=np.int64), 1, total)[0]
+    return running.reshape(weeks, cron_placement.MINUTES_PER_WEEK).max(axis=0)
+
+
+def test_load_histogram_matches_the_expansion():
+    np.testing.assert_array_equal(cron_placement.load_histogram(JOBS, START_TIME), expanded_histogram(JOBS))
+
+
+def test_load_histograms_of_subsets():
+    subsets = [(JOBS['priority'] != 5).to_numpy(), (JOBS['category'] == 'bus').to_numpy(), None]
+    loads = cron_placement.load_histograms(JOBS, subsets, START_TIME)
+    assert loads.shape == (3, cron_placement.MINUTES_PER_WEEK)
+    for load, subset in zip(loads, subsets):
+        np.testing.assert_array_equal(load, expanded_histogram(JOBS if subset is None else JOBS[subset]))
@@ -0,0 +1,75 @@
+import datetime
+import time
+import pandas as pd
+import conftest
+import cron_occurrences
+import cron_task_scheduler
+import data_preprocessor
+import synthetic_data
+
+
+START_TIME = datetime.datetime(2024, 1, 1)
+END_TIME = datetime.datetime(2024, 1, 2)
+SETTINGS = dict(max_runs_per_day=4, min_hours_gap=2, time_zone='+3:30', runtimes=range(1, 4))
+
+
+JOBS = conftest.make_jobs([
+  ('bus_nightly', '0 2 * * *', 30, 'bus', 5),
+  ('bus_noon', '0 12 * * *', 60, 'bus', 3),
+  ('train_morning', '15 6 * * *', 45, 'train', 5),
+  ('train_evening', '30 18 * * *', 20, 'train', 2),
+])
+
+
+def build(cron_data):
+  return cron_task_scheduler.build_schedule(cron_data, START_TIME, END_TIME, **SETTINGS)
+
+
+def update(df, old_data, new_data):
+  return cron_task_scheduler.update_schedule(df, old_data, new_data, START_TIME, END_TIME, **SETTINGS)
+
+
+def test_find_free_times_without_tasks():
+  free_times = cron_task_scheduler.find_free_times(JOBS.iloc[:0], START_TIME, END_TIME, consider_category=True)
+  assert list(free_times.columns) == ['start_time', 'end_time', 'category']
+  assert len(free_times) == 0
+
+
+def test_find_free_times_at_production_scale(tmp_path):
+  # 30000 jobs over 14 days, with nothing cached from earlier runs
+  cron_data = data_preprocessor.process_data(*synthetic_data.generate_datasets(30000, str(tmp_path)))
+  seconds = float('inf')
+  for _ in range(2):
+    cron_occurrences.cache_clear()
+    start = time.perf_counter()
+    cron_task_scheduler.find_free_times(cron_data, START_TIME, START_TIME + datetime.timedelta(days=14), consider_category=True)
+    seconds = min(seconds, time.perf_counter() - start)
+  assert seconds < 1
+
+
+def test_update_equals_rebuild_when_a_category_is_removed():
+  previous = build(JOBS)
+  assert (previous['category'] == 'train').any()
+  new_data = JOBS[JOBS['category'] != 'train'].reset_index(drop=True)
+  updated = update(previous, JOBS, new_data)
+  assert not (updated['category'] == 'train').any()
+  pd.testing.assert_frame_equal(updated, build(new_data))
+
+
+def test_update_equals_rebuild_when_a_job_changes():
+  previous = build(JOBS)
+  new_data = JOBS.copy()
+  new_data.loc[new_data['job_name'] == 'bus_noon', 'schedule'] = '0 15 * * *'
+  pd.testing.assert_frame_equal(update(previous, JOBS, new_data), build(new_data))
+
+
+def test_update_equals_rebuild_at_a_percentile():
+  jobs = JOBS.assign(runtime_p50=JOBS['avg_runtime'], runtime_p90=JOBS['avg_runtime'] * 2, runtime_p99=JOBS['avg_runtime'] * 4)
+  previous = cron_task_scheduler.build_schedule(jobs, START_TIME, END_TIME, percentile=99, **SETTINGS)
+  assert not previous.equals(build(jobs))
+  # Only the tail runtime of a priority job changes
+  new_data = jobs.copy()
+  new_data.loc[new_data['job_name'] == 'train_evening', 'runtime_p99'] = pd.Timedelta(hours=3)
+  updated = cron_task_scheduler.update_schedule(previous, jobs, new_data, START_TIME, END_TIME, percentile=99, **SETTINGS)
+  pd.testing.assert_frame_equal(updated, cron_task_scheduler.build_schedule(new_data, START_TIME, END_TIME, percentile=99, **SETTINGS))
+  assert not updated.equals(previous)
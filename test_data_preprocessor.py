@@ -0,0 +1,34 @@
+import datetime
+import pandas as pd
+import pytest
+import data_preprocessor
+
+
+def test_parse_runtimes():
+    runtimes = pd.Series(['0 years 0 mons 0 days 0 hours 13 mins 57.5 secs', '1 day 2 hours', None, ''])
+    parsed = data_preprocessor.parse_runtimes(runtimes)
+    assert list(parsed) == [pd.Timedelta(minutes=13, seconds=57.5), pd.Timedelta(days=1, hours=2), pd.Timedelta(0), pd.Timedelta(0)]
+    assert data_preprocessor.convert_to_timedelta('3 mins') == datetime.timedelta(minutes=3)
+
+
+def test_parse_runtimes_rejects_a_malformed_runtime():
+    runtimes = pd.Series(['13 mins', '00:13:57', '5 secs', 'soon'])
+    with pytest.raises(ValueError, match="'00:13:57'.*2 malformed"):
+        data_preprocessor.parse_runtimes(runtimes)
+
+
+def test_load_cache_rebuilds_a_cache_of_another_version(tmp_path, monkeypatch):
+    paths = []
+    for name, text in (('functions.csv', 'func_name,schedule,avg_runtime\nbus_report,0 2 * * *,5 mins\n'),
+                       ('dags.csv', 'dag_id,schedule,avg_runtime\nflight_dag,30 4 * * *,0 days 00:10:00\n'),
+                       ('priority.csv', 'function_name,priority\nbus_report,2\n')):
+        (tmp_path / name).write_text(text)
+        paths.append(str(tmp_path / name))
+    cache_path = str(tmp_path / 'cache.npz')
+    cron_data = data_preprocessor.load_data(*paths, cache_path=cache_path)
+    assert list(data_preprocessor.load_cache(cache_path, paths)['job_name']) == list(cron_data['job_name'])
+    # A cache written before the version was stored, or by another version, is not used
+    monkeypatch.setattr(data_preprocessor, 'CACHE_VERSION', data_preprocessor.CACHE_VERSION + 1)
+    assert data_preprocessor.load_cache(cache_path, paths) is None
+    data_preprocessor.write_table(cron_data, cache_path, sizes=[0, 0, 0], mtimes=[0, 0, 0], hashes=['', '', ''])
+    assert data_preprocessor.load_cache(cache_path, paths) is None
@@ -0,0 +1,79 @@
+import datetime
+import sqlite3
+import pandas as pd
+import data_preprocessor
+import metadata_loader
+import synthetic_data
+
+
+NOW = datetime.datetime(2024, 1, 31)
+SINCE = NOW - datetime.timedelta(days=metadata_loader.HISTORY_DAYS)
+
+
+def add_runs(connection, table, key, state, durations, start=NOW - datetime.timedelta(days=1)):
+    columns = {'cron_job_run_details': ('jobid', 'status', 'start_time', 'end_time'),
+               'dag_run': ('dag_id', 'state', 'start_date', 'end_date')}[table]
+    connection.executemany("INSERT INTO {} ({}) VALUES (?, ?, ?, ?)".format(table, ", ".join(columns)),
+                           [(key, state, str(start), str(start + datetime.timedelta(minutes=minutes))) for minutes in durations])
+
+
+def make_fixture(path):
+    connection = sqlite3.connect(str(path))
+    metadata_loader.create_fixture(connection)
+    connection.executemany("INSERT INTO cron_job (jobid, jobname, command, schedule, active) VALUES (?, ?, ?, ?, ?)",
+                           [(1, 'bus_report', 'SELECT 1', '0 2 * * *', 1), (2, None, 'SELECT train()', '*/15 * * * *', 1),
+                            (3, 'hotel_inactive', 'SELECT 3', '0 3 * * *', 0)])
+    connection.executemany("INSERT INTO dag (dag_id, schedule_interval, is_active, is_paused) VALUES (?, ?, ?, ?)",
+                           [('flight_dag', '"30 4 * * *"', 1, 0), ('flight_paused', '"0 5 * * *"', 1, 1),
+                            ('flight_once', '"@once"', 1, 0)])
+    # Ten succeeded runs of 1 to 10 minutes, plus a failed run and a run before the history that are not counted
+    add_runs(connection, 'cron_job_run_details', 1, 'succeeded', range(1, 11))
+    add_runs(connection, 'cron_job_run_details', 1, 'failed', [500])
+    add_runs(connection, 'cron_job_run_details', 1, 'succeeded', [500], start=SINCE - datetime.timedelta(hours=1))
+    add_runs(connection, 'dag_run', 'flight_dag', 'success', [20, 40])
+    add_runs(connection, 'dag_run', 'flight_dag', 'success', [30], start=SINCE + datetime.timedelta(hours=1))
+    connection.commit()
+    return connection
+
+
+def test_load_from_database_computes_the_runtime_percentiles(tmp_path):
+    connection = make_fixture(tmp_path / 'fixture.db')
+    cron_data = metadata_loader.load_from_database(connection, since=SINCE).set_index('job_name')
+    connection.close()
+    assert sorted(cron_data.index) == ['SELECT train()', 'bus_report', 'flight_dag']
+    minutes = lambda column: (cron_data[column] / pd.Timedelta(minutes=1)).round(6)
+    # Nearest rank percentiles of the ten runs of 1 to 10 minutes
+    assert minutes('avg_runtime')['bus_report'] == 5.5
+    assert [minutes(column)['bus_report'] for column in data_preprocessor.percentile_columns()] == [5, 9, 10]
+    assert [minutes(column)['flight_dag'] for column in data_preprocessor.percentile_columns()] == [30, 40, 40]
+    # A job without runs in the history has no runtime
+    assert cron_data.loc['SELECT train()', ['avg_runtime'] + data_preprocessor.percentile_columns()].isna().all()
+
+
+def test_load_from_database_accepts_an_aware_since(tmp_path):
+    connection = make_fixture(tmp_path / 'fixture.db')
+    naive = metadata_loader.load_from_database(connection, since=SINCE)
+    # The same moment in another time zone selects the same runs, including the one an hour after it
+    tehran = datetime.timezone(datetime.timedelta(hours=3, minutes=30))
+    aware = metadata_loader.load_from_database(connection, since=SINCE.replace(tzinfo=datetime.timezone.utc).astimezone(tehran))
+    connection.close()
+    pd.testing.assert_frame_equal(naive, aware)
+    assert metadata_loader._since(SINCE, 'postgres') == SINCE.replace(tzinfo=datetime.timezone.utc)
+    assert metadata_loader._since(SINCE, 'postgres').tzinfo is not None
+
+
+def test_load_from_database_reads_the_synthetic_database(tmp_path):
+    path = synthetic_data.generate_database(str(tmp_path / 'synthetic.db'), 200, num_runs=5000, now=NOW)
+    connection = sqlite3.connect(path)
+    try:
+        num_functions = connection.execute("SELECT COUNT(*) FROM cron_job").fetchone()[0]
+        num_dags = connection.execute("SELECT COUNT(*) FROM dag").fetchone()[0]
+        cron_data = metadata_loader.load_from_database(connection, since=SINCE)
+    finally:
+        connection.close()
+    assert len(cron_data) == num_functions + num_dags == 200
+    runtimes = cron_data[['avg_runtime'] + data_preprocessor.percentile_columns()].dropna()
+    assert len(runtimes) > 150
+    assert (runtimes['runtime_p50'] <= runtimes['runtime_p90']).all()
+    assert (runtimes['runtime_p90'] <= runtimes['runtime_p99']).all()
+    assert (runtimes['avg_runtime'] > pd.Timedelta(0)).all()
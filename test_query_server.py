@@ -0,0 +1,49 @@
+import datetime
+import json
+import conftest
+import data_preprocessor
+import query_server
+
+
+NOW = datetime.datetime(2024, 1, 1)
+
+
+def make_state(rows):
+    return query_server.ServerState(conftest.make_jobs(rows), now=NOW, index_path=None)
+
+
+def free_times(state, day, consider_category):
+    return state.free_times({'start_time': day + 'T00:00:00', 'end_time': day + 'T06:00:00',
+                             'consider_category': consider_category})
+
+
+def test_free_times_of_an_empty_table():
+    state = make_state([])
+    # Within the horizon (warm intervals) and outside of it (fallback to find_free_times)
+    for day in ('2024-01-01', '2030-01-01'):
+        assert free_times(state, day, True) == []
+        assert free_times(state, day, False) == [{'start_time': day + 'T00:00:00', 'end_time': day + 'T06:00:00'}]
+
+
+def test_free_times_match_the_fallback():
+    state = make_state([('bus_nightly', '0 2 * * *', 30, 'bus', 5), ('train_morning', '0 3 * * *', 60, 'train', 2)])
+    for consider_category in (True, False):
+        warm = free_times(state, '2024-01-01', consider_category)
+        cold = free_times(state, '2030-01-01', consider_category)
+        assert [{key: value.replace('2024', '2030') for key, value in row.items()} for row in warm] == cold
+
+
+def test_encoded_answers_match_the_json_of_the_answers(tmp_path):
+    cron_data = conftest.make_jobs([('bus_nightly', '0 2 * * *', 30, 'bus', 5), ('train_"quoted"', '0 2 * * *', 60, 'train', 2),
+                                    ('hôtel_morning', '30 1 * * *', 90, 'hotel', 5)])
+    table_path = str(tmp_path / 'table.npz')
+    data_preprocessor.write_table(cron_data, table_path)
+    server = query_server.QueryServer(None, None, None, index_path=None, table_path=table_path)
+    day = str(server.state.loaded_at.date())
+    running = {'time': day + ' 02:15'}
+    jobs = {'start_date': day, 'end_date': day + ' 06:00', 'time_interval': [1, 2], 'time_zone': 'UTC'}
+    assert server.handle('/running', running)['result'] == ['bus_nightly', 'train_"quoted"', 'hôtel_morning']
+    assert server.handle('/jobs', jobs)['result'] == ['hôtel_morning']
+    for endpoint, query in (('/running', running), ('/jobs', jobs), ('/running', {'time': day + ' 12:00'})):
+        for body in (query, {'queries': [query, query]}, {'queries': []}):
+            assert server.encode(endpoint, body) == json.dumps(server.handle(endpoint, body)).encode()
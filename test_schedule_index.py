@@ -0,0 +1,21 @@
+import datetime
+import numpy as np
+import cron_occurrences
+import schedule_index
+
+
+# Schedules of the exceptions layer (restricted days of the month or months), with and without cron's day "or" rule
+SCHEDULES = ['0 6 13 * 5', '0 6 13 * *', '30 7 * 2 1-5', '15 22 1,15 */3 *', '0 0 29 2 *', '45 12 */10 * 0,6']
+
+
+def test_exceptions_layer_matches_the_occurrences():
+    index = schedule_index.ScheduleIndex.build(['job_{}'.format(i) for i in range(len(SCHEDULES))], SCHEDULES)
+    day = datetime.datetime(2024, 1, 1)
+    for _ in range(400):
+        # Whole days from midnight UTC, answered by the date layer of the index
+        found = index.query(day - datetime.timedelta(minutes=1), day + datetime.timedelta(days=1) - datetime.timedelta(minutes=1),
+                            (0, 24), 'UTC')
+        expected = [job for job, schedule in enumerate(SCHEDULES)
+                    if len(cron_occurrences.occurrences(schedule, day, day + datetime.timedelta(days=1)))]
+        np.testing.assert_array_equal(found, expected, err_msg=str(day))
+        day += datetime.timedelta(days=1)
@@ -0,0 +1,52 @@
+import datetime
+import time
+import pandas as pd
+import pytest
+import cron_schedule_lookup
+import cron_task_scheduler
+import time_zones
+
+
+@pytest.fixture
+def tehran_host(monkeypatch):
+    # A host clock 3:30 ahead of UTC, so a local now would be off by hours
+    monkeypatch.setenv('TZ', 'Asia/Tehran')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def epoch_now():
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=time.time())
+
+
+def assert_close(moment, expected, seconds=60):
+    assert abs(moment - expected) < datetime.timedelta(seconds=seconds)
+
+
+def test_utc_now_ignores_the_host_time_zone(tehran_host):
+    assert datetime.datetime.now() - time_zones.utc_now() > datetime.timedelta(hours=3)
+    assert_close(time_zones.utc_now(), epoch_now(), seconds=5)
+
+
+def test_start_dates_are_in_utc(tehran_host):
+    tasks = pd.DataFrame({'job_name': ['minutely'], 'schedule': ['* * * * *']})
+    assert_close(cron_task_scheduler.generate_start_date(tasks)['start_date'].iloc[0].to_pydatetime(), epoch_now())
+
+
+def test_now_of_the_lookup_is_on_the_wall_clock_of_the_query(tehran_host):
+    assert_close(cron_schedule_lookup.parse_start_date('now'), epoch_now())
+    assert_close(cron_schedule_lookup.parse_start_date('now', time_zones.get_zone('-8:00')),
+                 epoch_now() - datetime.timedelta(hours=8))
+
+
+def test_scheduler_window_starts_at_utc_now(tehran_host, tmp_path):
+    cron_data = pd.DataFrame({'job_name': ['nightly'], 'schedule': ['0 2 * * *'], 'avg_runtime': [pd.Timedelta(minutes=30)],
+                              'category': ['bus'], 'priority': [5]})
+    snapshot_path = str(tmp_path / 'snapshot.npz')
+    cron_task_scheduler.run_schedule(cron_data, 4, 2, '+3:30', runtimes=range(1, 2), output_path=str(tmp_path / 'output.csv'),
+                                     snapshot_path=snapshot_path)
+    _, start_time, end_time, _ = cron_task_scheduler.load_snapshot(snapshot_path)
+    assert_close(start_time, epoch_now())
+    assert end_time - start_time == datetime.timedelta(days=3)
@@ -0,0 +1,202 @@
+import datetime
+import functools
+import re
+import numpy as np
+
+
+# An offset from UTC such as "+3:30", "-8:00" or "+03:30"
+OFFSET_PATTERN = r'^([+-])(\d{1,2}):(\d\d)$'
+
+# Spacing, in minutes, of the samples taken to find the offset changes of a zone; zones never change their
+# offset twice within this time, and every change found is narrowed down to the minute
+SAMPLE_MINUTES = 60
+
+# Maximum number of (zone, date range) offset tables kept in memory
+OFFSET_TABLE_CACHE_SIZE = 256
+
+
+def parse_offset(offset):
+    """
+    Convert an offset from UTC in the format '±H:M' (e.g. '+3:30', '-10:00') to a timedelta.
+    """
+    match = re.match(OFFSET_PATTERN, offset.strip())
+    if not match:
+        raise ValueError("Invalid offset: '{}'. Please enter the offset in the format '±H:M'.".format(offset))
+    sign = 1 if match.group(1) == '+' else -1
+    return sign * datetime.timedelta(hours=int(match.group(2)), minutes=int(match.group(3)))
+
+
+def get_zone(zone):
+    """
+    Return the time zone object for a zone given in any of the accepted forms.
+
+    Parameters:
+    - zone: None or '' for UTC, an IANA name such as 'Asia/Tehran', an offset from UTC such as '+3:30', a timedelta
+      (including pandas Timedelta) or a tzinfo object (datetime.timezone, zoneinfo or pytz zones).
+
+    Returns:
+    - tzinfo: The time zone; IANA names give a zoneinfo.ZoneInfo, which follows the daylight saving time rules.
+    """
+    if zone is None or (isinstance(zone, str) and not zone.strip()):
+        return datetime.timezone.utc
+    if isinstance(zone, datetime.tzinfo):
+        if hasattr(zone, 'localize'):
+            # pytz zones only give the right offsets through localize, so use the zoneinfo zone of the same name
+            return get_zone(zone.zone) if zone.zone else _fixed_zone(zone.utcoffset(None))
+        return zone
+    if isinstance(zone, datetime.timedelta):
+        return _fixed_zone(datetime.timedelta(minutes=int(zone.total_seconds() // 60)))
+    if re.match(OFFSET_PATTERN, zone.strip()):
+        return _fixed_zone(parse_offset(zone))
+    if zone.strip().upper() == 'UTC':
+        return datetime.timezone.utc
+    import zoneinfo
+    try:
+        return zoneinfo.ZoneInfo(zone.strip())
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        pass
+    # Anything pandas can read as a duration ('3h30m', '210 minutes') is a fixed offset, as in earlier versions
+    import pandas as pd
+    try:
+        return get_zone(pd.Timedelta(zone))
+    except ValueError:
+        raise ValueError("Unknown time zone: '{}'. Use an IANA name (e.g. 'Asia/Tehran') or an offset in the format '±H:M'.".format(zone))
+
+
+def utc_now():
+    """
+    Return the current time as a naive UTC datetime, the convention of every script whatever the time zone of the host.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def zone_name(zone):
+    """
+    Return the IANA name of a time zone if it has one, otherwise its offset from UTC (e.g. 'UTC+0330').
+    """
+    zone = get_zone(zone)
+    if zone is datetime.timezone.utc:
+        return 'UTC'
+    name = getattr(zone, 'key', None) or getattr(zone, 'zone', None)
+    if name:
+        return name
+    return datetime.datetime(2000, 1, 1, tzinfo=zone).strftime('UTC%z')
+
+
+def utc_offset(zone, moment):
+    """
+    Return the offset from UTC of a time zone at a moment.
+
+    Parameters:
+    - zone: The time zone, in any form accepted by get_zone.
+    - moment (datetime): The moment, naive datetimes being in UTC.
+
+    Returns:
+    - timedelta: The offset, including daylight saving time.
+    """
+    moment = _utc_datetime(moment)
+    return moment.astimezone(get_zone(zone)).utcoffset()
+
+
+def to_utc(moment, zone):
+    """
+    Convert a wall clock time of a time zone to a naive UTC datetime.
+
+    Wall clock times that happen twice (when the clocks go back) are taken at their first occurrence, and the ones
+    that do not exist (when the clocks go forward) are shifted by the offset from before the change.
+    """
+    local = moment.replace(tzinfo=get_zone(zone), fold=0)
+    return local.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def offset_table(zone, start, end):
+    """
+    Build the table of the offsets from UTC a time zone uses between two moments.
+
+    The offset changes are found by sampling the offset every SAMPLE_MINUTES minutes and narrowing every change
+    down to the minute by bisection. The tables are cached by zone and day range.
+
+    Parameters:
+    - zone: The time zone, in any form accepted by get_zone.
+    - start (numpy.datetime64): The first UTC moment the table must cover.
+    - end (numpy.datetime64): The last UTC moment the table must cover.
+
+    Returns:
+    - tuple: (changes, offsets) int64 arrays, where offsets[i] is the offset in minutes in effect from the UTC
+      epoch minute changes[i] on (changes[0] is the start of the table).
+    """
+    first_day = np.datetime64(start, 'D').astype(np.int64)
+    last_day = np.datetime64(end, 'D').astype(np.int64)
+    return _offset_table_cached(get_zone(zone), int(first_day), int(last_day) + 1)
+
+
+def to_local(times, zone):
+    """
+    Project UTC times onto the wall clock of a time zone, with one binary search over its offset table.
+
+    Parameters:
+    - times (numpy array): UTC datetime64 values, in minutes or a finer unit.
+    - zone: The time zone, in any form accepted by get_zone.
+
+    Returns:
+    - numpy array: The wall clock times, in the same unit as times.
+    """
+    zone = get_zone(zone)
+    if len(times) == 0:
+        return times.copy()
+    if isinstance(zone, datetime.timezone):
+        # Fixed offsets need no table
+        return times + np.timedelta64(int(zone.utcoffset(None).total_seconds() // 60), 'm')
+    minutes = times.astype('datetime64[m]').astype(np.int64)
+    changes, offsets = offset_table(zone, times.min(), times.max())
+    shift = offsets[np.searchsorted(changes, minutes, side='right') - 1]
+    return times + shift.astype('timedelta64[m]')
+
+
+def project(times, zones):
+    """
+    Project the same UTC times onto several time zones.
+
+    Returns:
+    - dict: The wall clock times for each zone, keyed as given.
+    """
+    return {zone: to_local(times, zone) for zone in zones}
+
+
+@functools.lru_cache(maxsize=OFFSET_TABLE_CACHE_SIZE)
+def _offset_table_cached(zone, first_day, end_day):
+    first = first_day * 1440
+    samples = np.arange(first, end_day * 1440 + SAMPLE_MINUTES, SAMPLE_MINUTES, dtype=np.int64)
+    offsets = np.array([_offset_minutes(zone, minute) for minute in samples], dtype=np.int64)
+    changes = [first]
+    values = [offsets[0]]
+    for i in np.flatnonzero(offsets[1:] != offsets[:-1]):
+        # The offset changes between samples i and i + 1: find the first minute with the new offset
+        low, high = int(samples[i]), int(samples[i + 1])
+        while high - low > 1:
+            middle = (low + high) // 2
+            if _offset_minutes(zone, middle) == offsets[i]:
+                low = middle
+            else:
+                high = middle
+        changes.append(high)
+        values.append(offsets[i + 1])
+    return np.array(changes, dtype=np.int64), np.array(values, dtype=np.int64)
+
+
+def _offset_minutes(zone, minute):
+    # The offset in minutes of a zone at a UTC epoch minute
+    moment = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(minutes=int(minute))
+    return int(moment.astimezone(zone).utcoffset().total_seconds() // 60)
+
+
+def _fixed_zone(offset):
+    return datetime.timezone.utc if not offset else datetime.timezone(offset)
+
+
+def _utc_datetime(moment):
+    if isinstance(moment, np.datetime64):
+        moment = moment.astype('datetime64[us]').astype(datetime.datetime)
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=datetime.timezone.utc)
+    return moment